@@ -44,15 +44,39 @@ from neurosym.utils.imports import import_pytorch_lightning
 from . import compression, datasets, examples, search
 from .dsl.dsl_factory import DSLFactory
 from .program_dist.bigram import (
+    BigramCountStore,
     BigramProgramCounts,
     BigramProgramCountsBatch,
     BigramProgramDistributionFamily,
 )
+from .program_dist.ngram import (
+    NgramProgramCounts,
+    NgramProgramCountsBatch,
+    NgramProgramDistributionFamily,
+)
 from .program_dist.tree_distribution.preorder_mask.type_preorder_mask import (
     TypePreorderMask,
 )
-from .program_dist.tree_distribution.tree_dist_enumerator import enumerate_tree_dist
-from .program_dist.tree_distribution.tree_distribution import TreeDistribution
+from .program_dist.tree_distribution.tree_dist_best_first_enumerator import (
+    enumerate_tree_dist_best_first,
+)
+from .program_dist.tree_distribution.tree_dist_enumerator import (
+    EnumerationCache,
+    EnumerationCursor,
+    EnumerationStats,
+    enumerate_tree_dist,
+)
+from .program_dist.tree_distribution.tree_dist_estimator import (
+    EnumerationEstimate,
+    estimate_tree_dist_enumeration,
+)
+from .program_dist.tree_distribution.tree_dist_likelihood_computer import (
+    LikelihoodCache,
+)
+from .program_dist.tree_distribution.tree_distribution import (
+    CSRDistribution,
+    TreeDistribution,
+)
 from .programs.s_expression import SExpression
 from .programs.s_expression_render import (
     parse_s_expression,
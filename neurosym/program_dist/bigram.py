@@ -1,7 +1,7 @@
 from collections import defaultdict
 from dataclasses import dataclass
 from types import NoneType
-from typing import Callable, Dict, List, Tuple, Union
+from typing import Any, Callable, Dict, List, Tuple, Union
 
 import numpy as np
 import torch
@@ -15,12 +15,20 @@ from neurosym.program_dist.tree_distribution.preorder_mask.preorder_mask import
 from neurosym.program_dist.tree_distribution.preorder_mask.type_preorder_mask import (
     TypePreorderMask,
 )
-from neurosym.program_dist.tree_distribution.tree_distribution import TreeDistribution
+from neurosym.program_dist.tree_distribution.tree_distribution import (
+    CSRDistribution,
+    TreeDistribution,
+)
 from neurosym.programs.s_expression import SExpression
 from neurosym.types.type import Type
+from neurosym.utils.fork_pool import fork_pool, worker_state
 
 from .tree_distribution.tree_distribution import TreeProgramDistributionFamily
 
+# Maximum number of parameter elements gathered at once when computing the
+# denominator of the loss.
+DEFAULT_DENOMINATOR_CHUNK_SIZE = 2**22
+
 
 @dataclass
 class BigramProgramDistribution:
@@ -60,6 +68,13 @@ class BigramProgramDistribution:
 
         return mask_square
 
+    def lazy(self) -> "LazyBigramProgramDistribution":
+        """
+        Produce a lazy view of this distribution, on which smoothing and mixing
+            operations are recorded rather than applied.
+        """
+        return LazyBigramProgramDistribution(self.dist_fam, self)
+
     def mix_with_other(self, other: "BigramProgramDistribution", weight_other: float):
         # pylint: disable=self-cls-assignment
         assert 0 <= weight_other <= 1
@@ -71,16 +86,7 @@ class BigramProgramDistribution:
             weight_other = 1 - weight_other
         else:
             if not set(symbols_this).issuperset(symbols_other):
-                extra_this = set(symbols_this) - set(symbols_other)
-                extra_other = set(symbols_other) - set(symbols_this)
-                extra_this, extra_other = (
-                    ", ".join(repr(x) for x in sorted(extra))
-                    for extra in (extra_this, extra_other)
-                )
-                raise ValueError(
-                    "DSL not compatible, extra symbols in this: "
-                    f"{extra_this}, extra symbols in other: {extra_other}"
-                )
+                raise incompatible_symbols_error(symbols_this, symbols_other)
         mask = np.array([s in symbols_other for s in symbols_this], dtype=np.bool_)
         distribution = self.distribution.copy()
         distribution_other = np.zeros_like(distribution)
@@ -92,6 +98,146 @@ class BigramProgramDistribution:
         return BigramProgramDistribution(self.dist_fam, distribution)
 
 
+@dataclass
+class LazyBigramProgramDistribution:
+    """
+    A bigram distribution with a sequence of transformations recorded on top of
+        it. The transformations have the same semantics as the corresponding
+        methods of `BigramProgramDistribution`, but are only applied when the tree
+        distribution is computed, in a single pass over the valid productions of
+        the family rather than over dense [symbols, arity, symbols] arrays.
+
+    Can be passed anywhere a `BigramProgramDistribution` is accepted by
+        `BigramProgramDistributionFamily`, e.g., `enumerate` or `compute_likelihood`.
+    """
+
+    dist_fam: "BigramProgramDistributionFamily"
+    source: BigramProgramDistribution
+    # each step is (name, *arguments)
+    steps: Tuple[Tuple[Any, ...], ...] = ()
+
+    def _with_step(self, *step) -> "LazyBigramProgramDistribution":
+        return LazyBigramProgramDistribution(
+            self.dist_fam, self.source, self.steps + (step,)
+        )
+
+    def bound_minimum_likelihood(
+        self, min_likelihood: float, symbol_mask: np.ndarray = None
+    ) -> "LazyBigramProgramDistribution":
+        """
+        See `BigramProgramDistribution.bound_minimum_likelihood`.
+        """
+        assert 0 <= min_likelihood <= 1
+        if symbol_mask is not None:
+            assert symbol_mask.shape == (len(self.dist_fam.symbols()),)
+            assert symbol_mask.dtype == np.bool_
+        return self._with_step("bound", min_likelihood, symbol_mask)
+
+    def mask_symbols(self, symbol_mask: np.ndarray) -> "LazyBigramProgramDistribution":
+        """
+        Remove all productions of the symbols not in the given mask, renormalizing
+            the remaining productions.
+        """
+        assert symbol_mask.shape == (len(self.dist_fam.symbols()),)
+        assert symbol_mask.dtype == np.bool_
+        return self._with_step("mask", symbol_mask)
+
+    def mix_with_other(
+        self,
+        other: Union[BigramProgramDistribution, "LazyBigramProgramDistribution"],
+        weight_other: float,
+    ) -> "LazyBigramProgramDistribution":
+        """
+        See `BigramProgramDistribution.mix_with_other`.
+        """
+        assert 0 <= weight_other <= 1
+        if isinstance(other, BigramProgramDistribution):
+            other = other.lazy()
+        symbols_this = self.dist_fam.symbols()
+        symbols_other = other.dist_fam.symbols()
+        if set(symbols_this).issubset(symbols_other):
+            # the result is over the larger family, so the mix is recorded on other
+            return LazyBigramProgramDistribution(
+                other.dist_fam,
+                other.source,
+                other.steps + (("mix", self, 1 - weight_other),),
+            )
+        if not set(symbols_this).issuperset(symbols_other):
+            raise incompatible_symbols_error(symbols_this, symbols_other)
+        return self._with_step("mix", other, weight_other)
+
+    def to_distribution(self) -> BigramProgramDistribution:
+        """
+        Apply the transformations to the dense distribution.
+        """
+        values = self.packed_values()
+        if values is not None:
+            return BigramProgramDistribution(
+                self.dist_fam, self.dist_fam.unpack_distribution(values)
+            )
+        distribution = self.source
+        for name, *args in self.steps:
+            if name == "bound":
+                distribution = distribution.bound_minimum_likelihood(*args)
+            elif name == "mix":
+                other, weight_other = args
+                distribution = distribution.mix_with_other(
+                    other.to_distribution(), weight_other
+                )
+            else:
+                assert name == "mask", name
+                [symbol_mask] = args
+                values = distribution.distribution * symbol_mask
+                values = values / (values.sum(-1)[..., None] + 1e-10)
+                distribution = BigramProgramDistribution(self.dist_fam, values)
+        return distribution
+
+    def packed_values(self) -> Union[np.ndarray, NoneType]:
+        """
+        Compute the probability of each valid production, in the order given by
+            the family's `valid_indices`. Returns None if some probability mass
+            would fall outside of the valid productions, in which case the
+            distribution can only be computed densely.
+        """
+        fam = self.dist_fam
+        dist_vals = self.source.distribution
+        values = dist_vals[tuple(fam.valid_indices.T)]
+        if (values > 0).sum() != (dist_vals > 0).sum():
+            return None
+        parent, _, child = fam.valid_indices.T
+        for name, *args in self.steps:
+            if name == "bound":
+                min_likelihood, symbol_mask = args
+                if symbol_mask is None:
+                    values = np.maximum(values, min_likelihood)
+                else:
+                    within = symbol_mask[parent] & symbol_mask[child]
+                    values = np.where(
+                        within, np.maximum(values, min_likelihood), values
+                    )
+            elif name == "mix":
+                other, weight_other = args
+                other_values = other.packed_values()
+                if other_values is None:
+                    return None
+                embedded = fam.embed_packed_values(other.dist_fam, other_values)
+                if embedded is None:
+                    return None
+                other_values, within = embedded
+                values = np.where(
+                    within,
+                    weight_other * other_values + (1 - weight_other) * values,
+                    values,
+                )
+                continue
+            else:
+                assert name == "mask", name
+                [symbol_mask] = args
+                values = values * symbol_mask[child]
+            values = values / (fam.packed_context_sums(values) + 1e-10)
+        return values
+
+
 @dataclass
 class BigramProgramDistributionBatch:
     dist_fam: "BigramProgramDistributionFamily"
@@ -113,24 +259,160 @@ class BigramProgramDistributionBatch:
 
 @dataclass
 class BigramProgramCounts:
-    # map from (parent_sym, parent_child_idx) to map from child_sym to count
-    numerators: Dict[Tuple[Tuple[int, int], ...], Dict[int, int]]
-    # map from (parent_sym, parent_child_idx) to map from potential child_sym values to count
-    denominators: Dict[Tuple[Tuple[int, int], ...], Dict[Tuple[int, ...], int]]
+    """
+    Counts of the productions in a set of programs, stored in COO form.
+    """
 
-    def add_to_numerator_array(self, arr, batch_idx):
-        for [(parent_sym, parent_child_idx)], children in self.numerators.items():
+    # [N, 3] array of (parent_sym, parent_child_idx, child_sym) rows, without duplicates
+    numerator_indices: np.ndarray
+    # [N] array of the count for each row of numerator_indices
+    numerator_values: np.ndarray
+    # [M, 3] array of (parent_sym, parent_child_idx, key_idx) rows, without duplicates,
+    # where key_idx is an index into denominator_keys
+    denominator_indices: np.ndarray
+    # [M] array of the count for each row of denominator_indices
+    denominator_values: np.ndarray
+    # the potential child_sym values for each key_idx
+    denominator_keys: List[Tuple[int, ...]]
+
+    @classmethod
+    def from_dicts(
+        cls,
+        numerators: Dict[Tuple[Tuple[int, int], ...], Dict[int, int]],
+        denominators: Dict[Tuple[Tuple[int, int], ...], Dict[Tuple[int, ...], int]],
+    ) -> "BigramProgramCounts":
+        """
+        Create the counts from the nested dictionary format, see
+            `numerators` and `denominators`.
+        """
+        accumulator = BigramCountAccumulator()
+        for [(parent_sym, position)], children in numerators.items():
             for child_sym, count in children.items():
-                arr[batch_idx, parent_sym, parent_child_idx, child_sym] = count
+                accumulator.add_numerator(parent_sym, position, child_sym, count)
+        for [(parent_sym, position)], children in denominators.items():
+            for child_syms, count in children.items():
+                accumulator.add_denominator(parent_sym, position, child_syms, count)
+        return accumulator.finish()
+
+    @property
+    def numerators(self) -> Dict[Tuple[Tuple[int, int], ...], Dict[int, int]]:
+        """
+        Map from ((parent_sym, parent_child_idx),) to map from child_sym to count.
+        """
+        result = defaultdict(dict)
+        for (parent_sym, position, child_sym), count in zip(
+            self.numerator_indices.tolist(), self.numerator_values.tolist()
+        ):
+            result[(parent_sym, position),][child_sym] = count
+        return dict(result)
+
+    @property
+    def denominators(
+        self,
+    ) -> Dict[Tuple[Tuple[int, int], ...], Dict[Tuple[int, ...], int]]:
+        """
+        Map from ((parent_sym, parent_child_idx),) to map from the tuple of
+            potential child_sym values to count.
+        """
+        result = defaultdict(dict)
+        for (parent_sym, position, key_idx), count in zip(
+            self.denominator_indices.tolist(), self.denominator_values.tolist()
+        ):
+            result[(parent_sym, position),][self.denominator_keys[key_idx]] = count
+        return dict(result)
+
+    def add_to_numerator_array(self, arr, batch_idx):
+        parent_sym, position, child_sym = self.numerator_indices.T
+        arr[batch_idx, parent_sym, position, child_sym] = self.numerator_values
         return arr
 
     def add_to_denominator_array(self, arr, batch_idx, backmap):
-        for [(parent_sym, parent_child_idx)], children in self.denominators.items():
-            for child_syms, count in children.items():
-                key = batch_idx, parent_sym, parent_child_idx, backmap[child_syms]
-                arr[key] = count
+        parent_sym, position, key_idx = self.denominator_indices.T
+        key_idx = self.key_remapping(backmap)[key_idx]
+        arr[batch_idx, parent_sym, position, key_idx] = self.denominator_values
         return arr
 
+    @classmethod
+    def merge(cls, counts: List["BigramProgramCounts"]) -> "BigramProgramCounts":
+        """
+        Sum together several sets of counts. This is associative, so counts
+            computed on disjoint shards of a corpus can be merged in any grouping.
+        """
+        if not counts:
+            return BigramCountAccumulator().finish()
+        denominator_keys = list(
+            dict.fromkeys(key for c in counts for key in c.denominator_keys)
+        )
+        backmap = {key: i for i, key in enumerate(denominator_keys)}
+        denominator_indices = []
+        for c in counts:
+            indices = c.denominator_indices.copy()
+            indices[:, 2] = c.key_remapping(backmap)[indices[:, 2]]
+            denominator_indices.append(indices)
+        numerator_indices, numerator_values = aggregate_coo(
+            np.concatenate([c.numerator_indices for c in counts]),
+            np.concatenate([c.numerator_values for c in counts]),
+        )
+        denominator_indices, denominator_values = aggregate_coo(
+            np.concatenate(denominator_indices),
+            np.concatenate([c.denominator_values for c in counts]),
+        )
+        return cls(
+            numerator_indices=numerator_indices,
+            numerator_values=numerator_values,
+            denominator_indices=denominator_indices,
+            denominator_values=denominator_values,
+            denominator_keys=denominator_keys,
+        )
+
+    def key_remapping(self, backmap: Dict[Tuple[int, ...], int]) -> np.ndarray:
+        """
+        Array mapping each of this object's key_idx values to the index given
+            by the backmap.
+        """
+        return np.array([backmap[key] for key in self.denominator_keys], dtype=np.int64)
+
+
+class BigramCountAccumulator:
+    """
+    Accumulates counts of productions, and produces a `BigramProgramCounts`.
+    """
+
+    def __init__(self):
+        self._numerator_indices = []
+        self._numerator_values = []
+        self._denominator_indices = []
+        self._denominator_values = []
+        self._denominator_key_ids = {}
+        # number of productions that were not allowed by the preorder mask
+        self.num_disallowed = 0
+
+    def add_numerator(self, parent_sym, position, child_sym, count=1):
+        self._numerator_indices.append((parent_sym, position, child_sym))
+        self._numerator_values.append(count)
+
+    def add_denominator(self, parent_sym, position, child_syms, count=1):
+        key_idx = self._denominator_key_ids.setdefault(
+            child_syms, len(self._denominator_key_ids)
+        )
+        self._denominator_indices.append((parent_sym, position, key_idx))
+        self._denominator_values.append(count)
+
+    def finish(self) -> BigramProgramCounts:
+        numerator_indices, numerator_values = aggregate_coo(
+            self._numerator_indices, self._numerator_values
+        )
+        denominator_indices, denominator_values = aggregate_coo(
+            self._denominator_indices, self._denominator_values
+        )
+        return BigramProgramCounts(
+            numerator_indices=numerator_indices,
+            numerator_values=numerator_values,
+            denominator_indices=denominator_indices,
+            denominator_values=denominator_values,
+            denominator_keys=list(self._denominator_key_ids),
+        )
+
 
 @dataclass
 class BigramProgramCountsBatch:
@@ -141,28 +423,88 @@ class BigramProgramCountsBatch:
         numerators = np.zeros(
             (len(self.counts), num_symbols, max_arity, num_symbols), dtype=np.int32
         )
-        for i, dist in enumerate(self.counts):
-            dist.add_to_numerator_array(numerators, i)
+        indices, values = self.numerator_entries()
+        numerators[tuple(indices.T)] = values
         return numerators
 
     def denominators(self, num_symbols, max_arity):
-        denominator_keys = {
-            key
-            for counts in self.counts
-            for mapping in counts.denominators.values()
-            for key in mapping.keys()
-        }
-        denominator_keys = sorted(denominator_keys)
-        denominator_keys_backmap = {key: i for i, key in enumerate(denominator_keys)}
+        indices, values, denominator_keys = self.denominator_entries()
         denominators = np.zeros(
             (len(self.counts), num_symbols, max_arity, len(denominator_keys)),
             dtype=np.int32,
         )
-        for i, counts in enumerate(self.counts):
-            counts.add_to_denominator_array(denominators, i, denominator_keys_backmap)
-
+        denominators[tuple(indices.T)] = values
         return denominators, denominator_keys
 
+    def denominator_keys(self) -> List[Tuple[int, ...]]:
+        """
+        Sorted list of all the distinct denominator keys (sets of possible
+            child symbols) that appear in any of the counts.
+        """
+        return sorted(
+            {key for counts in self.counts for key in counts.denominator_keys}
+        )
+
+    def numerator_entries(self):
+        """
+        Sparse version of `numerators`. Only the nonzero entries are produced.
+
+        Returns (indices, values), where indices is an [N, 4] array of
+            (batch_idx, parent_sym, parent_child_idx, child_sym) rows, and values
+            is the [N] array of corresponding counts.
+        """
+        return with_batch_index(
+            [counts.numerator_indices for counts in self.counts],
+            [counts.numerator_values for counts in self.counts],
+        )
+
+    def denominator_entries(self):
+        """
+        Sparse version of `denominators`. Only the nonzero entries are produced.
+
+        Returns (indices, values, denominator_keys), where indices is an
+            [N, 4] array of (batch_idx, parent_sym, parent_child_idx, key_idx)
+            rows, values is the [N] array of corresponding counts, and
+            denominator_keys is the same as in `denominators`.
+        """
+        denominator_keys = self.denominator_keys()
+        backmap = {key: i for i, key in enumerate(denominator_keys)}
+        all_indices = []
+        for counts in self.counts:
+            indices = counts.denominator_indices.copy()
+            indices[:, 2] = counts.key_remapping(backmap)[indices[:, 2]]
+            all_indices.append(indices)
+        indices, values = with_batch_index(
+            all_indices, [counts.denominator_values for counts in self.counts]
+        )
+        return indices, values, denominator_keys
+
+    def to_mle_distribution(
+        self,
+        num_symbols,
+        max_arity,
+        *,
+        max_iterations: int = 100,
+        tolerance: float = 1e-7,
+    ):
+        """
+        Like `to_distribution`, but takes the denominators into account, producing
+            the maximum likelihood distribution when preorder masks restrict the
+            set of possible symbols. See `masked_softmax_mle`.
+        """
+        den_indices, den_values, denominator_keys = self.denominator_entries()
+        return BigramProgramDistributionBatch(
+            self.dist_fam,
+            masked_softmax_mle(
+                self.numerators(num_symbols, max_arity),
+                den_indices,
+                den_values,
+                denominator_keys,
+                max_iterations=max_iterations,
+                tolerance=tolerance,
+            ),
+        )
+
     def to_distribution(self, num_symbols, max_arity):
         numerators = self.numerators(num_symbols, max_arity)
 
@@ -175,6 +517,123 @@ class BigramProgramCountsBatch:
         )
 
 
+class BigramCountStore:
+    """
+    Running bigram counts over a corpus that changes over time. Programs can be
+        added and removed incrementally, stores counted separately (e.g., on
+        different machines) can be merged, and the counts can be saved to and
+        loaded from a compressed .npz file.
+
+    Pass the store to `BigramProgramDistributionFamily.fit_distribution` to fit
+        a distribution to the programs it contains.
+    """
+
+    def __init__(
+        self,
+        dist_fam: "BigramProgramDistributionFamily",
+        counts: Union[BigramProgramCounts, NoneType] = None,
+        num_programs: int = 0,
+    ):
+        self.dist_fam = dist_fam
+        self.counts = (
+            counts if counts is not None else BigramCountAccumulator().finish()
+        )
+        self.num_programs = num_programs
+
+    def add(
+        self, programs: List[SExpression], *, n_workers: Union[int, NoneType] = None
+    ) -> "BigramCountStore":
+        """
+        Add the counts of the given programs to the store. Returns the store.
+        """
+        [counts] = self.dist_fam.count_programs([programs], n_workers=n_workers).counts
+        self.counts = BigramProgramCounts.merge([self.counts, counts])
+        self.num_programs += len(programs)
+        return self
+
+    def remove(
+        self, programs: List[SExpression], *, n_workers: Union[int, NoneType] = None
+    ) -> "BigramCountStore":
+        """
+        Remove the counts of the given programs, which must previously have been
+            added to the store. Returns the store.
+        """
+        [counts] = self.dist_fam.count_programs([programs], n_workers=n_workers).counts
+        counts = BigramProgramCounts(
+            numerator_indices=counts.numerator_indices,
+            numerator_values=-counts.numerator_values,
+            denominator_indices=counts.denominator_indices,
+            denominator_values=-counts.denominator_values,
+            denominator_keys=counts.denominator_keys,
+        )
+        result = BigramProgramCounts.merge([self.counts, counts])
+        if (result.numerator_values < 0).any() or (result.denominator_values < 0).any():
+            raise ValueError("Cannot remove programs that were not added to the store")
+        self.counts = result
+        self.num_programs -= len(programs)
+        return self
+
+    def merge(self, other: "BigramCountStore") -> "BigramCountStore":
+        """
+        Add the counts in another store to this one. Returns this store.
+        """
+        if list(other.dist_fam.symbols()) != list(self.dist_fam.symbols()):
+            raise ValueError("Cannot merge count stores over different symbols")
+        self.counts = BigramProgramCounts.merge([self.counts, other.counts])
+        self.num_programs += other.num_programs
+        return self
+
+    def save(self, path: str):
+        """
+        Save the store to the given path, as a compressed .npz file. Only the
+            denominator keys that are in use are saved.
+        """
+        used = np.unique(self.counts.denominator_indices[:, 2])
+        remap = np.zeros(len(self.counts.denominator_keys), dtype=np.int64)
+        remap[used] = np.arange(len(used))
+        denominator_indices = self.counts.denominator_indices.copy()
+        denominator_indices[:, 2] = remap[denominator_indices[:, 2]]
+        keys = [self.counts.denominator_keys[i] for i in used]
+        np.savez_compressed(
+            path,
+            symbols=np.array(self.dist_fam.symbols(), dtype=np.str_),
+            num_programs=self.num_programs,
+            numerator_indices=self.counts.numerator_indices,
+            numerator_values=self.counts.numerator_values,
+            denominator_indices=denominator_indices,
+            denominator_values=self.counts.denominator_values,
+            key_offsets=np.cumsum([0] + [len(key) for key in keys]),
+            key_symbols=np.array([x for key in keys for x in key], dtype=np.int64),
+        )
+
+    @classmethod
+    def load(
+        cls, dist_fam: "BigramProgramDistributionFamily", path: str
+    ) -> "BigramCountStore":
+        """
+        Load a store saved with `save`. The family must have the same symbols
+            as the one the store was saved with.
+        """
+        with np.load(path) as saved:
+            data = {k: np.asarray(v) for k, v in saved.items()}
+        if list(data["symbols"]) != list(dist_fam.symbols()):
+            raise ValueError(
+                "The saved counts are over different symbols than the family"
+            )
+        offsets, key_symbols = list(data["key_offsets"]), list(data["key_symbols"])
+        counts = BigramProgramCounts(
+            numerator_indices=data["numerator_indices"],
+            numerator_values=data["numerator_values"],
+            denominator_indices=data["denominator_indices"],
+            denominator_values=data["denominator_values"],
+            denominator_keys=[
+                tuple(int(x) for x in key_symbols[start:end])
+                for start, end in zip(offsets[:-1], offsets[1:])
+            ],
+        )
+        return cls(dist_fam, counts, int(data["num_programs"]))
+
+
 class BigramProgramDistributionFamily(TreeProgramDistributionFamily):
     def __init__(
         self,
@@ -186,7 +645,14 @@ class BigramProgramDistributionFamily(TreeProgramDistributionFamily):
         ] = (),
         include_type_preorder_mask: bool = True,
         node_ordering=DefaultNodeOrdering,
+        packed_parameters: bool = False,
     ):
+        """
+        If packed_parameters is True, the parameters are a flat vector with one entry
+            per valid (parent_sym, parent_child_idx, child_sym) triple, in the order
+            given by `valid_indices`, rather than a dense [symbols, arity, symbols]
+            array that is mostly invalid.
+        """
         if valid_root_types is not None:
             dsl = dsl.with_valid_root_types(valid_root_types)
         self._dsl = dsl
@@ -196,16 +662,105 @@ class BigramProgramDistributionFamily(TreeProgramDistributionFamily):
         self._additional_preorder_masks = additional_preorder_masks
         self._include_type_preorder_mask = include_type_preorder_mask
         self._node_ordering = node_ordering
+        self._tree_symbols = list(zip(self._symbols, self._arities))
+        self._packed_parameters = packed_parameters
+        self.valid_indices = np.argwhere(self._valid_mask)
+        # map from (parent_sym, parent_child_idx, child_sym) to packed index, or -1
+        self._packed_index = np.full(self._valid_mask.shape, -1, dtype=np.int64)
+        self._packed_index[self._valid_mask] = np.arange(len(self.valid_indices))
+        # the context of each packed entry, as an index into the unique contexts
+        _, first_entry, self._packed_context = np.unique(
+            self.valid_indices[:, 0] * self._max_arity + self.valid_indices[:, 1],
+            return_index=True,
+            return_inverse=True,
+        )
+        self._packed_contexts = [
+            ((parent, position),)
+            for parent, position in self.valid_indices[first_entry, :2].tolist()
+        ]
 
     def underlying_dsl(self) -> DSL:
         return self._dsl
 
     def parameters_shape(self) -> List[int]:
+        if self._packed_parameters:
+            return (len(self.valid_indices),)
         return self._valid_mask.shape
 
+    def pack_parameters(self, parameters: torch.Tensor) -> torch.Tensor:
+        """
+        Convert dense [batch, symbols, arity, symbols] parameters to packed form.
+        """
+        parent_sym, parent_child_idx, child_sym = self.valid_indices.T
+        return parameters[:, parent_sym, parent_child_idx, child_sym]
+
+    def unpack_parameters(
+        self, parameters: torch.Tensor, fill_value=-float("inf")
+    ) -> torch.Tensor:
+        """
+        Convert packed parameters to dense form, with invalid entries set to fill_value.
+        """
+        result = torch.full(
+            (parameters.shape[0], *self._valid_mask.shape),
+            fill_value,
+            dtype=parameters.dtype,
+            device=parameters.device,
+        )
+        parent_sym, parent_child_idx, child_sym = self.valid_indices.T
+        result[:, parent_sym, parent_child_idx, child_sym] = parameters
+        return result
+
+    def unpack_distribution(self, values: np.ndarray) -> np.ndarray:
+        """
+        Convert packed probabilities to a dense [symbols, arity, symbols] array,
+            with invalid entries set to 0.
+        """
+        result = np.zeros(self._valid_mask.shape, dtype=values.dtype)
+        result[tuple(self.valid_indices.T)] = values
+        return result
+
+    def packed_context_sums(self, values: np.ndarray) -> np.ndarray:
+        """
+        For each packed entry, the sum of the values of all entries in its context.
+        """
+        sums = segment_sum(values, self._packed_context, len(self._packed_contexts))
+        return sums[self._packed_context]
+
+    def embed_packed_values(
+        self, other: "BigramProgramDistributionFamily", values: np.ndarray
+    ) -> Union[Tuple[np.ndarray, np.ndarray], NoneType]:
+        """
+        Map packed values of a family whose symbols are a subset of this one's onto
+            this family's packed entries.
+
+        Returns (values, within), where within marks the entries whose parent is a
+            symbol of the other family, or None if some nonzero value has no
+            corresponding valid entry in this family.
+        """
+        symbol_map = np.array([self._symbol_to_idx[sym] for sym in other.symbols()])
+        parent, position, child = other.valid_indices.T
+        target = np.full(len(values), -1)
+        in_range = position < self._max_arity
+        target[in_range] = self._packed_index[
+            symbol_map[parent[in_range]],
+            position[in_range],
+            symbol_map[child[in_range]],
+        ]
+        if (values[target == -1] > 0).any():
+            return None
+        result = np.zeros(len(self.valid_indices), dtype=values.dtype)
+        result[target[target != -1]] = values[target != -1]
+        is_other_symbol = np.zeros(len(self._symbols), dtype=np.bool_)
+        is_other_symbol[symbol_map] = True
+        return result, is_other_symbol[self.valid_indices[:, 0]]
+
     def normalize_parameters(
         self, parameters: torch.Tensor, *, logits: bool, neg_inf=-float("inf")
     ) -> torch.Tensor:
+        if self._packed_parameters:
+            # no invalid entries to set to neg_inf; parameter_difference_loss
+            # takes it instead
+            return self._normalize_packed_parameters(parameters, logits=logits)
         parameters = parameters.clone()
         mask = torch.tensor(self._valid_mask, device=parameters.device)[None].repeat(
             parameters.shape[0], 1, 1, 1
@@ -219,6 +774,26 @@ class BigramProgramDistributionFamily(TreeProgramDistributionFamily):
             parameters[~mask] = 0
         return parameters
 
+    def _normalize_packed_parameters(
+        self, parameters: torch.Tensor, *, logits: bool
+    ) -> torch.Tensor:
+        """
+        Softmax (or log-softmax) of packed parameters, within each context.
+        """
+        context = torch.tensor(self._packed_context, device=parameters.device)
+        context = context[None].expand(parameters.shape[0], -1)
+        num_contexts = int(self._packed_context.max()) + 1
+        maxes = torch.full(
+            (parameters.shape[0], num_contexts),
+            -float("inf"),
+            dtype=parameters.dtype,
+            device=parameters.device,
+        ).scatter_reduce(1, context, parameters, reduce="amax")
+        shifted = parameters - maxes.gather(1, context).detach()
+        totals = torch.zeros_like(maxes).scatter_add(1, context, shifted.exp())
+        log_probs = shifted - totals.log().gather(1, context)
+        return log_probs if logits else log_probs.exp()
+
     def with_parameters(
         self, parameters: torch.Tensor
     ) -> BigramProgramDistributionBatch:
@@ -226,25 +801,75 @@ class BigramProgramDistributionFamily(TreeProgramDistributionFamily):
             parameters.shape[1:] == self.parameters_shape()
         ), f"Expected {self.parameters_shape()}, got {parameters.shape[1:]}"
         parameters = self.normalize_parameters(parameters, logits=False)
+        if self._packed_parameters:
+            parameters = self.unpack_parameters(parameters, fill_value=0)
         return BigramProgramDistributionBatch(self, parameters.detach().cpu().numpy())
 
-    def count_programs(self, data: List[List[SExpression]]) -> BigramProgramCountsBatch:
+    def count_programs(
+        self, data: List[List[SExpression]], *, n_workers: Union[int, NoneType] = None
+    ) -> BigramProgramCountsBatch:
+        """
+        Count the productions in each list of programs.
+
+        If n_workers is provided, the programs are split into shards that are
+            counted in a pool of that many processes, and the resulting counts
+            are merged. The tree distribution skeleton is sent to each worker once,
+            through a `fork_pool`.
+        """
         tree_dist = self.tree_distribution_skeleton
-        all_counts = []
-        for programs in data:
-            numerators, denominators = count_programs(tree_dist, programs)
-            all_counts.append(
-                BigramProgramCounts(numerators=numerators, denominators=denominators)
+        if n_workers is None:
+            return BigramProgramCountsBatch(
+                self, [count_programs(tree_dist, programs) for programs in data]
             )
-        return BigramProgramCountsBatch(self, all_counts)
+        shards, shard_owners = [], []
+        for i, programs in enumerate(data):
+            shard_size = max(1, -(-len(programs) // n_workers))
+            for start in range(0, len(programs), shard_size):
+                shards.append(programs[start : start + shard_size])
+                shard_owners.append(i)
+        with fork_pool(n_workers, tree_dist) as pool:
+            shard_counts = pool.map(_count_programs_in_worker, shards)
+        all_counts = [[] for _ in data]
+        for i, counts in zip(shard_owners, shard_counts):
+            all_counts[i].append(counts)
+        return BigramProgramCountsBatch(
+            self, [BigramProgramCounts.merge(counts) for counts in all_counts]
+        )
+
+    def fit_distribution(
+        self,
+        data: Union[List[List[SExpression]], List[SExpression], BigramCountStore],
+    ) -> Union[BigramProgramDistributionBatch, BigramProgramDistribution]:
+        """
+        Fits a distribution to the data, which can also be a `BigramCountStore`,
+            in which case a single distribution is fit to its counts.
+        """
+        if isinstance(data, BigramCountStore):
+            counts = BigramProgramCountsBatch(self, [data.counts])
+            return self.counts_to_distribution(counts)[0]
+        return super().fit_distribution(data)
 
     def counts_to_distribution(
         self, counts: BigramProgramCountsBatch
     ) -> BigramProgramDistribution:
         return counts.to_distribution(len(self._symbols), self._max_arity)
 
+    def counts_to_mle_distribution(
+        self, counts: BigramProgramCountsBatch, **kwargs
+    ) -> BigramProgramDistributionBatch:
+        """
+        Converts the counts to the maximum likelihood distribution, taking the
+            preorder masks into account. See `masked_softmax_mle` for the arguments.
+        """
+        return counts.to_mle_distribution(len(self._symbols), self._max_arity, **kwargs)
+
     def parameter_difference_loss(
-        self, parameters: torch.tensor, actual: BigramProgramCountsBatch
+        self,
+        parameters: torch.tensor,
+        actual: BigramProgramCountsBatch,
+        *,
+        chunk_size: int = DEFAULT_DENOMINATOR_CHUNK_SIZE,
+        neg_inf=-float("inf"),
     ) -> torch.float32:
         """
         Let
@@ -309,34 +934,102 @@ class BigramProgramDistributionFamily(TreeProgramDistributionFamily):
             = sum_g sum_d dencount_{g, d} agg_theta_by_denom(g, d)
             = (dencount * agg_theta_by_denom).sum()
 
+        Both sums are computed from the sparse (COO) counts, so only the nonzero
+            entries of numcount and dencount are ever touched.
+
+        With packed parameters, theta_{g, s} is the packed entry for (g, s), and
+            symbols s' in d that are not valid in context g are treated as having
+            theta_{g, s'} = neg_inf. This matches the dense parameters produced by
+            `normalize_parameters` with the same neg_inf, which packed parameters
+            have no invalid entries to hold.
+
+        We never materialize theta_by_denom, which would be of size
+            [batch, symbols, arity, symbols, keys]. Instead, we only compute
+            agg_theta_by_denom(g, d) for the (g, d) pairs where dencount is nonzero,
+            by gathering theta_{g, s'} for s' in d. This is done one key d at a time,
+            and in chunks of at most `chunk_size` gathered elements, so memory scales
+            with the number of nonzero (g, d) counts times the size of d.
         """
 
         assert parameters.shape[1:] == self.parameters_shape()
-        assert len(parameters.shape) == 4
+        assert len(parameters.shape) == 1 + len(self.parameters_shape())
 
-        numcount = actual.numerators(len(self._symbols), self._max_arity)
-        dencount, den_keys = actual.denominators(len(self._symbols), self._max_arity)
-        numcount, dencount = [
-            torch.tensor(x, device=parameters.device, dtype=torch.float32)
-            for x in (numcount, dencount)
-        ]
+        batch_size = max(parameters.shape[0], len(actual.counts))
+        packed_index = None
+        if self._packed_parameters:
+            packed_index = torch.tensor(self._packed_index, device=parameters.device)
 
-        def agg_across_all_but_batch_axis(x, fn):
-            x = x.reshape(x.shape[0], -1)
-            return fn(x, -1)
+        num_indices, num_values = broadcast_entries(
+            *actual.numerator_entries(), len(actual.counts), batch_size
+        )
+        numer = numerator_sum(
+            parameters,
+            batch_size,
+            num_indices,
+            num_values,
+            packed_index=packed_index,
+            neg_inf=neg_inf,
+        )
 
-        numer = agg_across_all_but_batch_axis(numcount * parameters, torch.sum)
+        den_indices, den_values, den_keys = actual.denominator_entries()
+        den_indices, den_values = broadcast_entries(
+            den_indices, den_values, len(actual.counts), batch_size
+        )
+        denom = denominator_logsumexp(
+            parameters,
+            batch_size,
+            den_indices,
+            den_values,
+            den_keys,
+            chunk_size=chunk_size,
+            packed_index=packed_index,
+            neg_inf=neg_inf,
+        )
+        return -(numer - denom)
 
-        theta_by_denom = parameters[..., None].repeat(1, 1, 1, 1, len(den_keys))
-        for i, key in enumerate(den_keys):
-            mask = torch.ones(
-                len(self._symbols), dtype=torch.bool, device=parameters.device
+    def compute_likelihood_matrix(
+        self,
+        distribution: BigramProgramDistributionBatch,
+        programs: List[SExpression],
+    ) -> np.ndarray:
+        """
+        Compute the log-likelihood of each program under each distribution in the batch.
+            Equivalent to calling `compute_likelihood` on each pair, but the productions
+            and allowed symbols of each program are only computed once, and the
+            likelihoods are then computed for the whole batch with array operations.
+
+        Returns an array of shape (len(programs), len(distribution)).
+        """
+        tree_dist = self.tree_distribution_skeleton
+        accumulators = [BigramCountAccumulator() for _ in programs]
+        accumulate_programs(tree_dist, programs, accumulators)
+        counts = BigramProgramCountsBatch(self, [a.finish() for a in accumulators])
+        dist_vals = distribution.distribution_batch
+        num_indices, num_values = counts.numerator_entries()
+        den_indices, den_values, keys = counts.denominator_entries()
+        with np.errstate(divide="ignore"):
+            # [M, N]
+            numerator = segment_sum(
+                num_values
+                * np.log(
+                    dist_vals[
+                        :, num_indices[:, 1], num_indices[:, 2], num_indices[:, 3]
+                    ]
+                ),
+                num_indices[:, 0],
+                len(programs),
             )
-            mask[list(key)] = False
-            theta_by_denom[..., mask, i] = -float("inf")
-        agg_theta_by_denom = torch.logsumexp(theta_by_denom, dim=-2)
-        denom = agg_across_all_but_batch_axis(dencount * agg_theta_by_denom, torch.sum)
-        return -(numer - denom)
+            denominator = segment_sum(
+                den_values
+                * np.log(denominator_mass(dist_vals, den_indices[:, 1:], keys)),
+                den_indices[:, 0],
+                len(programs),
+            )
+        result = (numerator - denominator).T
+        # a context with no mass means the program has a production of probability 0
+        result[np.isinf(denominator.T) | np.isnan(result)] = -np.inf
+        result[[a.num_disallowed > 0 for a in accumulators]] = -np.inf
+        return result
 
     def uniform(self):
         return BigramProgramDistribution(
@@ -346,6 +1039,17 @@ class BigramProgramDistributionFamily(TreeProgramDistributionFamily):
     def compute_tree_distribution(
         self, distribution: Union[BigramProgramDistribution, NoneType]
     ) -> TreeDistribution:
+        if isinstance(distribution, LazyBigramProgramDistribution):
+            values = distribution.packed_values()
+            if values is None:
+                return self.compute_tree_distribution(distribution.to_distribution())
+            keep = values > 0
+            return self._tree_distribution_from_entries(
+                self._packed_contexts,
+                self._packed_context[keep],
+                self.valid_indices[keep, 2],
+                np.log(values[keep]),
+            )
         if isinstance(distribution, BigramProgramDistribution):
             assert isinstance(distribution, BigramProgramDistribution), type(
                 distribution
@@ -355,17 +1059,83 @@ class BigramProgramDistributionFamily(TreeProgramDistributionFamily):
             assert distribution is None
             dist_vals = self._valid_mask
 
-        dist = defaultdict(list)
-        for parent, position, child in zip(*np.where(dist_vals > 0)):
-            dist[(parent, position),].append(
-                (child, np.log(dist_vals[parent, position, child]))
+        parent, position, child = np.where(dist_vals > 0)
+        unique_contexts, context_ids = np.unique(
+            parent * self._max_arity + position, return_inverse=True
+        )
+        return self._tree_distribution_from_entries(
+            [
+                ((int(c // self._max_arity), int(c % self._max_arity)),)
+                for c in unique_contexts
+            ],
+            context_ids.reshape(-1),
+            child,
+            np.log(dist_vals[parent, position, child]),
+        )
+
+    def tree_distribution_batch(
+        self, distribution: BigramProgramDistributionBatch
+    ) -> List[TreeDistribution]:
+        """
+        Equivalent to computing the tree distribution of each element of the batch,
+            but the structure (the contexts and their possible productions) is taken
+            from the skeleton once, and the log probabilities of all elements are
+            gathered in one step. Each element's distribution shares the skeleton's
+            arrays and only holds its own row of log probabilities, so productions
+            are in the skeleton's order rather than by decreasing likelihood, and
+            those with probability zero are kept, with a log probability of -inf.
+
+        Elements that have nonzero probability outside of the skeleton's support
+            are computed individually.
+        """
+        skeleton = self.tree_distribution_skeleton.csr
+        context_ids = np.repeat(
+            np.arange(len(skeleton.contexts)), np.diff(skeleton.offsets)
+        )
+        [parent, position] = (
+            np.array([context for [context] in skeleton.contexts], dtype=np.int64)
+            .reshape(-1, 2)
+            .T
+        )
+        parent, position = parent[context_ids], position[context_ids]
+        dist_vals = distribution.distribution_batch
+        values = dist_vals[:, parent, position, skeleton.symbol_ids]
+        within_support = (values > 0).sum(1) == (dist_vals > 0).sum((1, 2, 3))
+        with np.errstate(divide="ignore"):
+            log_probs = np.log(values).astype(np.float64)
+        return [
+            (
+                TreeDistribution(
+                    1,
+                    skeleton.with_log_probs(log_probs[i]),
+                    self._tree_symbols,
+                    self.compute_preorder_mask,
+                    self._node_ordering,
+                )
+                if within_support[i]
+                else self.compute_tree_distribution(distribution[i])
             )
-        dist = {k: sorted(v, key=lambda x: -x[1]) for k, v in dist.items()}
+            for i in range(len(values))
+        ]
 
+    def _tree_distribution_from_entries(
+        self,
+        contexts: List[Tuple[Tuple[int, int], ...]],
+        context_ids: np.ndarray,
+        symbol_ids: np.ndarray,
+        log_probs: np.ndarray,
+    ) -> TreeDistribution:
+        """
+        Produce a tree distribution from the given entries. See
+            `CSRDistribution.from_entries`.
+        """
+        dist = CSRDistribution.from_entries(
+            contexts, context_ids, symbol_ids, log_probs
+        )
         return TreeDistribution(
             1,
             dist,
-            list(zip(self._symbols, self._arities)),
+            self._tree_symbols,
             self.compute_preorder_mask,
             self._node_ordering,
         )
@@ -385,6 +1155,22 @@ class BigramProgramDistributionFamily(TreeProgramDistributionFamily):
         return self._symbols
 
 
+def incompatible_symbols_error(symbols_this, symbols_other) -> ValueError:
+    """
+    Error for mixing distributions where neither has a superset of the symbols
+        of the other.
+    """
+    extra_this = set(symbols_this) - set(symbols_other)
+    extra_other = set(symbols_other) - set(symbols_this)
+    extra_this, extra_other = (
+        ", ".join(repr(x) for x in sorted(extra)) for extra in (extra_this, extra_other)
+    )
+    return ValueError(
+        "DSL not compatible, extra symbols in this: "
+        f"{extra_this}, extra symbols in other: {extra_other}"
+    )
+
+
 def bigram_mask(dsl):
     symbols = dsl.ordered_symbols(include_root=True)
 
@@ -425,45 +1211,397 @@ def counts_to_probabilities(counts):
     )
 
 
-def count_programs(tree_dist: TreeDistribution, programs: List[SExpression]):
+def masked_softmax_mle(
+    numerators: np.ndarray,
+    den_indices: np.ndarray,
+    den_values: np.ndarray,
+    keys: List[Tuple[int, ...]],
+    *,
+    max_iterations: int = 100,
+    tolerance: float = 1e-7,
+) -> np.ndarray:
+    """
+    Computes the distribution that maximizes the likelihood of the counts, where
+        each production is chosen among only the symbols in its denominator key, i.e.,
+        maximizes
+
+        sum_{g, s} numcount_{g, s} log p_{g, s}
+            - sum_{g, d} dencount_{g, d} log sum_{s' in d} p_{g, s'}
+
+    (see `parameter_difference_loss`). This uses the minorize-maximize algorithm
+        (Hunter, 2004), where each iteration sets
+
+        p_{g, s} proportional to numcount_{g, s}
+            / sum_{d containing s} dencount_{g, d} / sum_{s' in d} p_{g, s'}
+
+    which increases the likelihood monotonically. The iterations are accelerated
+        with SQUAREM extrapolation. If every key contains all the symbols, this
+        converges in a single iteration to `counts_to_probabilities`.
+
+    Args:
+        numerators: The [batch, symbols, arity, symbols] numerator counts.
+        den_indices: [N, 4] array of (batch_idx, parent_sym, parent_child_idx, key_idx).
+        den_values: [N] array of denominator counts.
+        keys: The denominator keys, as tuples of symbols.
+        max_iterations: The maximum number of iterations to run.
+        tolerance: Stop once no probability changes by more than this.
+
+    Returns the [batch, symbols, arity, symbols] probabilities.
+    """
+    numerators = numerators.astype(np.float64)
+    key_lengths = np.array([len(key) for key in keys], dtype=np.int64)
+    flat_keys = np.array([x for key in keys for x in key], dtype=np.int64)
+    key_offsets = np.concatenate([[0], np.cumsum(key_lengths)])
+    # one element for each (denominator entry, symbol in its key) pair
+    lengths = key_lengths[den_indices[:, 3]]
+    entry_of = np.repeat(np.arange(len(den_indices)), lengths)
+    within = np.arange(len(entry_of)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    symbol = flat_keys[key_offsets[den_indices[entry_of, 3]] + within]
+    flat = np.ravel_multi_index(
+        (*den_indices[entry_of, :3].T, symbol), numerators.shape
+    )
+
+    support = numerators > 0
+
+    def update(probabilities):
+        totals = np.bincount(
+            entry_of, weights=probabilities.flat[flat], minlength=len(den_indices)
+        )
+        contribution = np.divide(
+            den_values, totals, out=np.zeros_like(totals), where=totals > 0
+        )
+        denominators = np.bincount(
+            flat, weights=contribution[entry_of], minlength=numerators.size
+        ).reshape(numerators.shape)
+        return normalize_last_axis(
+            np.divide(
+                numerators, denominators, out=numerators.copy(), where=denominators > 0
+            )
+        )
+
+    def log_likelihood(probabilities):
+        totals = np.bincount(
+            entry_of, weights=probabilities.flat[flat], minlength=len(den_indices)
+        )
+        return (numerators[support] * np.log(probabilities[support])).sum() - (
+            den_values[totals > 0] * np.log(totals[totals > 0])
+        ).sum()
+
+    # Each iteration is accelerated with SQUAREM (Varadhan and Roland, 2008), in
+    # log space on the support, falling back to two plain updates if the
+    # extrapolated step does not improve on them.
+    probabilities = normalize_last_axis(numerators)
+    for _ in range(max_iterations):
+        once = update(probabilities)
+        twice = update(once)
+        log_0, log_1, log_2 = [np.log(x[support]) for x in (probabilities, once, twice)]
+        r, v = log_1 - log_0, log_2 - 2 * log_1 + log_0
+        alpha = -np.sqrt((r**2).sum() / (v**2).sum()) if (v**2).sum() > 0 else -1
+        alpha = min(alpha, -1)
+        extrapolated = np.zeros_like(numerators)
+        extrapolated[support] = np.exp(log_0 - 2 * alpha * r + alpha**2 * v)
+        extrapolated = update(normalize_last_axis(extrapolated))
+        if not log_likelihood(extrapolated) >= log_likelihood(twice):
+            extrapolated = twice
+        delta = np.abs(extrapolated - probabilities).max(initial=0)
+        probabilities = extrapolated
+        if delta < tolerance:
+            break
+    return probabilities.astype(np.float32)
+
+
+def normalize_last_axis(values: np.ndarray) -> np.ndarray:
+    """
+    Normalize the values to sum to 1 along the last axis, leaving all-zero rows as is.
+    """
+    totals = values.sum(-1, keepdims=True)
+    return np.divide(values, totals, out=np.zeros_like(values), where=totals != 0)
+
+
+def broadcast_entries(
+    indices: np.ndarray, values: np.ndarray, num_counts: int, batch_size: int
+):
+    """
+    Broadcast COO entries (whose first index column is the batch index) from
+        num_counts count sets to batch_size. If num_counts is 1, the entries are
+        repeated for each batch element, otherwise num_counts must be batch_size.
+    """
+    if num_counts == batch_size:
+        return indices, values
+    assert num_counts == 1, f"Cannot broadcast {num_counts} counts to {batch_size}"
+    num_entries = len(indices)
+    indices = np.tile(indices, (batch_size, 1))
+    indices[:, 0] = np.repeat(np.arange(batch_size), num_entries)
+    return indices, np.tile(values, batch_size)
+
+
+def gather_parameters(parameters: torch.Tensor, indices: np.ndarray) -> List:
+    """
+    Convert the (batch_idx, parent_sym, parent_child_idx) columns of the indices into
+        tensors that index into the parameters. The batch index is broadcast if the
+        parameters have a batch axis of 1.
+    """
+    batch_idx, parent_sym, parent_child_idx = [
+        torch.tensor(x, dtype=torch.long, device=parameters.device)
+        for x in indices[:, :3].T
+    ]
+    param_idx = batch_idx if parameters.shape[0] > 1 else torch.zeros_like(batch_idx)
+    return batch_idx, param_idx, parent_sym, parent_child_idx
+
+
+def lookup_parameters(
+    parameters: torch.Tensor,
+    param_idx: torch.Tensor,
+    parent_sym: torch.Tensor,
+    parent_child_idx: torch.Tensor,
+    child_sym: torch.Tensor,
+    packed_index: Union[torch.Tensor, NoneType],
+    neg_inf=-float("inf"),
+) -> torch.Tensor:
+    """
+    Index into the parameters, which are dense unless packed_index is provided, in
+        which case it maps dense indices into the packed parameters. Entries that
+        are not present in the packed parameters are neg_inf.
+    """
+    if packed_index is None:
+        return parameters[param_idx, parent_sym, parent_child_idx, child_sym]
+    flat_idx = packed_index[parent_sym, parent_child_idx, child_sym]
+    theta = parameters[param_idx, flat_idx.clamp(min=0)]
+    return theta.masked_fill(flat_idx < 0, neg_inf)
+
+
+def numerator_sum(
+    parameters: torch.Tensor,
+    batch_size: int,
+    indices: np.ndarray,
+    values: np.ndarray,
+    *,
+    packed_index: Union[torch.Tensor, NoneType] = None,
+    neg_inf=-float("inf"),
+) -> torch.Tensor:
+    """
+    Computes, for each batch element b,
+        sum_{(b, g, s)} count_{b, g, s} * parameters[b, g, s]
+
+    Args:
+        parameters: The [batch, symbols, arity, symbols] parameters, or packed
+            [batch, num_valid] parameters if packed_index is provided.
+        batch_size: The size of the output.
+        indices: [N, 4] array of (batch_idx, parent_sym, parent_child_idx, child_sym).
+        values: [N] array of counts.
+        packed_index, neg_inf: See `lookup_parameters`.
+
+    Returns a tensor of shape [batch_size].
+    """
+    batch_idx, param_idx, parent_sym, parent_child_idx = gather_parameters(
+        parameters, indices
+    )
+    child_sym = torch.tensor(indices[:, 3], dtype=torch.long, device=parameters.device)
+    theta = lookup_parameters(
+        parameters,
+        param_idx,
+        parent_sym,
+        parent_child_idx,
+        child_sym,
+        packed_index,
+        neg_inf,
+    )
+    counts = torch.tensor(values, dtype=parameters.dtype, device=parameters.device)
+    result = torch.zeros(batch_size, dtype=parameters.dtype, device=parameters.device)
+    return result.index_add(0, batch_idx, counts * theta)
+
+
+def denominator_logsumexp(
+    parameters: torch.Tensor,
+    batch_size: int,
+    indices: np.ndarray,
+    values: np.ndarray,
+    keys: List[Tuple[int, ...]],
+    *,
+    chunk_size: int = DEFAULT_DENOMINATOR_CHUNK_SIZE,
+    packed_index: Union[torch.Tensor, NoneType] = None,
+    neg_inf=-float("inf"),
+) -> torch.Tensor:
+    """
+    Computes, for each batch element b,
+        sum_{(b, g, d)} count_{b, g, d} * logsumexp_{s in d} parameters[b, g, s]
+
+    Args:
+        parameters: The [batch, symbols, arity, symbols] parameters, or packed
+            [batch, num_valid] parameters if packed_index is provided.
+        batch_size: The size of the output.
+        indices: [N, 4] array of (batch_idx, parent_sym, parent_child_idx, key_idx).
+        values: [N] array of counts.
+        keys: The denominator keys, as tuples of symbols.
+        chunk_size: Maximum number of parameter elements to gather at once.
+        packed_index, neg_inf: See `lookup_parameters`.
+
+    Returns a tensor of shape [batch_size].
+    """
+    result = torch.zeros(batch_size, dtype=parameters.dtype, device=parameters.device)
+    order = np.argsort(indices[:, 3], kind="stable")
+    indices, values = indices[order], values[order]
+    boundaries = np.searchsorted(indices[:, 3], np.arange(len(keys) + 1))
+    for key_idx, key in enumerate(keys):
+        start, end = boundaries[key_idx], boundaries[key_idx + 1]
+        key = torch.tensor(key, dtype=torch.long, device=parameters.device)
+        per_chunk = max(1, chunk_size // max(1, len(key)))
+        for chunk_start in range(start, end, per_chunk):
+            chunk = slice(chunk_start, min(end, chunk_start + per_chunk))
+            batch_idx, param_idx, parent_sym, parent_child_idx = gather_parameters(
+                parameters, indices[chunk]
+            )
+            theta = lookup_parameters(
+                parameters,
+                param_idx[:, None],
+                parent_sym[:, None],
+                parent_child_idx[:, None],
+                key,
+                packed_index,
+                neg_inf,
+            )
+            counts = torch.tensor(
+                values[chunk], dtype=parameters.dtype, device=parameters.device
+            )
+            result = result.index_add(
+                0, batch_idx, counts * torch.logsumexp(theta, dim=-1)
+            )
+    return result
+
+
+def denominator_mass(
+    dist_vals: np.ndarray, indices: np.ndarray, keys: List[Tuple[int, ...]]
+) -> np.ndarray:
+    """
+    Compute the total probability of the allowed symbols for each
+        (parent_sym, parent_child_idx, key_idx) row of indices, under each
+        distribution in dist_vals, which is of shape [M, symbols, arity, symbols].
+
+    Returns an array of shape [M, len(indices)].
+    """
+    result = np.zeros((dist_vals.shape[0], len(indices)), dtype=dist_vals.dtype)
+    order = np.argsort(indices[:, 2], kind="stable")
+    key_idxs, starts = np.unique(indices[order, 2], return_index=True)
+    for key_idx, rows in zip(key_idxs, np.split(order, starts[1:])):
+        key = np.array(keys[key_idx], dtype=np.int64)
+        parent_sym, position = indices[rows, 0], indices[rows, 1]
+        result[:, rows] = dist_vals[:, parent_sym[:, None], position[:, None], key].sum(
+            -1
+        )
+    return result
+
+
+def segment_sum(values: np.ndarray, segment_ids: np.ndarray, num_segments: int):
+    """
+    Sum the values along the last axis into the given segments.
+    """
+    result = np.zeros((*values.shape[:-1], num_segments), dtype=values.dtype)
+    np.add.at(result.T, segment_ids, values.T)
+    return result
+
+
+def aggregate_coo(indices: List[Tuple[int, ...]], values: List[int]):
+    """
+    Sum together the values of duplicate rows in a COO representation, dropping
+        any rows whose total is zero.
+
+    Returns (indices, values) as an [N, k] array of unique rows and an [N] array.
+    """
+    if len(values) == 0:
+        return np.zeros((0, 3), dtype=np.int64), np.zeros(0, dtype=np.int64)
+    indices = np.array(indices, dtype=np.int64).reshape(len(values), -1)
+    indices, inverse = np.unique(indices, axis=0, return_inverse=True)
+    values = np.bincount(
+        inverse.reshape(-1), weights=np.array(values), minlength=indices.shape[0]
+    ).astype(np.int64)
+    nonzero = values != 0
+    return indices[nonzero], values[nonzero]
+
+
+def with_batch_index(indices: List[np.ndarray], values: List[np.ndarray]):
+    """
+    Concatenates several COO representations, prepending a batch index column.
+    """
+    batch_idx = np.repeat(np.arange(len(indices)), [len(x) for x in indices])
+    if not indices:
+        return np.zeros((0, 4), dtype=np.int64), np.zeros(0, dtype=np.int64)
+    indices = np.concatenate([batch_idx[:, None], np.concatenate(indices)], axis=1)
+    return indices, np.concatenate(values)
+
+
+def count_programs(
+    tree_dist: TreeDistribution, programs: List[SExpression]
+) -> BigramProgramCounts:
     """
     Count the productions in the programs, indexed by the path to the node.
     """
-    numerators = defaultdict(lambda: defaultdict(int))
-    denominators = defaultdict(lambda: defaultdict(int))
-    for program in programs:
+    accumulator = BigramCountAccumulator()
+    accumulate_programs(tree_dist, programs, [accumulator] * len(programs))
+    return accumulator.finish()
+
+
+def accumulate_programs(
+    tree_dist: TreeDistribution,
+    programs: List[SExpression],
+    accumulators: List[BigramCountAccumulator],
+):
+    """
+    Accumulate the counts of each program into the corresponding accumulator.
+        The allowed symbols are memoized across all the programs, if possible.
+    """
+    mask_cache = None
+    for program, accumulator in zip(programs, accumulators):
         preorder_mask = tree_dist.mask_constructor(tree_dist)
+        if mask_cache is None and preorder_mask.can_cache:
+            mask_cache = {}
         preorder_mask.on_entry(0, 0)
         accumulate_counts(
             tree_dist,
             program,
-            numerators,
-            denominators,
+            accumulator,
             ((0, 0),),
             preorder_mask=preorder_mask,
+            mask_cache=mask_cache,
         )
-    numerators = {k: dict(v) for k, v in numerators.items()}
-    denominators = {k: dict(v) for k, v in denominators.items()}
-    return numerators, denominators
+
+
+def _count_programs_in_worker(programs: List[SExpression]) -> BigramProgramCounts:
+    return count_programs(worker_state(), programs)
 
 
 def accumulate_counts(
     tree_dist: TreeDistribution,
     program: SExpression,
-    numerators: Dict[Tuple[Tuple[int, int], ...], Dict[int, int]],
-    denominators: Dict[Tuple[Tuple[int, int], ...], Dict[Tuple[int, ...], int]],
+    accumulator: BigramCountAccumulator,
     ancestors: Tuple[Tuple[int, int], ...],
     preorder_mask: PreorderMask,
+    mask_cache: Union[Dict[Any, Tuple[int, ...]], NoneType] = None,
 ):
-    parent_position = ancestors[-1][1]
+    """
+    Accumulate the counts of the productions in the program.
+
+    If mask_cache is provided, the allowed symbols at each node are memoized
+        in it, keyed by the mask's cache key and the ancestors. This should
+        only be used with masks that can cache, and only for a single tree_dist.
+    """
+    parent_sym, parent_position = ancestors[-1]
     this_idx = tree_dist.symbol_to_index[program.symbol]
-    numerators[ancestors][this_idx] += 1
-    possibilities = np.arange(len(tree_dist.symbols))
-    mask = preorder_mask.compute_mask(parent_position, possibilities)
+    accumulator.add_numerator(parent_sym, parent_position, this_idx)
+    key = None
+    if mask_cache is not None:
+        key = preorder_mask.cache_key(ancestors), ancestors
+    if key is None or key not in mask_cache:
+        possibilities = np.arange(len(tree_dist.symbols))
+        mask = preorder_mask.compute_mask(parent_position, possibilities)
+        elements = tuple(int(x) for x in possibilities[mask])
+        if key is not None:
+            mask_cache[key] = elements
+    else:
+        elements = mask_cache[key]
+    if this_idx not in elements:
+        accumulator.num_disallowed += 1
     preorder_mask.on_entry(parent_position, this_idx)
-    elements = possibilities[mask]
-    elements = tuple(int(x) for x in elements)
-    denominators[ancestors][elements] += 1
+    accumulator.add_denominator(parent_sym, parent_position, elements)
     order = tree_dist.ordering.order(this_idx, len(program.children))
     for j, child in zip(order, [program.children[i] for i in order]):
         new_ancestors = ancestors + ((this_idx, j),)
@@ -471,9 +1609,9 @@ def accumulate_counts(
         accumulate_counts(
             tree_dist,
             child,
-            numerators,
-            denominators,
+            accumulator,
             new_ancestors,
             preorder_mask=preorder_mask,
+            mask_cache=mask_cache,
         )
     preorder_mask.on_exit(parent_position, this_idx)
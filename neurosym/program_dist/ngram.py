@@ -0,0 +1,246 @@
+from collections import defaultdict
+from dataclasses import dataclass
+from types import NoneType
+from typing import Callable, Dict, List, Tuple, Union
+
+import numpy as np
+import torch
+
+from neurosym.dsl.dsl import DSL
+from neurosym.program_dist.bigram import BigramProgramDistributionFamily
+from neurosym.program_dist.tree_distribution.ordering import DefaultNodeOrdering
+from neurosym.program_dist.tree_distribution.preorder_mask.preorder_mask import (
+    PreorderMask,
+)
+from neurosym.program_dist.tree_distribution.tree_distribution import (
+    Context,
+    CSRDistribution,
+    TreeDistribution,
+    TreeProgramDistributionFamily,
+)
+from neurosym.programs.s_expression import SExpression
+from neurosym.types.type import Type
+
+
+@dataclass
+class NgramProgramCounts:
+    """
+    Counts of the productions in a set of programs, for every context of length
+        1 through the family's limit.
+    """
+
+    # map from context to map from child_sym to count
+    numerators: Dict[Context, Dict[int, int]]
+
+
+@dataclass
+class NgramProgramCountsBatch:
+    dist_fam: "NgramProgramDistributionFamily"
+    counts: List[NgramProgramCounts]
+
+
+@dataclass
+class NgramProgramDistribution:
+    dist_fam: "NgramProgramDistributionFamily"
+    # map from context to (sorted child_sym array, probability array). Contains every
+    # context of length 1 with valid productions, and every longer context observed.
+    distribution: Dict[Context, Tuple[np.ndarray, np.ndarray]]
+
+
+@dataclass
+class NgramProgramDistributionBatch:
+    dist_fam: "NgramProgramDistributionFamily"
+    distributions: List[NgramProgramDistribution]
+
+    def __getitem__(self, i):
+        return self.distributions[i]
+
+    def __len__(self):
+        return len(self.distributions)
+
+
+class NgramProgramDistributionFamily(TreeProgramDistributionFamily):
+    """
+    Family of distributions where the production at each node depends on its `limit`
+        nearest ancestors, and the position of the path within each of them. With
+        limit=1, the contexts are the same as in `BigramProgramDistributionFamily`.
+
+    Only contexts that were observed are stored. The distribution of each context is
+        Witten-Bell interpolated with that of the context with its most distant
+        ancestor dropped, bottoming out at the uniform distribution over the valid
+        productions. Contexts that were never observed back off to their longest
+        observed suffix.
+
+    This family has no dense parameterization, so the methods that work with
+        parameter tensors are not supported.
+    """
+
+    def __init__(
+        self,
+        dsl: DSL,
+        limit: int = 2,
+        valid_root_types: Union[NoneType, List[Type]] = None,
+        *,
+        additional_preorder_masks: Tuple[
+            Callable[[DSL, TreeDistribution], PreorderMask]
+        ] = (),
+        include_type_preorder_mask: bool = True,
+        node_ordering=DefaultNodeOrdering,
+    ):
+        assert limit >= 1, f"Expected a positive limit, got {limit}"
+        # the bigram family provides the symbols, valid productions, and masks
+        self._bigram_family = BigramProgramDistributionFamily(
+            dsl,
+            valid_root_types,
+            additional_preorder_masks=additional_preorder_masks,
+            include_type_preorder_mask=include_type_preorder_mask,
+            node_ordering=node_ordering,
+        )
+        self._limit = limit
+        self._node_ordering = node_ordering
+        skeleton = self._bigram_family.tree_distribution_skeleton
+        self._tree_symbols = skeleton.symbols
+        self._symbol_to_idx = skeleton.symbol_to_index
+        self._uniform_table = {}
+        for context, (children, _) in skeleton.likelihood_arrays.items():
+            children = np.sort(children)
+            self._uniform_table[context] = (
+                children,
+                np.full(len(children), 1 / len(children)),
+            )
+
+    def underlying_dsl(self) -> DSL:
+        return self._bigram_family.underlying_dsl()
+
+    def parameters_shape(self) -> List[int]:
+        raise NotImplementedError("N-gram distributions have no dense parameters")
+
+    def with_parameters(self, parameters: torch.Tensor):
+        raise NotImplementedError("N-gram distributions have no dense parameters")
+
+    def parameter_difference_loss(self, parameters: torch.tensor, actual):
+        raise NotImplementedError("N-gram distributions have no dense parameters")
+
+    def count_programs(self, data: List[List[SExpression]]) -> NgramProgramCountsBatch:
+        return NgramProgramCountsBatch(
+            self,
+            [
+                count_ngrams(self._symbol_to_idx, self._limit, programs)
+                for programs in data
+            ],
+        )
+
+    def counts_to_distribution(
+        self, counts: NgramProgramCountsBatch
+    ) -> NgramProgramDistributionBatch:
+        return NgramProgramDistributionBatch(
+            self,
+            [
+                NgramProgramDistribution(self, self._interpolate(c.numerators))
+                for c in counts.counts
+            ],
+        )
+
+    def _interpolate(
+        self, numerators: Dict[Context, Dict[int, int]]
+    ) -> Dict[Context, Tuple[np.ndarray, np.ndarray]]:
+        table = dict(self._uniform_table)
+        empty = np.zeros(0, dtype=np.int64), np.zeros(0)
+        # shorter contexts first, so the lower order distribution is always available
+        for context in sorted(numerators, key=len):
+            if len(context) == 1:
+                lower = self._uniform_table.get(context, empty)
+            else:
+                lower = table[context[1:]]
+            table[context] = witten_bell(numerators[context], *lower)
+        return table
+
+    def uniform(self) -> NgramProgramDistribution:
+        return NgramProgramDistribution(self, dict(self._uniform_table))
+
+    def compute_preorder_mask(self, tree_dist):
+        return self._bigram_family.compute_preorder_mask(tree_dist)
+
+    def compute_tree_distribution(
+        self, distribution: Union[NgramProgramDistribution, NoneType]
+    ) -> TreeDistribution:
+        if distribution is None:
+            table = {
+                context: (syms, np.ones(len(syms)))
+                for context, (syms, _) in self._uniform_table.items()
+            }
+        else:
+            assert isinstance(distribution, NgramProgramDistribution), type(
+                distribution
+            )
+            table = distribution.distribution
+        contexts = list(table)
+        symbol_ids = [table[context][0] for context in contexts]
+        context_ids = np.repeat(
+            np.arange(len(contexts)), [len(syms) for syms in symbol_ids]
+        )
+        symbol_ids = np.concatenate(symbol_ids).astype(np.int64)
+        with np.errstate(divide="ignore"):
+            log_probs = np.log(
+                np.concatenate([table[context][1] for context in contexts])
+            )
+        keep = log_probs > -np.inf
+        dist = CSRDistribution.from_entries(
+            contexts,
+            context_ids[keep],
+            symbol_ids[keep],
+            log_probs[keep],
+            backoff=True,
+        )
+        return TreeDistribution(
+            self._limit,
+            dist,
+            self._tree_symbols,
+            self.compute_preorder_mask,
+            self._node_ordering,
+        )
+
+    def symbols(self):
+        return self._bigram_family.symbols()
+
+
+def count_ngrams(
+    symbol_to_index: Dict[str, int], limit: int, programs: List[SExpression]
+) -> NgramProgramCounts:
+    """
+    Count the productions in the programs, for each suffix of up to `limit`
+        (ancestor, position) pairs of the path to the node.
+    """
+    numerators = defaultdict(lambda: defaultdict(int))
+
+    def accumulate(program, context):
+        this_idx = symbol_to_index[program.symbol]
+        for start in range(len(context)):
+            numerators[context[start:]][this_idx] += 1
+        for i, child in enumerate(program.children):
+            accumulate(child, (context + ((this_idx, i),))[-limit:])
+
+    for program in programs:
+        accumulate(program, ((0, 0),))
+    return NgramProgramCounts({k: dict(v) for k, v in numerators.items()})
+
+
+def witten_bell(
+    counts: Dict[int, int], lower_syms: np.ndarray, lower_probs: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Witten-Bell interpolation of the observed counts with a lower order distribution.
+        The lower order distribution gets weight proportional to the number of
+        distinct observed symbols. If the lower order distribution is empty, this is
+        just the maximum likelihood estimate.
+
+    Returns (sorted child_sym array, probability array).
+    """
+    observed = np.array(sorted(counts), dtype=np.int64)
+    observed_counts = np.array([counts[sym] for sym in observed.tolist()])
+    lower_weight = len(observed) if len(lower_syms) else 0
+    syms = np.union1d(lower_syms, observed)
+    probs = np.zeros(len(syms))
+    probs[np.searchsorted(syms, lower_syms)] += lower_weight * lower_probs
+    probs[np.searchsorted(syms, observed)] += observed_counts
+    return syms, probs / (observed_counts.sum() + lower_weight)
@@ -1,6 +1,4 @@
-from typing import Callable, Iterator, List, Tuple
-
-import numpy as np
+from typing import Any, Callable, Dict, Iterator, List, Tuple
 
 from neurosym.program_dist.tree_distribution.preorder_mask.preorder_mask import (
     PreorderMask,
@@ -16,11 +14,20 @@ def collect_preorder_symbols(
         [SExpression, PreorderMask, int, List[int]], SExpression
     ] = None,
     symbol_to_index_fn=None,
+    mask_cache: Dict[Any, Tuple[int, ...]] = None,
 ) -> Iterator[Tuple[SExpression, List[str], PreorderMask]]:
     """
     Collects the alernate symbols that could have been selected in the tree distribution.
+
+    If the mask can cache, the alternate symbols are memoized by the mask's cache key
+        and the parents. Pass a dictionary as mask_cache to share the memo across calls
+        on the same tree distribution.
     """
     mask = tree_dist.mask_constructor(tree_dist)
+    if not mask.can_cache:
+        mask_cache = None
+    elif mask_cache is None:
+        mask_cache = {}
     mask.on_entry(0, 0)
     yield from collect_preorder_symbols_dfs(
         s_exp,
@@ -29,6 +36,7 @@ def collect_preorder_symbols(
         ((0, 0),),
         replace_node_midstream=replace_node_midstream,
         symbol_to_index_fn=symbol_to_index_fn,
+        mask_cache=mask_cache,
     )
 
 
@@ -41,14 +49,21 @@ def collect_preorder_symbols_dfs(
         [SExpression, PreorderMask, int, List[int]], SExpression
     ] = None,
     symbol_to_index_fn=None,
+    mask_cache: Dict[Any, Tuple[int, ...]] = None,
 ) -> Iterator[Tuple[SExpression, List[str], PreorderMask]]:
     """
     Collects the alernate symbols that could have been selected in the tree distribution.
     """
     position = parents[-1][1]
-    idxs = np.array([i for i, _ in tree_dist.distribution[parents]])
-    bool_mask = mask.compute_mask(position, idxs)
-    alts = tuple(int(x) for x in idxs[bool_mask])
+    key = None if mask_cache is None else (mask.cache_key(parents), parents)
+    if key is None or key not in mask_cache:
+        idxs, _ = tree_dist.likelihood_arrays[parents]
+        bool_mask = mask.compute_mask(position, idxs)
+        alts = tuple(int(x) for x in idxs[bool_mask])
+        if key is not None:
+            mask_cache[key] = alts
+    else:
+        alts = mask_cache[key]
     if replace_node_midstream is not None:
         s_exp = replace_node_midstream(s_exp, mask, position, alts)
     yield s_exp, alts, mask
@@ -68,6 +83,7 @@ def collect_preorder_symbols_dfs(
             new_parents,
             replace_node_midstream=replace_node_midstream,
             symbol_to_index_fn=symbol_to_index_fn,
+            mask_cache=mask_cache,
         )
     mask.on_exit(position, sym_idx)
 
@@ -0,0 +1,41 @@
+import time
+from typing import Any, Callable, List, Tuple
+
+from .preorder_mask import PreorderMask
+
+
+class InstrumentedPreorderMask(PreorderMask):
+    """
+    Wraps another mask, counting the calls to `compute_mask` and the time spent in
+        it. The enumerator also counts the nodes it expands in `nodes_expanded`;
+        this can be more than the calls to `compute_mask`, since the tree
+        distribution memoizes the masked likelihoods of cacheable masks.
+    """
+
+    def __init__(self, mask: PreorderMask):
+        super().__init__(mask.tree_dist)
+        self.mask = mask
+        self.compute_mask_calls = 0
+        self.nodes_expanded = 0
+        self.compute_mask_time = 0.0
+
+    def compute_mask(self, position: int, symbols: List[int]) -> List[bool]:
+        self.compute_mask_calls += 1
+        start_time = time.perf_counter()
+        try:
+            return self.mask.compute_mask(position, symbols)
+        finally:
+            self.compute_mask_time += time.perf_counter() - start_time
+
+    def on_entry(self, position: int, symbol: int) -> Callable[[], None]:
+        return self.mask.on_entry(position, symbol)
+
+    def on_exit(self, position: int, symbol: int) -> Callable[[], None]:
+        return self.mask.on_exit(position, symbol)
+
+    @property
+    def can_cache(self) -> bool:
+        return self.mask.can_cache
+
+    def cache_key(self, parents: Tuple[Tuple[int, int], ...]) -> Any:
+        return self.mask.cache_key(parents)
@@ -0,0 +1,161 @@
+"""
+Best-first enumeration of the programs of a tree distribution.
+
+A partial program is the sequence of symbols chosen at each hole, in the
+    preorder traversal order given by the distribution's node ordering. Since
+    every choice has a log probability of at most 0, the likelihood of a partial
+    program is an upper bound on the likelihood of any of its completions. We
+    keep a priority queue of partial programs keyed by this bound, and always
+    expand the best one, so complete programs come out in exact non-increasing
+    likelihood order, and each partial program is expanded exactly once.
+
+The preorder mask state of a partial program is not stored in the queue.
+    Instead, a single mask is used, and the choices are replayed onto it when the
+    partial program is expanded, and then undone.
+"""
+
+import heapq
+import itertools
+from types import NoneType
+from typing import Callable, Dict, Iterator, List, Tuple, Union
+
+from neurosym.program_dist.tree_distribution.preorder_mask.preorder_mask import (
+    PreorderMask,
+)
+from neurosym.program_dist.tree_distribution.tree_distribution import TreeDistribution
+from neurosym.programs.s_expression import SExpression
+
+
+def enumerate_tree_dist_best_first(
+    tree_dist: TreeDistribution,
+    *,
+    min_likelihood: float = float("-inf"),
+    max_frontier_size: Union[int, NoneType] = None,
+) -> Iterator[Tuple[SExpression, float]]:
+    """
+    Enumerate all programs with likelihood above min_likelihood, in non-increasing
+        order of likelihood.
+
+    Args:
+        tree_dist: The distribution to enumerate.
+        min_likelihood: Only programs with a likelihood above this are produced.
+        max_frontier_size: If not None, the maximum number of partial programs to
+            keep. When the frontier grows past this, it is cut down to the best
+            half, and enumeration stops once it reaches the likelihood of the best
+            partial program that was discarded. All programs above that likelihood
+            are still produced, in order.
+    """
+    assert max_frontier_size is None or max_frontier_size >= 1, max_frontier_size
+    preorder_mask = tree_dist.mask_constructor(tree_dist)
+    preorder_mask.on_entry(0, 0)
+    tiebreak = itertools.count()
+    frontier = [(0.0, next(tiebreak), ())]
+    while frontier:
+        neg_likelihood, _, choices = heapq.heappop(frontier)
+        if -neg_likelihood <= min_likelihood:
+            return
+        options = expand_partial_program(tree_dist, choices, preorder_mask)
+        if options is None:
+            yield program_from_choices(tree_dist, choices), -neg_likelihood
+            continue
+        for node, likelihood in options:
+            likelihood = likelihood - neg_likelihood
+            if likelihood > min_likelihood:
+                heapq.heappush(
+                    frontier, (-likelihood, next(tiebreak), choices + (node,))
+                )
+        if max_frontier_size is not None and len(frontier) > max_frontier_size:
+            frontier = heapq.nsmallest(max(max_frontier_size // 2, 1) + 1, frontier)
+            min_likelihood = max(min_likelihood, -frontier.pop()[0])
+
+
+def expand_partial_program(
+    tree_dist: TreeDistribution,
+    choices: Tuple[int, ...],
+    preorder_mask: PreorderMask,
+) -> Union[List[Tuple[int, float]], NoneType]:
+    """
+    The symbols that can fill the first unfilled hole of the partial program, with
+        their log probabilities, or None if the program is complete. The preorder
+        mask should be in the state just after entering the root, and is restored
+        afterwards.
+    """
+    hole, _, undos = replay_choices(tree_dist, choices, preorder_mask)
+    try:
+        if hole is None:
+            return None
+        return list(tree_dist.masked_likelihoods(hole, preorder_mask).items())
+    finally:
+        for undo in reversed(undos):
+            undo()
+
+
+def replay_choices(
+    tree_dist: TreeDistribution,
+    choices: Tuple[int, ...],
+    preorder_mask: PreorderMask,
+) -> Tuple[
+    Union[Tuple[Tuple[int, int], ...], NoneType], List[list], List[Callable[[], None]]
+]:
+    """
+    Replay the given choices onto the preorder mask, which should be in the state
+        just after entering the root.
+
+    Returns (hole, stack, undos), where hole is the parents of the first unfilled
+        hole (None if the choices form a complete program), stack is the list of
+        nodes that still have unfilled children, as [parents, node, order, index
+        of the next child in the order, position of the node in choices], and
+        undos restore the mask when called in reverse order.
+    """
+    undos = []
+    stack = []
+    for position, node in enumerate(choices):
+        parents = hole_parents(tree_dist, stack)
+        if stack:
+            stack[-1][3] += 1
+        undos.append(preorder_mask.on_entry(parents[-1][1], node))
+        arity = tree_dist.symbols[node][1]
+        order = tree_dist.ordering.order(node, arity)
+        stack.append([parents, node, order, 0, position])
+        while stack and stack[-1][3] == len(stack[-1][2]):
+            parents, node, *_ = stack.pop()
+            undos.append(preorder_mask.on_exit(parents[-1][1], node))
+    hole = hole_parents(tree_dist, stack) if stack or not choices else None
+    return hole, stack, undos
+
+
+def hole_parents(tree_dist: TreeDistribution, stack: List[list]):
+    """
+    The parents of the next unfilled hole, given the stack from `replay_choices`.
+    """
+    if not stack:
+        return ((0, 0),)
+    parents, node, order, index, _ = stack[-1]
+    return (parents + ((node, order[index]),))[-tree_dist.limit :]
+
+
+def program_from_choices(
+    tree_dist: TreeDistribution,
+    choices: Tuple[int, ...],
+    fills: Union[Dict[int, Dict[int, SExpression]], NoneType] = None,
+) -> SExpression:
+    """
+    Convert the choices of a complete program back into an SExpression.
+
+    If fills is provided, the choices may be a partial program, and fills maps the
+        position in choices of each node with unfilled children to those children,
+        keyed by child index.
+    """
+    fills = {} if fills is None else fills
+    choices = iter(enumerate(choices))
+
+    def build():
+        position, node = next(choices)
+        symbol, arity = tree_dist.symbols[node]
+        filled = fills.get(position, {})
+        children = [None] * arity
+        for index in tree_dist.ordering.order(node, arity):
+            children[index] = filled[index] if index in filled else build()
+        return SExpression(symbol, children)
+
+    return build()
@@ -14,18 +14,322 @@ Likelihood is defined as the log probability of the program.
 """
 
 import bisect
+import heapq
 import itertools
-from typing import Any, Dict, List, Tuple, Union
+import math
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Tuple, Union
 
 import numpy as np
 from torch import NoneType
 
 from neurosym.program_dist.enumeration_chunk_size import DEFAULT_CHUNK_SIZE
+from neurosym.program_dist.tree_distribution.preorder_mask.instrumented_preorder_mask import (
+    InstrumentedPreorderMask,
+)
 from neurosym.program_dist.tree_distribution.preorder_mask.preorder_mask import (
     PreorderMask,
 )
+from neurosym.program_dist.tree_distribution.tree_dist_best_first_enumerator import (
+    expand_partial_program,
+    program_from_choices,
+    replay_choices,
+)
 from neurosym.program_dist.tree_distribution.tree_distribution import TreeDistribution
 from neurosym.programs.s_expression import SExpression
+from neurosym.utils.fork_pool import fork_pool, worker_state
+
+
+class EnumerationCache:
+    """
+    Cache of the programs enumerated below each (mask cache key, parents, depth
+        budget, size budget) key, shared across the chunks of an enumeration.
+        Programs are stored as (program, likelihood, size) triples.
+
+    Each entry holds the programs sorted by likelihood along with the minimum
+        likelihood they were enumerated down to, so it can serve any request with
+        a higher (or equal) minimum likelihood. A request with a lower minimum
+        likelihood, as made by each chunk after the first, is an extension: only
+        the programs in the band below the stored minimum are enumerated, and
+        merged into the entry. Entries are evicted in least recently used order
+        once either budget is exceeded.
+
+    Args:
+        max_entries: The maximum number of entries to keep, or None for no limit.
+        max_programs: The maximum total number of programs to keep across all
+            entries, or None for no limit.
+    """
+
+    def __init__(
+        self,
+        max_entries: Union[int, NoneType] = None,
+        max_programs: Union[int, NoneType] = None,
+    ):
+        self.max_entries = max_entries
+        self.max_programs = max_programs
+        self._entries = OrderedDict()
+        self.num_programs = 0
+        self.hits = 0
+        self.misses = 0
+        self.extensions = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(
+        self, key: Any, min_likelihood: float
+    ) -> Union[List[Tuple[SExpression, float, int]], NoneType]:
+        """
+        Get the programs at the given key with likelihood at least min_likelihood,
+            or None if they are not cached. If the entry only goes down to a higher
+            likelihood, this counts as an extension rather than a miss, and the
+            entry can be completed using `stored`.
+        """
+        entry = self._entries.get(key)
+        if entry is None or entry[1] > min_likelihood:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.extensions += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return remove_below_threshold(entry[0], min_likelihood)
+
+    def stored(self, key: Any) -> Tuple[List[Tuple[SExpression, float, int]], float]:
+        """
+        The programs stored at the given key and the minimum likelihood they were
+            enumerated down to, or no programs down to a likelihood of inf if there
+            is no entry.
+        """
+        return self._entries.get(key, ([], float("inf")))
+
+    def put(
+        self,
+        key: Any,
+        results: List[Tuple[SExpression, float, int]],
+        min_likelihood: float,
+    ):
+        """
+        Store the programs at the given key, which should be sorted by likelihood
+            and contain every program with likelihood at least min_likelihood.
+        """
+        if key in self._entries:
+            self.num_programs -= len(self._entries.pop(key)[0])
+        self._entries[key] = results, min_likelihood
+        self.num_programs += len(results)
+        while self._entries and (
+            (self.max_entries is not None and len(self._entries) > self.max_entries)
+            or (self.max_programs is not None and self.num_programs > self.max_programs)
+        ):
+            _, (evicted, _) = self._entries.popitem(last=False)
+            self.num_programs -= len(evicted)
+            self.evictions += 1
+
+
+@dataclass
+class EnumerationCursor:
+    """
+    Position within an enumeration, which is updated as the enumeration proceeds.
+        Chunk c contains the programs with likelihood in (-c * chunk_size,
+        -(c - 1) * chunk_size].
+
+    Args:
+        chunk_size: The chunk size of the enumeration.
+        chunk: The first chunk that has not been completely yielded. Resuming from
+            this cursor starts at the beginning of this chunk, so programs of a
+            partially yielded chunk are produced again.
+        end_chunk: If not None, the enumeration stops before this chunk.
+    """
+
+    chunk_size: float = DEFAULT_CHUNK_SIZE
+    chunk: int = 1
+    end_chunk: Union[int, NoneType] = None
+
+    def __post_init__(self):
+        assert self.chunk >= 1, f"Chunks are numbered from 1, got {self.chunk}"
+
+    @classmethod
+    def starting_at(
+        cls, likelihood: float, chunk_size: float = DEFAULT_CHUNK_SIZE
+    ) -> "EnumerationCursor":
+        """
+        Cursor starting at the chunk containing the given likelihood.
+        """
+        return cls(chunk_size, chunk=math.floor(-likelihood / chunk_size) + 1)
+
+    @classmethod
+    def partition(
+        cls,
+        num_shards: int,
+        min_likelihood: float,
+        chunk_size: float = DEFAULT_CHUNK_SIZE,
+    ) -> List["EnumerationCursor"]:
+        """
+        Split the chunks of an enumeration down to min_likelihood into num_shards
+            contiguous, disjoint ranges, each of which can be enumerated
+            independently, e.g., on different machines. min_likelihood must be
+            finite, as the number of chunks is otherwise unbounded.
+        """
+        assert min_likelihood > -float("inf"), "The enumeration must be finite"
+        num_chunks = max(1, math.ceil(-min_likelihood / chunk_size))
+        boundaries = np.linspace(1, num_chunks + 1, num_shards + 1).round().astype(int)
+        return [
+            cls(chunk_size, chunk=int(start), end_chunk=int(end))
+            for start, end in zip(boundaries[:-1], boundaries[1:])
+            if start < end
+        ]
+
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        Serializable representation of this cursor.
+        """
+        return dict(
+            chunk_size=self.chunk_size, chunk=self.chunk, end_chunk=self.end_chunk
+        )
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "EnumerationCursor":
+        return cls(**data)
+
+    def chunk_bounds(self, min_likelihood: float):
+        """
+        Yields the (lower, upper) likelihood bounds of each chunk, advancing the
+            cursor once the caller asks for the next one.
+        """
+        for chunk in itertools.count(self.chunk):
+            if self.end_chunk is not None and chunk >= self.end_chunk:
+                return
+            likelihood_bound = -chunk * self.chunk_size
+            yield likelihood_bound, likelihood_bound + self.chunk_size
+            self.chunk = chunk + 1
+            if likelihood_bound <= min_likelihood:
+                return
+
+
+@dataclass
+class EnumerationStats:
+    """
+    Statistics of an enumeration, with one entry per chunk.
+
+    Args:
+        chunk_bounds: The (lower, upper) likelihood bounds of each chunk.
+        nodes_expanded: The number of nodes expanded by the search in each chunk,
+            i.e., the holes whose productions the search went through.
+        nodes_visited: The number of nodes visited by the search in each chunk,
+            whether expanded or served from the cache.
+        compute_mask_calls: The number of calls to the mask's compute_mask in each
+            chunk. This can be lower than nodes_expanded, since the tree
+            distribution memoizes the masked likelihoods of cacheable masks.
+        compute_mask_time: The time in seconds spent in compute_mask in each chunk.
+        cache_hits: The number of cache hits in each chunk.
+        cache_misses: The number of cache misses in each chunk.
+        cache_size: The number of cache entries at the end of each chunk.
+        programs_generated: The number of programs produced by the search in each
+            chunk, including those outside the chunk's likelihood band.
+        programs_yielded: The number of programs yielded in each chunk. The rest of
+            the programs generated were discarded as outside the band.
+        wall_time: The time in seconds spent in the enumeration in each chunk, not
+            counting the time the caller spends between programs.
+    """
+
+    chunk_bounds: List[Tuple[float, float]] = field(default_factory=list)
+    nodes_expanded: List[int] = field(default_factory=list)
+    nodes_visited: List[int] = field(default_factory=list)
+    compute_mask_calls: List[int] = field(default_factory=list)
+    compute_mask_time: List[float] = field(default_factory=list)
+    cache_hits: List[int] = field(default_factory=list)
+    cache_misses: List[int] = field(default_factory=list)
+    cache_size: List[int] = field(default_factory=list)
+    programs_generated: List[int] = field(default_factory=list)
+    programs_yielded: List[int] = field(default_factory=list)
+    wall_time: List[float] = field(default_factory=list)
+
+    def record_chunk(
+        self,
+        chunk_bounds: Tuple[float, float],
+        preorder_mask: InstrumentedPreorderMask,
+        cache: Union[EnumerationCache, NoneType],
+        cache_counts_before: Tuple[int, int],
+        programs: Tuple[int, int],
+        wall_time: float,
+    ):
+        """
+        Record the statistics of a chunk, given the mask it was enumerated with,
+            the cache's (hits, misses) before the chunk, and the number of programs
+            (generated, yielded).
+        """
+        hits, misses = 0, 0
+        if cache is not None:
+            hits = cache.hits - cache_counts_before[0]
+            misses = cache.misses - cache_counts_before[1]
+        self.chunk_bounds.append(chunk_bounds)
+        self.nodes_expanded.append(preorder_mask.nodes_expanded)
+        self.nodes_visited.append(preorder_mask.nodes_expanded + hits)
+        self.compute_mask_calls.append(preorder_mask.compute_mask_calls)
+        self.compute_mask_time.append(preorder_mask.compute_mask_time)
+        self.cache_hits.append(hits)
+        self.cache_misses.append(misses)
+        self.cache_size.append(0 if cache is None else len(cache))
+        self.programs_generated.append(programs[0])
+        self.programs_yielded.append(programs[1])
+        self.wall_time.append(wall_time)
+
+    def work(self) -> List[int]:
+        """
+        The work done in each chunk, as the number of nodes expanded plus the
+            number of programs generated.
+        """
+        return [
+            nodes + programs
+            for nodes, programs in zip(self.nodes_expanded, self.programs_generated)
+        ]
+
+
+def adaptive_chunk_bounds(
+    chunk_size: float,
+    min_likelihood: float,
+    stats: EnumerationStats,
+    max_change: float = 4,
+    first_chunk: int = 0,
+):
+    """
+    Yields the (lower, upper) likelihood bounds of each chunk, picking the size of
+        each chunk from the growth of the work done in the previous two, which is
+        read from stats once the caller asks for the next chunk. Only the chunks
+        recorded in stats from index first_chunk on are read, so stats that
+        already hold earlier enumerations do not affect the sizing.
+
+    Assuming the work needed to reach likelihood -h grows as e^{rh}, the analysis
+        in `enumeration_chunk_size` applies with h scaled by r, so the optimal chunk
+        size is DEFAULT_CHUNK_SIZE / r. The chunk size stays within a factor of
+        max_change of the initial chunk_size.
+    """
+    upper, size = 0.0, chunk_size
+    while True:
+        likelihood_bound = max(upper - size, min_likelihood)
+        yield likelihood_bound, upper
+        if likelihood_bound <= min_likelihood:
+            return
+        upper = likelihood_bound
+        if len(stats.chunk_bounds) - first_chunk < 2:
+            continue
+        [(previous_bound, _), (current_bound, _)] = stats.chunk_bounds[-2:]
+        previous_work, current_work = stats.work()[-2:]
+        if previous_work == 0 or current_work <= previous_work:
+            size = chunk_size * max_change
+            continue
+        rate = np.log(current_work / previous_work) / (previous_bound - current_bound)
+        size = float(
+            np.clip(
+                DEFAULT_CHUNK_SIZE / rate,
+                chunk_size / max_change,
+                chunk_size * max_change,
+            )
+        )
 
 
 def enumerate_tree_dist(
@@ -34,6 +338,15 @@ def enumerate_tree_dist(
     chunk_size: float = DEFAULT_CHUNK_SIZE,
     min_likelihood: float = float("-inf"),
     use_cache=True,
+    cache: Union[EnumerationCache, NoneType] = None,
+    n_workers: Union[int, NoneType] = None,
+    split_depth: int = 2,
+    cursor: Union[EnumerationCursor, NoneType] = None,
+    adaptive_chunk_size: bool = False,
+    stats: Union[EnumerationStats, NoneType] = None,
+    stats_callback: Union[Callable[[EnumerationStats], NoneType], NoneType] = None,
+    max_depth: float = float("inf"),
+    max_size: float = float("inf"),
 ):
     """
     Enumerate all programs using iterative deepening.
@@ -43,35 +356,256 @@ def enumerate_tree_dist(
         chunk_size: The amount of likelihood to consider at once. If this is
             too small, we will spend a lot of time doing the same work over and
             over again. If this is too large, we will spend a lot of time
-            doing work that we don't need to do.
+            doing work that we don't need to do. See
+            `EnumerationEstimate.recommended_chunk_size` for a way to pick it.
+        use_cache: Whether to cache the programs enumerated at each node. Ignored if
+            the preorder mask does not support caching.
+        cache: The cache to use, which is kept across chunks. Must only be shared
+            between enumerations of the same distribution. If None, a new
+            unbounded cache is used. Not supported with n_workers, where each
+            worker keeps its own cache, so passing both raises a ValueError.
+        n_workers: If provided, the search is split into independent subproblems
+            that are enumerated in a pool of that many processes. See
+            `enumerate_tree_dist_parallel`.
+        split_depth: The number of choices made before splitting the search, when
+            n_workers is provided.
+        cursor: If provided, the enumeration resumes from this cursor, which is
+            updated as chunks are completed. Its chunk size is used in place of
+            chunk_size.
+        adaptive_chunk_size: If True, chunk_size is only the size of the first
+            chunks, and the rest are sized by `adaptive_chunk_bounds`. Not supported
+            with n_workers or cursor.
+        stats: If provided, filled in with statistics of the enumeration as it
+            proceeds. Statistics accumulate: a stats object that already holds
+            data is appended to rather than reset, and the adaptive chunk sizing
+            only reads the chunks of this call. Not supported with n_workers.
+        stats_callback: If provided, called with the statistics after each chunk.
+            Not supported with n_workers.
+        max_depth: Only programs with at most this depth are produced, where a leaf
+            has depth 1. Subtrees that cannot fit are pruned during the search.
+            Not supported with n_workers.
+        max_size: Only programs with at most this many nodes are produced, pruned
+            as with max_depth. Not supported with n_workers.
     """
-    for chunk in itertools.count(1):
-        likelihood_bound = -chunk * chunk_size
+    if cursor is None:
+        cursor = EnumerationCursor(chunk_size)
+    if stats_callback is not None and stats is None:
+        stats = EnumerationStats()
+    assert n_workers is None or not (
+        adaptive_chunk_size
+        or stats is not None
+        or min(max_depth, max_size) < float("inf")
+    ), "Not supported in parallel enumeration"
+    if n_workers is not None and cache is not None:
+        raise ValueError(
+            "A cache cannot be used with n_workers, as each worker keeps its own"
+        )
+    if n_workers is not None:
+        yield from enumerate_tree_dist_parallel(
+            tree_dist,
+            cursor=cursor,
+            min_likelihood=min_likelihood,
+            use_cache=use_cache,
+            n_workers=n_workers,
+            split_depth=split_depth,
+        )
+        return
+    cache = enumeration_cache(tree_dist, use_cache, cache)
+    if adaptive_chunk_size:
+        assert cursor.chunk == 1 and cursor.end_chunk is None, "Cannot resume"
+        stats = EnumerationStats() if stats is None else stats
+        bounds = adaptive_chunk_bounds(
+            cursor.chunk_size,
+            min_likelihood,
+            stats,
+            first_chunk=len(stats.chunk_bounds),
+        )
+    else:
+        bounds = cursor.chunk_bounds(min_likelihood)
+    for likelihood_bound, upper in bounds:
+        start_time = time.perf_counter()
+        wall_time = 0.0
+        hits, misses = (cache.hits, cache.misses) if cache is not None else (0, 0)
         preorder_mask = tree_dist.mask_constructor(tree_dist)
-        cache = {} if use_cache and preorder_mask.can_cache else None
+        if stats is not None:
+            preorder_mask = InstrumentedPreorderMask(preorder_mask)
         preorder_mask.on_entry(0, 0)
-        for program, likelihood in enumerate_tree_dist_dfs(
-            tree_dist, likelihood_bound, ((0, 0),), preorder_mask, cache
+        programs_generated = programs_yielded = 0
+        for program, likelihood, _ in enumerate_tree_dist_dfs(
+            tree_dist,
+            likelihood_bound,
+            ((0, 0),),
+            preorder_mask,
+            cache,
+            max_depth,
+            max_size,
         ):
-            if (
-                max(likelihood_bound, min_likelihood)
-                < likelihood
-                <= likelihood_bound + chunk_size
-            ):
+            programs_generated += 1
+            if max(likelihood_bound, min_likelihood) < likelihood <= upper:
+                programs_yielded += 1
+                wall_time += time.perf_counter() - start_time
                 yield program, likelihood
-        if likelihood_bound <= min_likelihood:
-            return
+                start_time = time.perf_counter()
+        if stats is None:
+            continue
+        stats.record_chunk(
+            (likelihood_bound, upper),
+            preorder_mask,
+            cache,
+            (hits, misses),
+            (programs_generated, programs_yielded),
+            wall_time + time.perf_counter() - start_time,
+        )
+        if stats_callback is not None:
+            stats_callback(stats)
+
+
+def enumeration_cache(
+    tree_dist: TreeDistribution,
+    use_cache: bool,
+    cache: Union[EnumerationCache, NoneType] = None,
+) -> Union[EnumerationCache, NoneType]:
+    """
+    The cache to enumerate with: None if caching is off or the preorder mask does
+        not support it, otherwise the given cache, or a new one if it is None.
+    """
+    if not (use_cache and tree_dist.mask_constructor(tree_dist).can_cache):
+        return None
+    return EnumerationCache() if cache is None else cache
+
+
+def enumerate_tree_dist_parallel(
+    tree_dist: TreeDistribution,
+    *,
+    cursor: EnumerationCursor,
+    min_likelihood: float,
+    use_cache: bool,
+    n_workers: int,
+    split_depth: int,
+):
+    """
+    Like `enumerate_tree_dist`, but the search is split into the partial programs
+        formed by the first split_depth choices of the preorder traversal, and the
+        completions of each are enumerated in a separate task, in a pool of
+        n_workers processes. Each worker keeps its own cache across tasks.
+
+    Every chunk is completed across all tasks before any of its programs are
+        yielded, so each chunk is yielded in full before the next, as in the
+        sequential version, though the order within a chunk may differ. The tree
+        distribution is sent to each worker once, through a `fork_pool`.
+    """
+    assert split_depth >= 1, split_depth
+    prefixes = split_search(tree_dist, split_depth, min_likelihood)
+    state = tree_dist, enumeration_cache(tree_dist, use_cache)
+    with fork_pool(n_workers, state) as pool:
+        for likelihood_bound, upper in cursor.chunk_bounds(min_likelihood):
+            low = max(likelihood_bound, min_likelihood)
+            tasks = [
+                (choices, likelihood, low, upper)
+                for choices, likelihood in prefixes
+                if likelihood > low
+            ]
+            for results in pool.imap(_enumerate_prefix_in_worker, tasks):
+                yield from results
+
+
+def split_search(
+    tree_dist: TreeDistribution, split_depth: int, min_likelihood: float
+) -> List[Tuple[Tuple[int, ...], float]]:
+    """
+    The partial programs formed by the first split_depth choices of the preorder
+        traversal (or fewer, for complete programs), with their likelihoods.
+    """
+    preorder_mask = tree_dist.mask_constructor(tree_dist)
+    preorder_mask.on_entry(0, 0)
+    prefixes = [((), 0.0)]
+    for _ in range(split_depth):
+        new_prefixes = []
+        for choices, likelihood in prefixes:
+            options = expand_partial_program(tree_dist, choices, preorder_mask)
+            if options is None:
+                new_prefixes.append((choices, likelihood))
+                continue
+            for node, node_likelihood in options:
+                if likelihood + node_likelihood > min_likelihood:
+                    new_prefixes.append(
+                        (choices + (node,), likelihood + node_likelihood)
+                    )
+        prefixes = new_prefixes
+    return prefixes
+
+
+def enumerate_completions(
+    tree_dist: TreeDistribution,
+    min_likelihood: float,
+    stack: List[list],
+    preorder_mask: PreorderMask,
+    cache: Union[NoneType, EnumerationCache],
+):
+    """
+    Enumerate the ways to fill the unfilled children of the nodes in the stack, as
+        produced by `replay_choices`, with the preorder mask in the state it leaves.
+
+    Yields (fills, likelihood), where fills is as in `program_from_choices`.
+    """
+    if not stack:
+        yield {}, 0
+        return
+    parents, node, order, index, position = stack[-1]
+    for children, likelihood, _ in enumerate_children_and_likelihoods_dfs(
+        tree_dist,
+        min_likelihood,
+        parents,
+        node,
+        num_children=len(order),
+        starting_index=index,
+        order=order,
+        preorder_mask=preorder_mask,
+        cache=cache,
+    ):
+        children = dict(children)
+        undo_exit = preorder_mask.on_exit(parents[-1][1], node)
+        for fills, rest_likelihood in enumerate_completions(
+            tree_dist, min_likelihood - likelihood, stack[:-1], preorder_mask, cache
+        ):
+            yield {**fills, position: children}, likelihood + rest_likelihood
+        undo_exit()
+
+
+def _enumerate_prefix_in_worker(
+    task: Tuple[Tuple[int, ...], float, float, float]
+) -> List[Tuple[SExpression, float]]:
+    choices, likelihood, low, high = task
+    tree_dist, cache = worker_state()
+    preorder_mask = tree_dist.mask_constructor(tree_dist)
+    preorder_mask.on_entry(0, 0)
+    _, stack, _ = replay_choices(tree_dist, choices, preorder_mask)
+    results = []
+    for fills, rest_likelihood in enumerate_completions(
+        tree_dist, low - likelihood, stack, preorder_mask, cache
+    ):
+        if low < likelihood + rest_likelihood <= high:
+            results.append(
+                (
+                    program_from_choices(tree_dist, choices, fills),
+                    likelihood + rest_likelihood,
+                )
+            )
+    return results
 
 
 def remove_below_threshold(
-    results: List[Tuple[SExpression, float]], min_likelihood: float
+    results: List[Tuple[SExpression, float]],
+    min_likelihood: float,
+    max_likelihood: float = float("inf"),
 ):
     """
-    Remove all results below the threshold.
+    Remove all results below the threshold, and at or above max_likelihood.
     """
     # binary search
     index = bisect.bisect_left(results, min_likelihood, key=lambda x: x[1])
-    return results[index:]
+    end = bisect.bisect_left(results, max_likelihood, key=lambda x: x[1])
+    return results[index:end]
 
 
 def enumerate_tree_dist_dfs(
@@ -79,21 +613,47 @@ def enumerate_tree_dist_dfs(
     min_likelihood: float,
     parents: Tuple[Tuple[int, int], ...],
     preorder_mask: PreorderMask,
-    cache: Union[NoneType, Dict[Any, List[Tuple[SExpression, float]]]],
+    cache: Union[NoneType, EnumerationCache],
+    max_depth: float = float("inf"),
+    max_size: float = float("inf"),
+    max_likelihood: float = float("inf"),
 ):
-    if cache is not None:
-        key = preorder_mask.cache_key(parents), parents
-        if key in cache:
-            old_results, old_min_likelihood = cache[key]
-            if old_min_likelihood <= min_likelihood:
-                return remove_below_threshold(old_results, min_likelihood)
-    generator = enumerate_tree_dist_dfs_uncached(
-        tree_dist, min_likelihood, parents, preorder_mask, cache
-    )
-    if cache is not None:
-        generator = sorted(generator, key=lambda x: x[1])
-        cache[key] = generator, min_likelihood
-    return generator
+    """
+    Like `enumerate_tree_dist_dfs_uncached`, but using the cache if provided. The
+        cache entries always hold every program down to their minimum likelihood,
+        regardless of max_likelihood, which only limits the programs returned.
+    """
+    if cache is None:
+        return enumerate_tree_dist_dfs_uncached(
+            tree_dist,
+            min_likelihood,
+            parents,
+            preorder_mask,
+            cache,
+            max_depth,
+            max_size,
+            max_likelihood,
+        )
+    key = preorder_mask.cache_key(parents), parents, max_depth, max_size
+    results = cache.get(key, min_likelihood)
+    if results is None:
+        # only enumerate the band below the programs already stored, if any
+        stored, stored_min_likelihood = cache.stored(key)
+        band = enumerate_tree_dist_dfs_uncached(
+            tree_dist,
+            min_likelihood,
+            parents,
+            preorder_mask,
+            cache,
+            max_depth,
+            max_size,
+            stored_min_likelihood,
+        )
+        results = list(
+            heapq.merge(sorted(band, key=lambda x: x[1]), stored, key=lambda x: x[1])
+        )
+        cache.put(key, results, min_likelihood)
+    return remove_below_threshold(results, min_likelihood, max_likelihood)
 
 
 def enumerate_tree_dist_dfs_uncached(
@@ -101,13 +661,25 @@ def enumerate_tree_dist_dfs_uncached(
     min_likelihood: float,
     parents: Tuple[Tuple[int, int], ...],
     preorder_mask: PreorderMask,
-    cache: Union[NoneType, Dict[Any, List[Tuple[SExpression, float]]]],
+    cache: Union[NoneType, EnumerationCache],
+    max_depth: float = float("inf"),
+    max_size: float = float("inf"),
+    max_likelihood: float = float("inf"),
 ):
     """
-    Enumerate all programs that are within the likelihood range, with the given parents.
+    Enumerate all programs that are within the likelihood range, with the given parents,
+        and with at most max_depth depth and max_size nodes. The range is from
+        min_likelihood (inclusive) to max_likelihood (exclusive).
+
+    Yields (program, likelihood, size) triples.
     """
 
-    if min_likelihood > 0:
+    if (
+        min_likelihood > 0
+        or min_likelihood >= max_likelihood
+        or max_depth < 1
+        or max_size < 1
+    ):
         # We can stop searching deeper.
         return
 
@@ -115,18 +687,26 @@ def enumerate_tree_dist_dfs_uncached(
     assert isinstance(
         preorder_mask, PreorderMask
     ), f"{preorder_mask} is not a PreorderMask"
+    if isinstance(preorder_mask, InstrumentedPreorderMask):
+        preorder_mask.nodes_expanded += 1
 
     # Performed recursively for now.
-    syms, log_probs = tree_dist.likelihood_arrays[parents]
     position = parents[-1][1]
-    mask = preorder_mask.compute_mask(position, syms)
-    denominator = np.logaddexp.reduce(log_probs[mask])
-    for node, likelihood in zip(syms[mask], log_probs[mask] - denominator):
+    for node, likelihood in tree_dist.masked_likelihoods(
+        parents, preorder_mask
+    ).items():
         new_parents = parents + (node,)
         new_parents = new_parents[-tree_dist.limit :]
         symbol, arity = tree_dist.symbols[node]
+        if arity >= max_size or (arity and max_depth == 1):
+            # Each child needs at least one node, one level below this one.
+            continue
         undo_entry = preorder_mask.on_entry(position, node)
-        for children, child_likelihood in enumerate_children_and_likelihoods_dfs(
+        for (
+            children,
+            child_likelihood,
+            child_size,
+        ) in enumerate_children_and_likelihoods_dfs(
             tree_dist,
             min_likelihood - likelihood,
             parents,
@@ -136,13 +716,16 @@ def enumerate_tree_dist_dfs_uncached(
             order=tree_dist.ordering.order(node, arity),
             preorder_mask=preorder_mask,
             cache=cache,
+            max_depth=max_depth - 1,
+            max_size=max_size - 1,
+            max_likelihood=max_likelihood - likelihood,
         ):
-            if child_likelihood + likelihood < min_likelihood:
+            if not min_likelihood <= child_likelihood + likelihood < max_likelihood:
                 continue
             undo_exit = preorder_mask.on_exit(position, node)
             yield SExpression(
                 symbol, [children[i] for i in range(arity)]
-            ), child_likelihood + likelihood
+            ), child_likelihood + likelihood, child_size + 1
             undo_exit()
         undo_entry()
 
@@ -156,28 +739,49 @@ def enumerate_children_and_likelihoods_dfs(
     starting_index: int,
     order: List[int],
     preorder_mask: PreorderMask,
-    cache: Union[NoneType, Dict[Any, List[Tuple[SExpression, float]]]],
+    cache: Union[NoneType, EnumerationCache],
+    max_depth: float = float("inf"),
+    max_size: float = float("inf"),
+    max_likelihood: float = float("inf"),
 ):
     """
-    Enumerate all children and their likelihoods.
+    Enumerate all children and their likelihoods, with each child having at most
+        max_depth depth, and all the children together at most max_size nodes.
+        The likelihood is at least min_likelihood and below max_likelihood.
+
+    Yields (children, likelihood, size) triples.
     """
 
-    if min_likelihood > 0:
+    if min_likelihood > 0 or min_likelihood >= max_likelihood:
         # We can stop searching deeper.
         return
 
     if starting_index == num_children:
-        yield {}, 0
+        if max_likelihood > 0:
+            yield {}, 0, 0
         return
     new_parents = parents + ((most_recent_parent, order[starting_index]),)
     new_parents = new_parents[-tree_dist.limit :]
 
-    for first_child, first_likelihood in enumerate_tree_dist_dfs(
-        tree_dist, min_likelihood, new_parents, preorder_mask, cache
+    # leave at least one node for each of the remaining children
+    first_max_size = max_size - (num_children - starting_index - 1)
+    # only the last child can be bounded above, as the others can be followed by
+    # children of any likelihood
+    is_last = starting_index == num_children - 1
+    for first_child, first_likelihood, first_size in enumerate_tree_dist_dfs(
+        tree_dist,
+        min_likelihood,
+        new_parents,
+        preorder_mask,
+        cache,
+        max_depth,
+        first_max_size,
+        max_likelihood if is_last else float("inf"),
     ):
         for (
             rest_children,
             rest_likelihood,
+            rest_size,
         ) in enumerate_children_and_likelihoods_dfs(
             tree_dist,
             min_likelihood - first_likelihood,
@@ -188,6 +792,11 @@ def enumerate_children_and_likelihoods_dfs(
             order,
             preorder_mask,
             cache=cache,
+            max_depth=max_depth,
+            max_size=max_size - first_size,
+            max_likelihood=max_likelihood - first_likelihood,
         ):
             rest_children[order[starting_index]] = first_child
-            yield rest_children, first_likelihood + rest_likelihood
+            yield rest_children, first_likelihood + rest_likelihood, (
+                first_size + rest_size
+            )
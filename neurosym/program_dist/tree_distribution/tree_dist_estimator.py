@@ -0,0 +1,216 @@
+"""
+Estimates of the size of an enumeration, without running it.
+
+The likelihood range is split into bins of width bin_width, and the cost of a
+    production is -log P(production) in bins, split between the two nearest whole
+    numbers of bins in proportion to how close it is to each. The cost of a
+    program is then the sum of the costs of its productions. By dynamic
+    programming over the holes, we compute, for each cost up to the budget, the
+    number of programs with that cost, their total number of nodes, and their
+    total probability mass. Rounding makes these estimates, which get more
+    precise as bin_width shrinks. A production that would recurse into a hole
+    being computed, with the same budget, is charged at least one bin, so
+    cycles of likely productions are counted rather than cut off.
+
+The holes are identified by their parents and the mask's cache key, so the mask
+    is taken into account. This requires the mask state at each child of a node
+    to not depend on the earlier children, which holds for type masks. Masks
+    that cannot cache are replaced by a mask that allows everything, which
+    overestimates the counts.
+"""
+
+import math
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+from neurosym.program_dist.tree_distribution.preorder_mask.preorder_mask import (
+    NoopPreorderMask,
+    PreorderMask,
+)
+from neurosym.program_dist.tree_distribution.tree_distribution import TreeDistribution
+
+
+@dataclass
+class EnumerationEstimate:
+    """
+    Estimate of the programs of a distribution, binned by likelihood. Bin b
+        holds the programs with likelihood of about -b * bin_width.
+
+    Args:
+        bin_width: The width of each bin, in nats.
+        counts: The number of programs in each bin.
+        sizes: The total number of nodes of the programs in each bin.
+        mass: The total probability of the programs in each bin.
+    """
+
+    bin_width: float
+    counts: np.ndarray
+    sizes: np.ndarray
+    mass: np.ndarray
+
+    def _bins_above(self, min_likelihood: float) -> int:
+        return min(
+            len(self.counts), max(0, math.ceil(-min_likelihood / self.bin_width))
+        )
+
+    def num_programs(self, min_likelihood: float) -> float:
+        """
+        The estimated number of programs with likelihood above min_likelihood.
+        """
+        return float(self.counts[: self._bins_above(min_likelihood)].sum())
+
+    def num_nodes(self, min_likelihood: float) -> float:
+        """
+        The estimated total number of nodes of the programs with likelihood above
+            min_likelihood, which is proportional to the time to enumerate them.
+        """
+        return float(self.sizes[: self._bins_above(min_likelihood)].sum())
+
+    def covered_mass(self, min_likelihood: float) -> float:
+        """
+        The estimated probability that a sample has likelihood above
+            min_likelihood.
+        """
+        return float(self.mass[: self._bins_above(min_likelihood)].sum())
+
+    def entropy(self) -> float:
+        """
+        The estimated contribution to the entropy of the distribution from the
+            programs in the bins, in nats. This approaches the entropy as the
+            bins cover more of the probability mass.
+        """
+        return float(np.sum(self.mass * np.arange(len(self.mass)) * self.bin_width))
+
+    def min_likelihood_for_budget(self, max_nodes: float) -> float:
+        """
+        The lowest min_likelihood, at a bin boundary, for which the estimated
+            number of nodes is at most max_nodes. A time budget can be converted
+            to nodes using the wall_time and nodes_expanded of `EnumerationStats`.
+        """
+        within = np.cumsum(self.sizes) <= max_nodes
+        bins = int(np.argmin(within)) if not within.all() else len(within)
+        return -bins * self.bin_width
+
+    def recommended_chunk_size(
+        self, min_likelihood: float, max_overhead: float = 0.5
+    ) -> float:
+        """
+        The smallest chunk size, in whole bins, for which iterative deepening down
+            to min_likelihood is estimated to take at most (1 + max_overhead)
+            times the work of a single pass. Smaller chunks produce the first
+            programs sooner, at the cost of redoing work for each chunk.
+        """
+        bins = self._bins_above(min_likelihood)
+        work = np.cumsum(self.sizes[:bins])
+        if bins == 0 or work[-1] == 0:
+            return bins * self.bin_width
+        for chunk in range(1, bins + 1):
+            ends = np.minimum(np.arange(chunk, bins + chunk, chunk), bins)
+            if work[ends - 1].sum() <= (1 + max_overhead) * work[-1]:
+                return chunk * self.bin_width
+        return bins * self.bin_width
+
+
+def estimate_tree_dist_enumeration(
+    tree_dist: TreeDistribution, min_likelihood: float, bin_width: float = 0.1
+) -> EnumerationEstimate:
+    """
+    Estimate the number, total size, and probability mass of the programs with
+        likelihood above min_likelihood, binned by likelihood.
+
+    Args:
+        tree_dist: The distribution to estimate.
+        min_likelihood: The lowest likelihood to consider. Must be finite.
+        bin_width: The width of each bin, in nats.
+    """
+    assert min_likelihood > -float("inf"), "The budget must be finite"
+    assert bin_width > 0, bin_width
+    budget = max(0, math.ceil(-min_likelihood / bin_width) - 1)
+    preorder_mask = tree_dist.mask_constructor(tree_dist)
+    if not preorder_mask.can_cache:
+        preorder_mask = NoopPreorderMask(tree_dist)
+    preorder_mask.on_entry(0, 0)
+    counts, sizes, mass = hole_estimate(
+        tree_dist, ((0, 0),), preorder_mask, budget, bin_width, {}
+    )
+    return EnumerationEstimate(bin_width, counts, sizes, mass)
+
+
+def hole_estimate(
+    tree_dist: TreeDistribution,
+    hole: Tuple[Tuple[int, int], ...],
+    preorder_mask: PreorderMask,
+    budget: int,
+    bin_width: float,
+    memo: Dict[Tuple, Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]]],
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    The number of programs that fill the hole with each cost from 0 to budget, in
+        bins, and their total number of nodes and probability mass. Memoized in
+        memo, where None marks a computation in progress.
+    """
+    key = preorder_mask.cache_key(hole), hole, budget
+    empty = np.zeros((3, budget + 1))
+    if key in memo:
+        assert memo[key] is not None, "Cycle of productions with zero cost"
+        return memo[key]
+    memo[key] = None
+    result = empty
+    position = hole[-1][1]
+    for node, likelihood in tree_dist.masked_likelihoods(hole, preorder_mask).items():
+        cost = -likelihood / bin_width
+        if cost > budget:
+            continue
+        undo = preorder_mask.on_entry(position, node)
+        children = [
+            (hole + ((node, child),))[-tree_dist.limit :]
+            for child in range(tree_dist.symbols[node][1])
+        ]
+        if cost < 1 and any(
+            memo.get((preorder_mask.cache_key(child), child, budget), ()) is None
+            for child in children
+        ):
+            # this closes a cycle of productions with zero cost, so charge it a bin
+            if budget == 0:
+                undo()
+                continue
+            cost = 1
+        fraction = cost - math.floor(cost)
+        cost = math.floor(cost)
+        # counts, sizes, and mass of the combinations of the children
+        combined = np.zeros((3, budget - cost + 1))
+        combined[:, 0] = 1, 0, 1
+        for child in children:
+            child_estimate = hole_estimate(
+                tree_dist, child, preorder_mask, budget - cost, bin_width, memo
+            )
+            combined = combine_estimates(combined, child_estimate)
+        undo()
+        combined[1] += combined[0]
+        combined[2] *= np.exp(likelihood)
+        # split between the two nearest bins, so the rounding is unbiased
+        result[:, cost:] += (1 - fraction) * combined
+        result[:, cost + 1 :] += fraction * combined[:, :-1]
+    memo[key] = result
+    return result
+
+
+def combine_estimates(first: np.ndarray, second: np.ndarray) -> np.ndarray:
+    """
+    Combine the (counts, sizes, mass) estimates of two independent holes into the
+        estimate of filling both, truncated to the length of the first.
+    """
+    length = first.shape[1]
+
+    def convolve(a, b):
+        return np.convolve(a, b)[:length]
+
+    return np.array(
+        [
+            convolve(first[0], second[0]),
+            convolve(first[1], second[0]) + convolve(first[0], second[1]),
+            convolve(first[2], second[2]),
+        ]
+    )
@@ -1,7 +1,5 @@
 from types import NoneType
-from typing import Callable, Tuple, Union
-
-import numpy as np
+from typing import Any, Callable, Dict, List, Tuple, Union
 
 from neurosym.program_dist.tree_distribution.preorder_mask.preorder_mask import (
     PreorderMask,
@@ -10,12 +8,125 @@ from neurosym.program_dist.tree_distribution.tree_distribution import TreeDistri
 from neurosym.programs.s_expression import SExpression
 
 
+class LikelihoodCache:
+    """
+    Memo of subtree likelihoods, shared across the programs of a corpus.
+
+    Subtrees are hash-consed, so structurally equal subtrees get the same id no
+        matter which program they appear in. The likelihood of a subtree is keyed
+        by its id, its parents, and the mask's cache key, which together determine
+        it for masks that can cache.
+
+    Attributes:
+        hits: The number of subtrees whose likelihood was found in the memo.
+        misses: The number of subtrees whose likelihood was computed.
+        uncached_programs: The number of programs scored without the memo, as
+            their mask cannot cache.
+    """
+
+    def __init__(self):
+        self._subtree_ids: Dict[Tuple[str, Tuple[int, ...]], int] = {}
+        self._likelihoods: Dict[Any, float] = {}
+        self.hits = 0
+        self.misses = 0
+        self.uncached_programs = 0
+
+    def __len__(self):
+        return len(self._likelihoods)
+
+    @property
+    def num_subtrees(self) -> int:
+        """
+        The number of distinct subtrees seen.
+        """
+        return len(self._subtree_ids)
+
+    @property
+    def hit_rate(self) -> float:
+        """
+        The fraction of subtree lookups served from the memo.
+        """
+        return self.hits / max(self.hits + self.misses, 1)
+
+    def get(self, key: Any) -> Union[float, NoneType]:
+        """
+        Get the likelihood of the subtree at the given key, or None if it is not
+            memoized.
+        """
+        likelihood = self._likelihoods.get(key)
+        if likelihood is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return likelihood
+
+    def put(self, key: Any, likelihood: float):
+        """
+        Memoize the likelihood of the subtree at the given key.
+        """
+        self._likelihoods[key] = likelihood
+
+    def intern(self, program: SExpression) -> Dict[int, int]:
+        """
+        Hash-cons the subtrees of the program. Returns a map from the id() of each
+            node of the program to the id of its subtree.
+        """
+        ids = {}
+        for node in program.postorder:
+            key = node.symbol, tuple(ids[id(child)] for child in node.children)
+            ids[id(node)] = self._subtree_ids.setdefault(key, len(self._subtree_ids))
+        return ids
+
+
+def compute_corpus_likelihoods(
+    tree_dist: TreeDistribution,
+    programs: List[SExpression],
+    cache: Union[LikelihoodCache, NoneType] = None,
+) -> List[float]:
+    """
+    Compute the likelihood of each program, as with `compute_likelihood`, reusing
+        the likelihoods of subtrees shared across the corpus. Masks that cannot
+        cache fall back to scoring each program in full.
+
+    Args:
+        programs: The programs to score.
+        cache: The memo to use, which reports its effectiveness. Must only be
+            shared between calls with the same distribution. If None, a new one
+            is used.
+    """
+    cache = LikelihoodCache() if cache is None else cache
+    likelihoods = []
+    for program in programs:
+        preorder_mask = tree_dist.mask_constructor(tree_dist)
+        preorder_mask.on_entry(0, 0)
+        if not preorder_mask.can_cache:
+            cache.uncached_programs += 1
+            likelihoods.append(
+                compute_likelihood(tree_dist, program, ((0, 0),), preorder_mask, None)
+            )
+            continue
+        likelihoods.append(
+            compute_likelihood(
+                tree_dist,
+                program,
+                ((0, 0),),
+                preorder_mask,
+                None,
+                cache=cache,
+                subtree_ids=cache.intern(program),
+            )
+        )
+    return likelihoods
+
+
 def compute_likelihood(
     tree_dist: TreeDistribution,
     program: SExpression,
     parents: Tuple[Tuple[int, int], ...],
     preorder_mask: PreorderMask,
     tracker: Union[NoneType, Callable[[SExpression, float], NoneType]],
+    cache: Union[LikelihoodCache, NoneType] = None,
+    subtree_ids: Union[Dict[int, int], NoneType] = None,
 ):
     """
     Compute the likelihood of a program under a distribution.
@@ -23,6 +134,39 @@ def compute_likelihood(
     If `tracker` is not None, it will be called with each node and the likelihood
         of that node. This can be useful for debugging why a program has a certain
         likelihood.
+
+    If `cache` is not None, the likelihood of each subtree is memoized in it, and
+        subtree_ids must be the result of `cache.intern` on the whole program.
+        This requires the mask to cache, and cannot be used with a tracker.
+    """
+    if cache is None:
+        return compute_node_likelihood(
+            tree_dist, program, parents, preorder_mask, tracker
+        )
+    assert tracker is None, "Cannot track nodes whose likelihood is memoized"
+    key = subtree_ids[id(program)], parents, preorder_mask.cache_key(parents)
+    likelihood = cache.get(key)
+    if likelihood is None:
+        likelihood = compute_node_likelihood(
+            tree_dist, program, parents, preorder_mask, None, cache, subtree_ids
+        )
+        cache.put(key, likelihood)
+    return likelihood
+
+
+def compute_node_likelihood(
+    tree_dist: TreeDistribution,
+    program: SExpression,
+    parents: Tuple[Tuple[int, int], ...],
+    preorder_mask: PreorderMask,
+    tracker: Union[NoneType, Callable[[SExpression, float], NoneType]],
+    cache: Union[LikelihoodCache, NoneType] = None,
+    subtree_ids: Union[Dict[int, int], NoneType] = None,
+):
+    """
+    Compute the likelihood of a program under a distribution, without looking up
+        the program itself in the cache. Its children are computed with
+        `compute_likelihood`.
     """
     start_position = parents[-1][1]
     top_symbol = tree_dist.symbol_to_index[program.symbol]
@@ -44,6 +188,8 @@ def compute_likelihood(
             (parents + ((top_symbol, i),))[-tree_dist.limit :],
             preorder_mask=preorder_mask,
             tracker=tracker,
+            cache=cache,
+            subtree_ids=subtree_ids,
         )
         if likelihood == -float("inf") and tracker is None:
             return -float("inf")
@@ -54,15 +200,10 @@ def compute_likelihood(
 def symbol_likelihood(tree_dist, parents, preorder_mask, start_position, top_symbol):
     if parents not in tree_dist.likelihood_arrays:
         return -float("inf")
-    idx = tree_dist.index_within_distribution_list[parents].get(top_symbol, None)
-    if idx is None:
-        return -float("inf")
-    syms, log_probs = tree_dist.likelihood_arrays[parents]
-    mask = preorder_mask.compute_mask(start_position, syms)
-    if not mask[idx]:
-        return -float("inf")
-    denominator = np.logaddexp.reduce(log_probs[mask])
-    likelihood = log_probs[idx] - denominator
+    assert start_position == parents[-1][1]
+    likelihood = tree_dist.masked_likelihoods(parents, preorder_mask).get(
+        top_symbol, -float("inf")
+    )
 
     assert likelihood <= 0, f"Likelihood is {likelihood}, expected <= 0"
 
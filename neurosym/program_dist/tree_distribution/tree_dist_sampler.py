@@ -1,4 +1,5 @@
-from typing import Tuple
+from types import NoneType
+from typing import List, Tuple, Union
 
 import numpy as np
 
@@ -7,6 +8,7 @@ from neurosym.program_dist.tree_distribution.preorder_mask.preorder_mask import
 )
 from neurosym.program_dist.tree_distribution.tree_distribution import TreeDistribution
 from neurosym.programs.s_expression import SExpression
+from neurosym.utils.fork_pool import fork_pool, worker_state
 
 
 def attempt_to_sample_tree_dist(
@@ -83,5 +85,280 @@ def sample_tree_dist(
             continue
 
 
+def sample_tree_dist_depth_limited(
+    dist: TreeDistribution, rng: np.random.RandomState, depth_limit: int
+) -> SExpression:
+    """
+    Sample a program from the distribution, conditioned on the depth limit, with
+        the same distribution as `sample_tree_dist` but without rejection.
+
+    Each production is drawn with its probability weighted by the probability that
+        all of its children terminate within the remaining depth, which is
+        computed by dynamic programming in `depth_limited_cdf`. This requires the
+        mask to cache, and the mask state at each child of a node to not depend
+        on the earlier children, which holds for type masks.
+
+    Args:
+        rng: The random number generator to use.
+        depth_limit: The maximum depth of the program.
+    """
+    preorder_mask = dist.mask_constructor(dist)
+    assert preorder_mask.can_cache, "Exact depth limits require a cacheable mask"
+    preorder_mask.on_entry(0, 0)
+    hole = ((0, 0),)
+    _, cdf = depth_limited_cdf(dist, hole, preorder_mask, depth_limit)
+    if termination_probability(cdf) == 0:
+        raise ValueError(f"No programs within depth limit {depth_limit}")
+    root_sym, _ = dist.symbols[0]
+    return SExpression(
+        root_sym,
+        (_sample_depth_limited(dist, rng, hole, preorder_mask, depth_limit),),
+    )
+
+
+def _sample_depth_limited(
+    dist: TreeDistribution,
+    rng: np.random.RandomState,
+    hole: Tuple[Tuple[int, int], ...],
+    preorder_mask: PreorderMask,
+    depth: int,
+) -> SExpression:
+    syms, cdf = depth_limited_cdf(dist, hole, preorder_mask, depth)
+    node = syms[np.searchsorted(cdf, rng.random() * cdf[-1], side="right")]
+    symbol, arity = dist.symbols[node]
+    position = hole[-1][1]
+    preorder_mask.on_entry(position, node)
+    children = [None] * arity
+    for i in dist.ordering.order(node, arity):
+        children[i] = _sample_depth_limited(
+            dist, rng, (hole + ((node, i),))[-dist.limit :], preorder_mask, depth - 1
+        )
+    preorder_mask.on_exit(position, node)
+    return SExpression(symbol, tuple(children))
+
+
+def depth_limited_cdf(
+    dist: TreeDistribution,
+    hole: Tuple[Tuple[int, int], ...],
+    preorder_mask: PreorderMask,
+    depth: int,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    The symbols allowed at the hole, and the cumulative sums of the probabilities
+        of each symbol times the probability that all its children terminate
+        within depth - 1 levels. The last entry is then the probability that the
+        subtree at the hole terminates within depth levels, where a leaf has
+        depth 1.
+
+    Memoized on the distribution by the mask's cache key, the hole, and the depth.
+        Symbols with probability 0 of terminating are left in, so the symbols
+        may be drawn with a single inverse CDF lookup.
+    """
+    key = preorder_mask.cache_key(hole), hole, depth
+    result = dist.depth_limited_cache.get(key)
+    if result is not None:
+        return result
+    likelihoods = dist.masked_likelihoods(hole, preorder_mask)
+    syms = np.array(list(likelihoods), dtype=np.int64)
+    weights = np.exp(np.array(list(likelihoods.values()), dtype=np.float64))
+    position = hole[-1][1]
+    for i, node in enumerate(syms.tolist()):
+        arity = dist.symbols[node][1]
+        if depth <= 0 or (arity and depth == 1):
+            weights[i] = 0
+            continue
+        if not arity:
+            continue
+        undo = preorder_mask.on_entry(position, node)
+        for child in range(arity):
+            child_hole = (hole + ((node, child),))[-dist.limit :]
+            weights[i] *= termination_probability(
+                depth_limited_cdf(dist, child_hole, preorder_mask, depth - 1)[1]
+            )
+        undo()
+    result = syms, np.cumsum(weights)
+    dist.depth_limited_cache[key] = result
+    return result
+
+
+def termination_probability(cdf: np.ndarray) -> float:
+    """
+    The probability that the subtree terminates, given the CDF from
+        `depth_limited_cdf`.
+    """
+    return cdf[-1] if len(cdf) else 0.0
+
+
+def sample_tree_dist_batch(
+    dist: TreeDistribution, n: int, rng: np.random.RandomState, depth_limit
+) -> List[SExpression]:
+    """
+    Sample n programs from the distribution, conditioned on the depth limit, with
+        the same distribution as `sample_tree_dist`.
+
+    All the programs are advanced together, one hole per program per round. The
+        open holes of each round are grouped by their parents and the state of
+        their preorder mask, and each group gets a single vectorized draw by
+        inverse CDF. For masks that can cache, the state is the mask's cache key,
+        so programs in the same state share the masked distribution, which is
+        computed once across all rounds. Programs that get too deep are restarted.
+
+    Args:
+        rng: The random number generator to use.
+        depth_limit: The maximum depth of the program.
+    """
+    results = [None] * n
+    partials = {i: _start_partial_program(dist) for i in range(n)}
+    cdfs = {}
+    while partials:
+        groups = {}
+        round_cdfs = {}
+        for i, (preorder_mask, stack) in partials.items():
+            parents, node, order, index, *_ = stack[-1]
+            hole = (parents + ((node, order[index]),))[-dist.limit :]
+            if preorder_mask.can_cache:
+                key = preorder_mask.cache_key(hole), hole
+                target = cdfs
+            else:
+                key = i
+                target = round_cdfs
+            if key not in target:
+                target[key] = _masked_cdf(dist, hole, preorder_mask)
+            groups.setdefault(key, (target[key], []))[1].append(i)
+        for (syms, cdf), indices in groups.values():
+            draws = np.searchsorted(
+                cdf, rng.random(len(indices)) * cdf[-1], side="right"
+            )
+            draws = syms[np.minimum(draws, len(syms) - 1)].tolist()
+            for i, node in zip(indices, draws):
+                preorder_mask, stack = partials[i]
+                if len(stack) > depth_limit:
+                    partials[i] = _start_partial_program(dist)
+                    continue
+                program = _fill_hole(dist, preorder_mask, stack, node)
+                if program is not None:
+                    results[i] = program
+                    del partials[i]
+    return results
+
+
+def _start_partial_program(
+    dist: TreeDistribution,
+) -> Tuple[PreorderMask, List[list]]:
+    """
+    A fresh partial program, as its preorder mask and its stack of nodes with
+        unfilled children, each as [parents, node, order, index of the child being
+        filled in the order, children].
+    """
+    preorder_mask = dist.mask_constructor(dist)
+    preorder_mask.on_entry(0, 0)
+    arity = dist.symbols[0][1]
+    return preorder_mask, [[(), 0, dist.ordering.order(0, arity), 0, [None] * arity]]
+
+
+def _masked_cdf(
+    dist: TreeDistribution,
+    hole: Tuple[Tuple[int, int], ...],
+    preorder_mask: PreorderMask,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    The symbols allowed at the hole, and the cumulative sums of their probabilities.
+    """
+    likelihoods = dist.masked_likelihoods(hole, preorder_mask)
+    if not likelihoods:
+        raise ValueError(f"No valid productions for {hole}")
+    syms = np.array(list(likelihoods), dtype=np.int64)
+    return syms, np.cumsum(np.exp(list(likelihoods.values())))
+
+
+def _fill_hole(
+    dist: TreeDistribution, preorder_mask: PreorderMask, stack: List[list], node: int
+) -> SExpression:
+    """
+    Fill the hole at the top of the stack with the given node, and close off every
+        node that is complete as a result. Returns the program if it is complete,
+        otherwise None.
+    """
+    parents, parent, order, index, _ = stack[-1]
+    hole = (parents + ((parent, order[index]),))[-dist.limit :]
+    preorder_mask.on_entry(order[index], node)
+    arity = dist.symbols[node][1]
+    stack.append([hole, node, dist.ordering.order(node, arity), 0, [None] * arity])
+    while stack[-1][3] == len(stack[-1][2]):
+        _, node, _, _, children = stack.pop()
+        program = SExpression(dist.symbols[node][0], tuple(children))
+        if not stack:
+            return program
+        _, _, order, index, siblings = stack[-1]
+        preorder_mask.on_exit(order[index], node)
+        siblings[order[index]] = program
+        stack[-1][3] += 1
+    return None
+
+
+def sample_tree_dist_parallel(
+    dist: TreeDistribution,
+    n: int,
+    seed: Union[int, np.random.SeedSequence],
+    *,
+    n_workers: Union[int, NoneType] = None,
+    depth_limit=float("inf"),
+    exact_depth_limit: bool = False,
+    block_size: int = 1000,
+) -> List[SExpression]:
+    """
+    Sample n programs reproducibly, in a pool of n_workers processes.
+
+    The samples are split into blocks of block_size, and block i is sampled with
+        its own random number generator, seeded by the i-th child spawned from the
+        seed sequence. The blocks do not depend on the number of workers, so the
+        result is the same for any n_workers, including None, which samples in
+        this process. The distribution is sent to each worker once, through a
+        `fork_pool`.
+
+    Args:
+        seed: The seed, or the seed sequence to spawn the block seeds from.
+        depth_limit: The maximum depth of the program.
+        exact_depth_limit: Whether to use `sample_tree_dist_depth_limited`
+            instead of rejection sampling when depth_limit is finite.
+        block_size: The number of samples that share a random number generator.
+    """
+    assert block_size >= 1, block_size
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    sizes = [min(block_size, n - start) for start in range(0, n, block_size)]
+    tasks = [
+        (child, size, depth_limit, exact_depth_limit)
+        for child, size in zip(seed.spawn(len(sizes)), sizes)
+    ]
+    if n_workers is None:
+        blocks = [sample_block(dist, task) for task in tasks]
+    else:
+        with fork_pool(n_workers, dist) as pool:
+            blocks = pool.map(_sample_block_in_worker, tasks)
+    return [program for block in blocks for program in block]
+
+
+def _sample_block_in_worker(
+    task: Tuple[np.random.SeedSequence, int, float, bool]
+) -> List[SExpression]:
+    return sample_block(worker_state(), task)
+
+
+def sample_block(
+    dist: TreeDistribution, task: Tuple[np.random.SeedSequence, int, float, bool]
+) -> List[SExpression]:
+    """
+    Sample a block of programs, given (seed, size, depth_limit, exact_depth_limit).
+    """
+    seed, size, depth_limit, exact_depth_limit = task
+    rng = np.random.RandomState(np.random.MT19937(seed))
+    if exact_depth_limit and depth_limit < float("inf"):
+        return [
+            sample_tree_dist_depth_limited(dist, rng, depth_limit) for _ in range(size)
+        ]
+    return [sample_tree_dist(dist, rng, depth_limit) for _ in range(size)]
+
+
 class TooDeepError(Exception):
     pass
@@ -1,8 +1,9 @@
 from abc import abstractmethod
+from collections.abc import Mapping
 from dataclasses import dataclass
 from functools import cached_property
 from types import NoneType
-from typing import Callable, Dict, List, Tuple, Union
+from typing import Any, Callable, Dict, List, Tuple, Union
 
 import numpy as np
 
@@ -18,6 +19,185 @@ from neurosym.program_dist.tree_distribution.preorder_mask.preorder_mask import
 )
 from neurosym.programs.s_expression import SExpression
 
+Context = Tuple[Tuple[int, int], ...]
+
+
+@dataclass
+class CSRDistribution(Mapping):
+    """
+    Compact storage for the distribution of a `TreeDistribution`. Each context is
+        interned to an integer id (its index in `contexts`), and the productions for
+        context i are `symbol_ids[offsets[i]:offsets[i + 1]]`, with log probabilities
+        `log_probs[offsets[i]:offsets[i + 1]]`.
+
+    Acts as a read-only mapping from context to a list of (production index,
+        likelihood) pairs, so it can be used anywhere the dictionary form can.
+
+    If backoff is True, a context that is not present is looked up by its longest
+        present suffix instead, i.e., by dropping the most distant ancestors.
+    """
+
+    contexts: List[Context]
+    offsets: np.ndarray
+    symbol_ids: np.ndarray
+    log_probs: np.ndarray
+    backoff: bool = False
+
+    def __post_init__(self):
+        assert len(self.offsets) == len(self.contexts) + 1
+        assert len(self.symbol_ids) == len(self.log_probs) == self.offsets[-1]
+        for arr in self.offsets, self.symbol_ids, self.log_probs:
+            arr.flags.writeable = False
+
+    @classmethod
+    def from_dict(
+        cls, distribution: Dict[Context, List[Tuple[int, float]]]
+    ) -> "CSRDistribution":
+        """
+        Convert a distribution in dictionary form to CSR form.
+        """
+        contexts = list(distribution)
+        entries = [x for context in contexts for x in distribution[context]]
+        return cls(
+            contexts=contexts,
+            offsets=np.cumsum([0] + [len(distribution[c]) for c in contexts]),
+            symbol_ids=np.array([sym for sym, _ in entries], dtype=np.int64),
+            log_probs=np.array([log_prob for _, log_prob in entries], dtype=np.float64),
+        )
+
+    @classmethod
+    def from_entries(
+        cls,
+        contexts: List[Context],
+        context_ids: np.ndarray,
+        symbol_ids: np.ndarray,
+        log_probs: np.ndarray,
+        *,
+        backoff: bool = False,
+    ) -> "CSRDistribution":
+        """
+        Produce a distribution from the given entries, where each entry is a
+            production with the given symbol and log probability in the context
+            contexts[context_id]. Contexts with no entries are dropped.
+
+        Within each context, productions are sorted by decreasing likelihood, with
+            ties remaining in the order they were given in.
+        """
+        # lexsort is stable, so ties remain in the order they were given in.
+        order = np.lexsort((-log_probs, context_ids))
+        context_counts = np.bincount(context_ids, minlength=len(contexts))
+        present = context_counts > 0
+        return cls(
+            contexts=[c for c, p in zip(contexts, present) if p],
+            offsets=np.concatenate([[0], np.cumsum(context_counts[present])]),
+            symbol_ids=symbol_ids[order],
+            log_probs=log_probs[order].astype(np.float64),
+            backoff=backoff,
+        )
+
+    def with_log_probs(self, log_probs: np.ndarray) -> "CSRDistribution":
+        """
+        A distribution with the same contexts and productions, in the same order,
+            but with the given log probabilities. The arrays and the context index
+            are shared with this distribution rather than copied.
+        """
+        assert log_probs.shape == self.log_probs.shape, log_probs.shape
+        result = CSRDistribution(
+            contexts=self.contexts,
+            offsets=self.offsets,
+            symbol_ids=self.symbol_ids,
+            log_probs=log_probs,
+            backoff=self.backoff,
+        )
+        result.__dict__["context_ids"] = self.context_ids
+        return result
+
+    @cached_property
+    def context_ids(self) -> Dict[Context, int]:
+        return {context: i for i, context in enumerate(self.contexts)}
+
+    def context_id(self, context: Context) -> Union[int, NoneType]:
+        """
+        The id of the given context, or of the context it backs off to. Returns None
+            if there is no such context.
+        """
+        i = self.context_ids.get(context)
+        if i is None and self.backoff:
+            for start in range(1, len(context)):
+                i = self.context_ids.get(context[start:])
+                if i is not None:
+                    break
+        return i
+
+    @cached_property
+    def probs(self) -> np.ndarray:
+        probs = np.exp(self.log_probs)
+        probs.flags.writeable = False
+        return probs
+
+    def span(self, context: Context) -> slice:
+        """
+        The slice of the flat arrays that corresponds to the given context.
+        """
+        i = self.context_id(context)
+        if i is None:
+            raise KeyError(context)
+        return slice(self.offsets[i], self.offsets[i + 1])
+
+    def __getitem__(self, context: Context) -> List[Tuple[int, float]]:
+        span = self.span(context)
+        return list(zip(self.symbol_ids[span].tolist(), self.log_probs[span].tolist()))
+
+    def __iter__(self):
+        return iter(self.contexts)
+
+    def __len__(self):
+        return len(self.contexts)
+
+    def __contains__(self, context):
+        return self.context_id(context) is not None
+
+    def __eq__(self, other):
+        # the generated __eq__ would compare the arrays elementwise
+        if not isinstance(other, CSRDistribution):
+            return NotImplemented
+        return (
+            self.contexts == other.contexts
+            and self.backoff == other.backoff
+            and np.array_equal(self.offsets, other.offsets)
+            and np.array_equal(self.symbol_ids, other.symbol_ids)
+            and np.array_equal(self.log_probs, other.log_probs)
+        )
+
+
+class _ContextView(Mapping):
+    """
+    Read-only mapping from context to a value computed from the context's span
+        of a `CSRDistribution`. Values are computed on demand, and optionally memoized.
+    """
+
+    def __init__(self, csr: CSRDistribution, compute, memoize=False):
+        self._csr = csr
+        self._compute = compute
+        self._memo = {} if memoize else None
+
+    def __getitem__(self, context):
+        if self._memo is not None and context in self._memo:
+            return self._memo[context]
+        result = self._compute(self._csr.span(context))
+        if self._memo is not None:
+            self._memo[context] = result
+        return result
+
+    def __iter__(self):
+        return iter(self._csr)
+
+    def __len__(self):
+        return len(self._csr)
+
+    def __contains__(self, context):
+        return context in self._csr
+
 
 @dataclass
 class TreeDistribution:
@@ -33,7 +213,9 @@ class TreeDistribution:
     #        which is the path to the current node, with the
     #        most immediate ancestor at the end.
     # output: list of (production index, likelihood) pairs
-    distribution: Dict[Tuple[Tuple[int, int], ...], List[Tuple[int, float]]]
+    # Can be provided either as a dictionary or in the more compact CSRDistribution
+    #   form, in which case the accessors below are views into its arrays.
+    distribution: Union[Dict[Context, List[Tuple[int, float]]], CSRDistribution]
     # production index -> (symbol, arity). at 0 should be the root.
     symbols: List[Tuple[str, int]]
     # Preorder mask constructor
@@ -41,6 +223,15 @@ class TreeDistribution:
     # Node ordering
     node_ordering: Callable[["TreeDistribution"], NodeOrdering]
 
+    @cached_property
+    def csr(self) -> CSRDistribution:
+        """
+        The distribution in CSR form, converting it if necessary.
+        """
+        if isinstance(self.distribution, CSRDistribution):
+            return self.distribution
+        return CSRDistribution.from_dict(self.distribution)
+
     @cached_property
     def symbol_to_index(self) -> Dict[str, int]:
         return {symbol: i for i, (symbol, _) in enumerate(self.symbols)}
@@ -48,20 +239,41 @@ class TreeDistribution:
     @cached_property
     def index_within_distribution_list(
         self,
-    ) -> Dict[Tuple[Tuple[int, int], ...], Dict[int, int]]:
+    ) -> Mapping[Context, Dict[int, int]]:
+        if isinstance(self.distribution, CSRDistribution):
+            symbol_ids = self.distribution.symbol_ids
+            return _ContextView(
+                self.distribution,
+                lambda span: {x: i for i, x in enumerate(symbol_ids[span].tolist())},
+                memoize=True,
+            )
         return {
             k: {x: i for i, (x, _) in enumerate(v)}
             for k, v in self.distribution.items()
         }
 
     @cached_property
-    def distribution_dict(self) -> Dict[Tuple[Tuple[int, int], ...], Dict[int, float]]:
+    def distribution_dict(self) -> Mapping[Context, Dict[int, float]]:
+        if isinstance(self.distribution, CSRDistribution):
+            csr = self.distribution
+            return _ContextView(
+                csr,
+                lambda span: dict(
+                    zip(csr.symbol_ids[span].tolist(), csr.log_probs[span].tolist())
+                ),
+                memoize=True,
+            )
         return {k: dict(v) for k, v in self.distribution.items()}
 
     @cached_property
     def likelihood_arrays(
         self,
-    ) -> Dict[Tuple[Tuple[int, int], ...], Tuple[np.ndarray, np.ndarray]]:
+    ) -> Mapping[Context, Tuple[np.ndarray, np.ndarray]]:
+        if isinstance(self.distribution, CSRDistribution):
+            csr = self.distribution
+            return _ContextView(
+                csr, lambda span: (csr.symbol_ids[span], csr.log_probs[span])
+            )
         return {
             k: (
                 np.array([x[0] for x in v]),
@@ -73,7 +285,12 @@ class TreeDistribution:
     @cached_property
     def sampling_dict_arrays(
         self,
-    ) -> Dict[Tuple[Tuple[int, int], ...], Tuple[np.ndarray, np.ndarray]]:
+    ) -> Mapping[Context, Tuple[np.ndarray, np.ndarray]]:
+        if isinstance(self.distribution, CSRDistribution):
+            csr = self.distribution
+            return _ContextView(
+                csr, lambda span: (csr.symbol_ids[span], csr.probs[span])
+            )
         return {
             k: (syms, np.exp(log_probs))
             for k, (syms, log_probs) in self.likelihood_arrays.items()
@@ -83,6 +300,51 @@ class TreeDistribution:
     def ordering(self) -> NodeOrdering:
         return self.node_ordering(self)
 
+    @cached_property
+    def masked_likelihood_cache(self) -> Dict[Any, Dict[int, float]]:
+        """
+        Memo for `masked_likelihoods`, keyed by the mask's cache key and the parents.
+        """
+        return {}
+
+    @cached_property
+    def depth_limited_cache(self) -> Dict[Any, Tuple[np.ndarray, np.ndarray]]:
+        """
+        Memo for `depth_limited_cdf` in `tree_dist_sampler`, keyed by the mask's
+            cache key, the parents, and the depth.
+        """
+        return {}
+
+    def masked_likelihoods(
+        self, parents: Context, preorder_mask: PreorderMask
+    ) -> Dict[int, float]:
+        """
+        Map from each symbol the preorder mask allows at the hole with the given
+            parents to its log probability, renormalized over the allowed symbols,
+            in the order of `likelihood_arrays`.
+
+        If the mask can cache, the result only depends on its cache key and the
+            parents, so it is memoized by them, and the mask is not recomputed.
+            The result should not be modified.
+        """
+        key = None
+        if preorder_mask.can_cache:
+            key = preorder_mask.cache_key(parents), parents
+            result = self.masked_likelihood_cache.get(key)
+            if result is not None:
+                return result
+        syms, log_probs = self.likelihood_arrays[parents]
+        mask = preorder_mask.compute_mask(parents[-1][1], syms)
+        # productions of probability zero may be present, see `with_log_probs`
+        mask = mask & (log_probs > -np.inf)
+        syms, log_probs = syms[mask], log_probs[mask]
+        if len(log_probs):
+            log_probs = log_probs - np.logaddexp.reduce(log_probs)
+        result = dict(zip(syms.tolist(), log_probs.tolist()))
+        if key is not None:
+            self.masked_likelihood_cache[key] = result
+        return result
+
 
 class TreeProgramDistributionFamily(ProgramDistributionFamily):
     """
@@ -129,7 +391,22 @@ class TreeProgramDistributionFamily(ProgramDistributionFamily):
         *,
         min_likelihood: float = float("-inf"),
         chunk_size: float = DEFAULT_CHUNK_SIZE,
+        n_workers: Union[int, NoneType] = None,
+        cursor=None,
+        adaptive_chunk_size: bool = False,
+        stats=None,
+        stats_callback=None,
+        max_depth: float = float("inf"),
+        max_size: float = float("inf"),
     ):
+        """
+        See `ProgramDistributionFamily.enumerate`. If n_workers is provided, the
+            enumeration is split across that many processes, see
+            `enumerate_tree_dist_parallel`. If cursor is provided, the enumeration
+            resumes from that `EnumerationCursor`, and updates it as it proceeds.
+            See `enumerate_tree_dist` for adaptive_chunk_size, stats,
+            stats_callback, max_depth, and max_size.
+        """
         # pylint: disable=cyclic-import
         from neurosym.program_dist.tree_distribution.tree_dist_enumerator import (
             enumerate_tree_dist,
@@ -138,7 +415,59 @@ class TreeProgramDistributionFamily(ProgramDistributionFamily):
         tree_dist = self.tree_distribution(dist)
 
         return enumerate_tree_dist(
-            tree_dist, min_likelihood=min_likelihood, chunk_size=chunk_size
+            tree_dist,
+            min_likelihood=min_likelihood,
+            chunk_size=chunk_size,
+            n_workers=n_workers,
+            cursor=cursor,
+            adaptive_chunk_size=adaptive_chunk_size,
+            stats=stats,
+            stats_callback=stats_callback,
+            max_depth=max_depth,
+            max_size=max_size,
+        )
+
+    def enumerate_best_first(
+        self,
+        dist: ProgramDistribution,
+        *,
+        min_likelihood: float = float("-inf"),
+        max_frontier_size: Union[int, NoneType] = None,
+    ):
+        """
+        Enumerate the programs in exact non-increasing order of likelihood. See
+            `enumerate_tree_dist_best_first`.
+        """
+        # pylint: disable=cyclic-import
+        from neurosym.program_dist.tree_distribution.tree_dist_best_first_enumerator import (
+            enumerate_tree_dist_best_first,
+        )
+
+        return enumerate_tree_dist_best_first(
+            self.tree_distribution(dist),
+            min_likelihood=min_likelihood,
+            max_frontier_size=max_frontier_size,
+        )
+
+    def estimate_enumeration(
+        self,
+        dist: ProgramDistribution,
+        *,
+        min_likelihood: float,
+        bin_width: float = 0.1,
+    ):
+        """
+        Estimate the number, total size, and probability mass of the programs that
+            `enumerate` would produce with the given min_likelihood, without
+            enumerating them. See `estimate_tree_dist_enumeration`.
+        """
+        # pylint: disable=cyclic-import
+        from neurosym.program_dist.tree_distribution.tree_dist_estimator import (
+            estimate_tree_dist_enumeration,
+        )
+
+        return estimate_tree_dist_enumeration(
+            self.tree_distribution(dist), min_likelihood, bin_width
         )
 
     def compute_likelihood(
@@ -158,6 +487,28 @@ class TreeProgramDistributionFamily(ProgramDistributionFamily):
         preorder_mask.on_entry(0, 0)
         return compute_likelihood(dist, program, ((0, 0),), preorder_mask, tracker)
 
+    def compute_likelihoods(
+        self,
+        dist: ProgramDistribution,
+        programs: List[SExpression],
+        *,
+        cache=None,
+    ) -> List[float]:
+        """
+        Compute the likelihood of each program under a distribution, memoizing the
+            likelihoods of subtrees shared across the programs. If cache is
+            provided, it is the `LikelihoodCache` to use, and reports how
+            effective the memo was. See `compute_corpus_likelihoods`.
+        """
+        # pylint: disable=cyclic-import
+        from .tree_dist_likelihood_computer import compute_corpus_likelihoods
+
+        return compute_corpus_likelihoods(
+            self.tree_distribution(dist),
+            programs,
+            cache,
+        )
+
     def compute_likelihood_per_node(
         self,
         dist: ProgramDistribution,
@@ -181,15 +532,92 @@ class TreeProgramDistributionFamily(ProgramDistributionFamily):
         rng: np.random.RandomState,
         *,
         depth_limit=float("inf"),
+        exact_depth_limit: bool = False,
     ) -> SExpression:
+        """
+        See `ProgramDistributionFamily.sample`. By default, programs that exceed the
+            depth limit are rejected and resampled. If exact_depth_limit is True,
+            the program is instead sampled directly from the depth-limited
+            distribution, see `sample_tree_dist_depth_limited`.
+        """
         # pylint: disable=cyclic-import
 
         from neurosym.program_dist.tree_distribution.tree_dist_sampler import (
             sample_tree_dist,
+            sample_tree_dist_depth_limited,
         )
 
         tree_dist = self.tree_distribution(dist)
-        element = sample_tree_dist(tree_dist, rng, depth_limit=depth_limit)
+        if exact_depth_limit and depth_limit < float("inf"):
+            element = sample_tree_dist_depth_limited(tree_dist, rng, depth_limit)
+        else:
+            element = sample_tree_dist(tree_dist, rng, depth_limit=depth_limit)
         assert element.symbol == ROOT_SYMBOL
         [element] = element.children
         return element
+
+    def sample_parallel(
+        self,
+        dist: ProgramDistribution,
+        n: int,
+        seed: Union[int, np.random.SeedSequence],
+        *,
+        n_workers: Union[int, NoneType] = None,
+        depth_limit=float("inf"),
+        exact_depth_limit: bool = False,
+        block_size: int = 1000,
+    ) -> List[SExpression]:
+        """
+        Samples n programs as with `sample`, split across n_workers processes. The
+            result only depends on the seed and block_size, not on n_workers. See
+            `sample_tree_dist_parallel`.
+        """
+        # pylint: disable=cyclic-import
+        from neurosym.program_dist.tree_distribution.tree_dist_sampler import (
+            sample_tree_dist_parallel,
+        )
+
+        elements = sample_tree_dist_parallel(
+            self.tree_distribution(dist),
+            n,
+            seed,
+            n_workers=n_workers,
+            depth_limit=depth_limit,
+            exact_depth_limit=exact_depth_limit,
+            block_size=block_size,
+        )
+        return strip_root(elements)
+
+    def sample_batch(
+        self,
+        dist: ProgramDistribution,
+        n: int,
+        rng: np.random.RandomState,
+        *,
+        depth_limit=float("inf"),
+    ) -> List[SExpression]:
+        """
+        Samples n programs from this distribution, with the same distribution as
+            `sample`, but advancing all of them together. See
+            `sample_tree_dist_batch`.
+        """
+        # pylint: disable=cyclic-import
+        from neurosym.program_dist.tree_distribution.tree_dist_sampler import (
+            sample_tree_dist_batch,
+        )
+
+        tree_dist = self.tree_distribution(dist)
+        elements = sample_tree_dist_batch(tree_dist, n, rng, depth_limit=depth_limit)
+        return strip_root(elements)
+
+
+def strip_root(elements: List[SExpression]) -> List[SExpression]:
+    """
+    The programs below the root symbol of each of the given sampled trees.
+    """
+    programs = []
+    for element in elements:
+        assert element.symbol == ROOT_SYMBOL
+        [program] = element.children
+        programs.append(program)
+    return programs
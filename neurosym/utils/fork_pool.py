@@ -0,0 +1,34 @@
+import multiprocessing
+import multiprocessing.pool
+from typing import Any
+
+_worker_state = None
+
+
+def fork_pool(n_workers: int, state: Any) -> multiprocessing.pool.Pool:
+    """
+    A pool of n_workers processes, each of which can access state through
+        `worker_state`. The state is handed to each worker once, when it starts,
+        rather than with every task.
+
+    This uses the "fork" start method, so the state does not need to be
+        picklable, which matters for tree distributions, as their preorder mask
+        constructors are not generally picklable. Each worker gets its own copy
+        of the state, so mutating it (e.g., filling a cache) is local to the
+        worker.
+    """
+    return multiprocessing.get_context("fork").Pool(
+        n_workers, initializer=_initialize_worker, initargs=(state,)
+    )
+
+
+def worker_state() -> Any:
+    """
+    The state of the `fork_pool` this worker belongs to.
+    """
+    return _worker_state
+
+
+def _initialize_worker(state: Any):
+    global _worker_state  # pylint: disable=global-statement
+    _worker_state = state
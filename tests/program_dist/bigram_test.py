@@ -1,3 +1,5 @@
+import os
+import tempfile
 import unittest
 from fractions import Fraction
 
@@ -6,6 +8,11 @@ import torch
 from parameterized import parameterized
 
 import neurosym as ns
+from neurosym.program_dist.bigram import (
+    BigramCountAccumulator,
+    BigramProgramDistribution,
+    accumulate_counts,
+)
 from tests.utils import assertDSL
 
 from .utils import (
@@ -13,6 +20,7 @@ from .utils import (
     ChildrenInOrderMask,
     ProbabilityTester,
     enumerate_dsl,
+    program_depth,
 )
 
 
@@ -117,6 +125,113 @@ class BigramSamplerTest(ProbabilityTester):
             )
 
 
+class BigramBatchSamplerTest(ProbabilityTester):
+    def test_uniform_sample_counts(self):
+        n = 10_000
+        samples = fam.sample_batch(fam.uniform(), n, np.random.RandomState(0))
+        samples = [ns.render_s_expression(x) for x in samples]
+        self.assertBinomial(n, 1 / 3, 0.015, samples.count("(1)"))
+        self.assertBinomial(n, 1 / 27, 0.015, samples.count("(+ (1) (2))"))
+
+    def test_sample_with_variables(self):
+        n = 20000
+        samples = fam_with_vars.sample_batch(
+            fam_with_vars.uniform(), n, np.random.RandomState(0)
+        )
+        samples = [ns.render_s_expression(x) for x in samples]
+        self.assertBinomial(n, 1 / 4, 0.01, samples.count("(1)"))
+        self.assertBinomial(n, 1 / 80, 0.01, samples.count("(call (lam ($0_0)) (1))"))
+
+    def test_sample_with_ordering(self):
+        samples = fam_with_ordering_231.sample_batch(
+            fam_with_ordering_231.uniform(), 1000, np.random.RandomState(0)
+        )
+        samples = {ns.render_s_expression(x) for x in samples}
+        self.assertEqual(samples, {"(+ (2) (3) (1))"})
+
+    def test_depth_limit(self):
+        n = 10_000
+        samples = fam.sample_batch(
+            fam.uniform(), n, np.random.RandomState(0), depth_limit=2
+        )
+        samples = [ns.render_s_expression(x) for x in samples]
+        self.assertEqual(
+            set(samples),
+            {"(1)", "(2)"} | {f"(+ ({a}) ({b}))" for a in "12" for b in "12"},
+        )
+        # conditioned on the depth limit, the leaves have probability 1/3 / (2/3 + 4/27)
+        self.assertBinomial(n, 9 / 22, 0.015, samples.count("(1)"))
+
+
+class BigramExactDepthLimitSamplerTest(ProbabilityTester):
+    def sample(self, family, n, depth_limit):
+        dist = family.uniform()
+        return [
+            ns.render_s_expression(
+                family.sample(
+                    dist,
+                    np.random.RandomState(i),
+                    depth_limit=depth_limit,
+                    exact_depth_limit=True,
+                )
+            )
+            for i in range(n)
+        ]
+
+    def test_uniform_sample_counts(self):
+        n = 10_000
+        samples = self.sample(fam, n, depth_limit=2)
+        self.assertEqual(
+            set(samples),
+            {"(1)", "(2)"} | {f"(+ ({a}) ({b}))" for a in "12" for b in "12"},
+        )
+        self.assertBinomial(n, 9 / 22, 0.015, samples.count("(1)"))
+        self.assertBinomial(n, 1 / 22, 0.015, samples.count("(+ (1) (2))"))
+
+    def test_sample_with_variables(self):
+        for program in self.sample(fam_with_vars, 1000, depth_limit=3):
+            program = ns.parse_s_expression(program)
+            self.assertLessEqual(program_depth(program), 3)
+
+    def test_no_programs(self):
+        with self.assertRaises(ValueError):
+            self.sample(fam, 1, depth_limit=0)
+
+
+class BigramParallelSamplerTest(ProbabilityTester):
+    def sample(self, family, n, seed, **kwargs):
+        return [
+            ns.render_s_expression(program)
+            for program in family.sample_parallel(
+                family.uniform(), n, seed, block_size=100, **kwargs
+            )
+        ]
+
+    def test_independent_of_workers(self):
+        expected = self.sample(fam_with_vars, 450, 0, depth_limit=4)
+        self.assertEqual(len(expected), 450)
+        for n_workers in 1, 2, 3:
+            self.assertEqual(
+                self.sample(fam_with_vars, 450, 0, depth_limit=4, n_workers=n_workers),
+                expected,
+            )
+        self.assertNotEqual(self.sample(fam_with_vars, 450, 1, depth_limit=4), expected)
+
+    def test_exact_depth_limit(self):
+        self.assertEqual(
+            self.sample(fam, 250, 0, depth_limit=2, exact_depth_limit=True),
+            self.sample(
+                fam, 250, 0, depth_limit=2, exact_depth_limit=True, n_workers=2
+            ),
+        )
+
+    def test_uniform_sample_counts(self):
+        n = 10_000
+        samples = self.sample(fam, n, 0, n_workers=2)
+        self.assertBinomial(n, 1 / 3, 0.015, samples.count("(1)"))
+        self.assertBinomial(n, 1 / 27, 0.015, samples.count("(+ (1) (2))"))
+
+
 class BigramParameterShapeTest(unittest.TestCase):
     def test_shape(self):
         self.assertEqual(fam.parameters_shape(), (4, 2, 4))
@@ -414,6 +529,455 @@ class BigramCountProgramsTest(unittest.TestCase):
         )
 
 
+class BigramTreeDistributionTest(unittest.TestCase):
+    def test_matches_sorted_dict(self):
+        dist = fam_with_vars.fit_distribution(
+            [ns.parse_s_expression("(call (lam (+ ($0_0) (1))) (2))")]
+        ).bound_minimum_likelihood(0.01)
+        expected = {}
+        for parent, position, child in zip(*np.where(dist.distribution > 0)):
+            expected.setdefault(((parent, position),), []).append(
+                (child, np.log(dist.distribution[parent, position, child]))
+            )
+        expected = {k: sorted(v, key=lambda x: -x[1]) for k, v in expected.items()}
+        tree_dist = fam_with_vars.tree_distribution(dist)
+        self.assertIsInstance(tree_dist.distribution, ns.CSRDistribution)
+        self.assertEqual(dict(tree_dist.distribution), expected)
+
+    def test_batch_matches_individual(self):
+        parameters = torch.randn(
+            (5, *fam_with_vars.parameters_shape()),
+            generator=torch.Generator().manual_seed(0),
+        )
+        parameters[1, 0, 0] = -float("inf")
+        dist = fam_with_vars.with_parameters(parameters)
+        # put weight outside of the valid productions
+        dist.distribution_batch[2, 0, 1, 0] = 0.5
+        tree_dists = fam_with_vars.tree_distribution_batch(dist)
+        self.assertEqual(len(tree_dists), len(dist))
+        for i, tree_dist in enumerate(tree_dists):
+            expected = fam_with_vars.compute_tree_distribution(dist[i])
+            # zero probability productions are kept, and the order may differ
+            actual = {
+                context: dict(p for p in productions if p[1] > -np.inf)
+                for context, productions in tree_dist.distribution.items()
+            }
+            self.assertEqual(
+                {context: dict(ps) for context, ps in expected.distribution.items()},
+                {context: ps for context, ps in actual.items() if ps},
+            )
+            if ((0, 0),) not in expected.distribution:
+                # no programs at all
+                continue
+            programs = [
+                {
+                    (ns.render_s_expression(program), round(likelihood, 6))
+                    for program, likelihood in ns.enumerate_tree_dist(
+                        t, min_likelihood=-6
+                    )
+                }
+                for t in (tree_dist, expected)
+            ]
+            self.assertEqual(programs[0], programs[1])
+
+    def test_batch_shares_structure(self):
+        parameters = torch.randn(
+            (3, *fam_with_vars.parameters_shape()),
+            generator=torch.Generator().manual_seed(0),
+        )
+        dist = fam_with_vars.with_parameters(parameters)
+        skeleton = fam_with_vars.tree_distribution_skeleton.csr
+        csrs = [
+            tree_dist.distribution
+            for tree_dist in fam_with_vars.tree_distribution_batch(dist)
+        ]
+        for csr in csrs:
+            self.assertIs(csr.contexts, skeleton.contexts)
+            self.assertIs(csr.offsets, skeleton.offsets)
+            self.assertIs(csr.symbol_ids, skeleton.symbol_ids)
+            self.assertIs(csr.context_ids, skeleton.context_ids)
+            self.assertIs(csr.log_probs.base, csrs[0].log_probs.base)
+        self.assertFalse(np.array_equal(csrs[0].log_probs, csrs[1].log_probs))
+
+
+class CorpusLikelihoodTest(unittest.TestCase):
+    corpus = [
+        ns.parse_s_expression(x)
+        for x in [
+            "(call (lam (+ ($0_0) (1))) (2))",
+            "(+ (1) (2))",
+            "(+ (+ (1) (2)) (+ (1) (2)))",
+            "(call (lam (+ ($0_0) (1))) (+ (1) (2)))",
+            "(call (lam ($0_0)) (call (lam (2)) (1)))",
+            "(1)",
+        ]
+    ]
+
+    def test_matches_compute_likelihood(self):
+        dist = fam_with_vars.with_parameters(
+            torch.randn(
+                (1, *fam_with_vars.parameters_shape()),
+                generator=torch.Generator().manual_seed(0),
+            )
+        )[0]
+        cache = ns.LikelihoodCache()
+        likelihoods = fam_with_vars.compute_likelihoods(dist, self.corpus, cache=cache)
+        for program, likelihood in zip(self.corpus, likelihoods):
+            self.assertAlmostEqual(
+                likelihood, fam_with_vars.compute_likelihood(dist, program)
+            )
+        # (+ (1) (2)) is shared across programs
+        self.assertGreater(cache.hits, 0)
+        self.assertEqual(len(cache), cache.misses)
+        self.assertLess(
+            cache.num_subtrees, sum(len(list(p.postorder)) for p in self.corpus)
+        )
+        hits, misses = cache.hits, cache.misses
+        # every program is served whole from the memo the second time around
+        self.assertEqual(
+            fam_with_vars.compute_likelihoods(dist, self.corpus, cache=cache),
+            likelihoods,
+        )
+        self.assertEqual((cache.hits, cache.misses), (hits + len(self.corpus), misses))
+
+    def test_impossible(self):
+        dist = fam_with_vars.uniform()
+        likelihoods = fam_with_vars.compute_likelihoods(
+            dist, [ns.parse_s_expression("(lam (1))")]
+        )
+        self.assertEqual(likelihoods, [-float("inf")])
+
+    def test_uncacheable(self):
+        cache = ns.LikelihoodCache()
+        programs = [
+            ns.parse_s_expression(x) for x in ["(+ (1) (2) (3))", "(+ (3) (2) (1))"]
+        ]
+        likelihoods = fam_with_ordering.compute_likelihoods(
+            fam_with_ordering.uniform(), programs, cache=cache
+        )
+        self.assertEqual(
+            likelihoods,
+            [
+                fam_with_ordering.compute_likelihood(fam_with_ordering.uniform(), p)
+                for p in programs
+            ],
+        )
+        self.assertEqual((cache.hits, cache.misses, cache.uncached_programs), (0, 0, 2))
+
+
+class BigramLikelihoodMatrixTest(unittest.TestCase):
+    def test_matches_compute_likelihood(self):
+        programs = [
+            ns.parse_s_expression(x)
+            for x in [
+                "(call (lam (+ ($0_0) (1))) (2))",
+                "(+ (1) (2))",
+                "(1)",
+                "(call (lam ($0_0)) (call (lam (2)) (1)))",
+            ]
+        ]
+        parameters = torch.randn(
+            (3, *fam_with_vars.parameters_shape()),
+            generator=torch.Generator().manual_seed(0),
+        )
+        dist = fam_with_vars.with_parameters(parameters)
+        # make (2) impossible in the first distribution
+        dist.distribution_batch[0, :, :, fam_with_vars.symbols().index("2")] = 0
+        matrix = fam_with_vars.compute_likelihood_matrix(dist, programs)
+        self.assertEqual(matrix.shape, (len(programs), len(dist)))
+        for i, program in enumerate(programs):
+            for j in range(matrix.shape[1]):
+                expected = fam_with_vars.compute_likelihood(dist[j], program)
+                if expected == -float("inf"):
+                    self.assertEqual(matrix[i, j], -float("inf"))
+                else:
+                    self.assertAlmostEqual(matrix[i, j], expected, places=5)
+        self.assertTrue(np.isinf(matrix[0, 0]))
+
+    def test_disallowed_by_mask(self):
+        programs = [
+            ns.parse_s_expression(x) for x in ["(+ (1) (2) (3))", "(+ (3) (2) (1))"]
+        ]
+        dist = fam_with_ordering.with_parameters(
+            torch.zeros((1, *fam_with_ordering.parameters_shape()))
+        )
+        matrix = fam_with_ordering.compute_likelihood_matrix(dist, programs)
+        self.assertAlmostEqual(
+            matrix[0, 0], fam_with_ordering.compute_likelihood(dist[0], programs[0])
+        )
+        self.assertEqual(
+            fam_with_ordering.compute_likelihood(dist[0], programs[1]), -float("inf")
+        )
+        self.assertEqual(matrix[1, 0], -float("inf"))
+
+
+class BigramCountArraysTest(unittest.TestCase):
+    programs = [
+        ["(call (lam (+ ($0_0) (1))) (2))", "(+ (1) (2))", "(+ (1) (2))"],
+        ["(1)"],
+        ["(call (lam ($0_0)) (call (lam (2)) (1)))"],
+    ]
+
+    def counts(self):
+        return fam_with_vars.count_programs(
+            [[ns.parse_s_expression(x) for x in ps] for ps in self.programs]
+        )
+
+    def test_round_trip_dicts(self):
+        for count in self.counts().counts:
+            round_tripped = ns.BigramProgramCounts.from_dicts(
+                count.numerators, count.denominators
+            )
+            self.assertEqual(round_tripped.numerators, count.numerators)
+            self.assertEqual(round_tripped.denominators, count.denominators)
+
+    def test_dense_arrays(self):
+        counts = self.counts()
+        num_symbols, max_arity = 10, 2
+        numerators = counts.numerators(num_symbols, max_arity)
+        denominators, keys = counts.denominators(num_symbols, max_arity)
+        self.assertEqual(keys, sorted(keys))
+        for i, count in enumerate(counts.counts):
+            expected_numerators = np.zeros_like(numerators[i])
+            for [(parent, position)], children in count.numerators.items():
+                for child, value in children.items():
+                    expected_numerators[parent, position, child] = value
+            np.testing.assert_equal(numerators[i], expected_numerators)
+            expected_denominators = np.zeros_like(denominators[i])
+            for [(parent, position)], children in count.denominators.items():
+                for key, value in children.items():
+                    expected_denominators[parent, position, keys.index(key)] = value
+            np.testing.assert_equal(denominators[i], expected_denominators)
+        # one count per node: 6 + 3 + 3
+        self.assertEqual(numerators[0].sum(), 12)
+        self.assertEqual(numerators[0].sum(), denominators[0].sum())
+
+    def test_merge(self):
+        counts = self.counts().counts
+        merged = ns.BigramProgramCounts.merge(counts)
+        [expected] = fam_with_vars.count_programs(
+            [[ns.parse_s_expression(x) for ps in self.programs for x in ps]]
+        ).counts
+        self.assertEqual(merged.numerators, expected.numerators)
+        self.assertEqual(merged.denominators, expected.denominators)
+
+    def test_mask_cache_matches_uncached(self):
+        tree_dist = fam_with_vars.tree_distribution_skeleton
+        programs = [ns.parse_s_expression(x) for ps in self.programs for x in ps]
+        uncached = BigramCountAccumulator()
+        cached = BigramCountAccumulator()
+        mask_cache = {}
+        for program in programs:
+            for accumulator, cache in ((uncached, None), (cached, mask_cache)):
+                preorder_mask = tree_dist.mask_constructor(tree_dist)
+                preorder_mask.on_entry(0, 0)
+                accumulate_counts(
+                    tree_dist,
+                    program,
+                    accumulator,
+                    ((0, 0),),
+                    preorder_mask=preorder_mask,
+                    mask_cache=cache,
+                )
+        self.assertNotEqual(mask_cache, {})
+        self.assertEqual(cached.finish().denominators, uncached.finish().denominators)
+
+    @parameterized.expand([(1,), (2,), (5,)])
+    def test_parallel_count_matches_sequential(self, n_workers):
+        data = [[ns.parse_s_expression(x) for x in ps] for ps in self.programs] + [[]]
+        sequential = fam_with_vars.count_programs(data)
+        parallel = fam_with_vars.count_programs(data, n_workers=n_workers)
+        self.assertEqual(len(parallel.counts), len(sequential.counts))
+        for p, s in zip(parallel.counts, sequential.counts):
+            self.assertEqual(p.numerators, s.numerators)
+            self.assertEqual(p.denominators, s.denominators)
+
+
+class BigramCountStoreTest(unittest.TestCase):
+    programs = [
+        ns.parse_s_expression(x)
+        for x in [
+            "(call (lam (+ ($0_0) (1))) (2))",
+            "(+ (1) (2))",
+            "(1)",
+            "(call (lam ($0_0)) (call (lam (2)) (1)))",
+        ]
+    ]
+
+    def assertSameCounts(self, store, programs):
+        [expected] = fam_with_vars.count_programs([programs]).counts
+        self.assertEqual(store.counts.numerators, expected.numerators)
+        self.assertEqual(store.counts.denominators, expected.denominators)
+        self.assertEqual(store.num_programs, len(programs))
+
+    def test_add_incrementally(self):
+        store = ns.BigramCountStore(fam_with_vars)
+        store.add(self.programs[:2]).add(self.programs[2:])
+        self.assertSameCounts(store, self.programs)
+
+    def test_remove(self):
+        store = ns.BigramCountStore(fam_with_vars).add(self.programs)
+        store.remove(self.programs[1:3])
+        self.assertSameCounts(store, self.programs[:1] + self.programs[3:])
+        store.remove(self.programs[:1] + self.programs[3:])
+        self.assertSameCounts(store, [])
+
+    def test_remove_missing(self):
+        store = ns.BigramCountStore(fam_with_vars).add(self.programs[:1])
+        with self.assertRaises(ValueError):
+            store.remove(self.programs[1:2])
+
+    def test_merge(self):
+        store = ns.BigramCountStore(fam_with_vars).add(self.programs[:3])
+        store.merge(ns.BigramCountStore(fam_with_vars).add(self.programs[3:]))
+        self.assertSameCounts(store, self.programs)
+
+    def test_save_load(self):
+        store = ns.BigramCountStore(fam_with_vars).add(self.programs)
+        store.remove(self.programs[:1])
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "counts.npz")
+            store.save(path)
+            loaded = ns.BigramCountStore.load(fam_with_vars, path)
+            self.assertSameCounts(loaded, self.programs[1:])
+            with self.assertRaises(ValueError):
+                ns.BigramCountStore.load(fam, path)
+
+    def test_fit_distribution(self):
+        store = ns.BigramCountStore(fam_with_vars).add(self.programs)
+        np.testing.assert_equal(
+            fam_with_vars.fit_distribution(store).distribution,
+            fam_with_vars.fit_distribution(self.programs).distribution,
+        )
+
+
+class BigramMLEDistributionTest(unittest.TestCase):
+    programs = [
+        "(call (lam (+ ($0_0) (1))) (2))",
+        "(call (lam ($0_0)) (call (lam (2)) (1)))",
+        "(+ (1) (2))",
+        "(call (lam (+ ($0_0) ($0_0))) (1))",
+    ]
+
+    def test_matches_counts_without_restrictions(self):
+        counts = fam.count_programs(
+            [[ns.parse_s_expression(x) for x in ["(+ (1) (2))", "(1)", "(2)"]]]
+        )
+        np.testing.assert_allclose(
+            fam.counts_to_mle_distribution(counts).distribution_batch,
+            fam.counts_to_distribution(counts).distribution_batch,
+            atol=1e-6,
+        )
+
+    def test_is_stationary(self):
+        counts = fam_with_vars.count_programs(
+            [
+                [ns.parse_s_expression(x) for x in self.programs],
+                [ns.parse_s_expression(x) for x in self.programs[:2]],
+            ]
+        )
+        mle = fam_with_vars.counts_to_mle_distribution(counts).distribution_batch
+        naive = fam_with_vars.counts_to_distribution(counts).distribution_batch
+        with np.errstate(divide="ignore"):
+            logits = torch.tensor(np.log(mle), dtype=torch.float64)
+            naive_logits = torch.tensor(np.log(naive), dtype=torch.float64)
+        logits.requires_grad_()
+        loss = fam_with_vars.parameter_difference_loss(logits, counts)
+        loss.sum().backward()
+        support = torch.tensor(mle > 0)
+        self.assertLess(logits.grad[support].abs().max().item(), 1e-3)
+        naive_loss = fam_with_vars.parameter_difference_loss(naive_logits, counts)
+        self.assertTrue((loss <= naive_loss + 1e-6).all())
+        self.assertLess(loss[0].item(), naive_loss[0].item() - 1e-3)
+
+
+fam_with_vars_packed = ns.BigramProgramDistributionFamily(
+    dsl_with_vars, packed_parameters=True
+)
+
+
+class BigramPackedParametersTest(unittest.TestCase):
+    def dense_and_packed(self, batch_size):
+        dense = torch.randn(
+            (batch_size, *fam_with_vars.parameters_shape()),
+            generator=torch.Generator().manual_seed(0),
+        )
+        return dense, fam_with_vars_packed.pack_parameters(dense)
+
+    def test_shape(self):
+        [num_valid] = fam_with_vars_packed.parameters_shape()
+        self.assertEqual(num_valid, len(fam_with_vars_packed.valid_indices))
+        self.assertLess(num_valid, np.prod(fam_with_vars.parameters_shape()))
+
+    def test_normalize_matches_dense(self):
+        dense, packed = self.dense_and_packed(3)
+        for logits in (True, False):
+            expected = fam_with_vars.normalize_parameters(dense, logits=logits)
+            actual = fam_with_vars_packed.unpack_parameters(
+                fam_with_vars_packed.normalize_parameters(packed, logits=logits),
+                fill_value=-float("inf") if logits else 0,
+            )
+            torch.testing.assert_close(actual, expected)
+
+    def test_with_parameters_matches_dense(self):
+        dense, packed = self.dense_and_packed(3)
+        np.testing.assert_allclose(
+            fam_with_vars_packed.with_parameters(packed).distribution_batch,
+            fam_with_vars.with_parameters(dense).distribution_batch,
+            rtol=1e-6,
+        )
+
+    def test_loss_matches_dense(self):
+        programs = [
+            [ns.parse_s_expression("(call (lam (+ ($0_0) (1))) (2))")],
+            [ns.parse_s_expression("(+ (1) (2))"), ns.parse_s_expression("(1)")],
+        ]
+        counts = fam_with_vars.count_programs(programs)
+        dense, packed = self.dense_and_packed(2)
+        # the dense loss uses all parameters in the denominator, so invalid
+        # entries need to be masked out to match the packed loss
+        dense = fam_with_vars_packed.unpack_parameters(packed).requires_grad_()
+        packed = packed.clone().requires_grad_()
+        dense_loss = fam_with_vars.parameter_difference_loss(dense, counts)
+        packed_loss = fam_with_vars_packed.parameter_difference_loss(packed, counts)
+        torch.testing.assert_close(packed_loss, dense_loss)
+        dense_loss.sum().backward()
+        packed_loss.sum().backward()
+        torch.testing.assert_close(
+            packed.grad, fam_with_vars_packed.pack_parameters(dense.grad)
+        )
+
+    def test_loss_matches_dense_with_neg_inf(self):
+        # without the type mask, the denominators include invalid productions
+        packed_family = ns.BigramProgramDistributionFamily(
+            dsl_with_3, include_type_preorder_mask=False, packed_parameters=True
+        )
+        counts = fam_with_3_no_type_mask.count_programs(
+            [
+                [ns.parse_s_expression("(+ (1) (3))")],
+                [ns.parse_s_expression("(+ (1) (2))"), ns.parse_s_expression("(2)")],
+            ]
+        )
+        dense = torch.randn(
+            (2, *fam_with_3_no_type_mask.parameters_shape()),
+            generator=torch.Generator().manual_seed(0),
+        )
+        packed = packed_family.pack_parameters(dense)
+        for neg_inf in -float("inf"), -2.0:
+            dense_loss = fam_with_3_no_type_mask.parameter_difference_loss(
+                fam_with_3_no_type_mask.normalize_parameters(
+                    dense, logits=True, neg_inf=neg_inf
+                ),
+                counts,
+            )
+            packed_loss = packed_family.parameter_difference_loss(
+                packed_family.normalize_parameters(packed, logits=True),
+                counts,
+                neg_inf=neg_inf,
+            )
+            torch.testing.assert_close(packed_loss, dense_loss)
+
+
 class BigramParameterDifferenceLossTest(unittest.TestCase):
     def computeLoss(self, logits, programs, family=fam):
         programs = [[ns.parse_s_expression(x) for x in ps] for ps in programs]
@@ -474,6 +1038,54 @@ class BigramParameterDifferenceLossTest(unittest.TestCase):
             family=fam_with_vars,
         )
 
+    def dense_loss(self, family, logits, counts):
+        """
+        Reference implementation that materializes the full theta_by_denom tensor.
+        """
+        num_symbols, max_arity = len(family.symbols()), logits.shape[2]
+        numcount = torch.tensor(counts.numerators(num_symbols, max_arity)).float()
+        dencount, den_keys = counts.denominators(num_symbols, max_arity)
+        dencount = torch.tensor(dencount).float()
+        theta_by_denom = logits[..., None].repeat(1, 1, 1, 1, len(den_keys))
+        for i, key in enumerate(den_keys):
+            mask = torch.ones(num_symbols, dtype=torch.bool)
+            mask[list(key)] = False
+            theta_by_denom[..., mask, i] = -float("inf")
+        agg_theta_by_denom = torch.logsumexp(theta_by_denom, dim=-2)
+        numer = (numcount * logits).flatten(1).sum(-1)
+        denom = (dencount * agg_theta_by_denom).flatten(1).sum(-1)
+        return -(numer - denom)
+
+    @parameterized.expand([(1,), (3,), (10**6,)])
+    def test_matches_dense_loss_and_gradients(self, chunk_size):
+        programs = [
+            ["(call (lam (+ ($0_0) (1))) (2))", "(+ (1) (2))"],
+            ["(1)", "(call (lam ($0_0)) (call (lam (2)) (1)))"],
+            ["(+ (+ (1) (1)) (call (lam ($0_0)) (2)))"],
+        ]
+        counts = fam_with_vars.count_programs(
+            [[ns.parse_s_expression(x) for x in ps] for ps in programs]
+        )
+        for batch_size in (1, 3):
+            logits = torch.randn(
+                (batch_size, *fam_with_vars.parameters_shape()),
+                generator=torch.Generator().manual_seed(batch_size),
+            )
+            logits_dense = logits.clone().requires_grad_()
+            logits_sparse = logits.clone().requires_grad_()
+            dense = self.dense_loss(fam_with_vars, logits_dense, counts)
+            sparse = fam_with_vars.parameter_difference_loss(
+                logits_sparse, counts, chunk_size=chunk_size
+            )
+            np.testing.assert_allclose(
+                sparse.detach().numpy(), dense.detach().numpy(), rtol=1e-5
+            )
+            dense.sum().backward()
+            sparse.sum().backward()
+            np.testing.assert_allclose(
+                logits_sparse.grad.numpy(), logits_dense.grad.numpy(), atol=1e-5
+            )
+
 
 class BigramLikelihoodTest(unittest.TestCase):
     def assertLikelihood(self, dist, program, str_prob, family=fam, **kwargs):
@@ -1091,6 +1703,93 @@ class BigramMixTest(unittest.TestCase):
         )
 
 
+class BigramLazyTransformTest(unittest.TestCase):
+    def fit(self, family, programs):
+        return family.fit_distribution([ns.parse_s_expression(x) for x in programs])
+
+    def assertSameTreeDistribution(self, family, lazy, eager):
+        lazy_tree = family.compute_tree_distribution(lazy).distribution
+        eager_tree = family.compute_tree_distribution(eager).distribution
+        self.assertEqual(set(lazy_tree), set(eager_tree))
+        for context in eager_tree:
+            lazy_entries, eager_entries = (
+                dict(tree[context]) for tree in (lazy_tree, eager_tree)
+            )
+            self.assertEqual(set(lazy_entries), set(eager_entries))
+            for sym, log_prob in eager_entries.items():
+                self.assertAlmostEqual(lazy_entries[sym], log_prob, places=5)
+        np.testing.assert_allclose(
+            lazy.to_distribution().distribution, eager.distribution, atol=1e-6
+        )
+
+    def test_chain_matches_eager(self):
+        dist = self.fit(fam_with_3, ["(1)", "(+ (1) (2))"])
+        other = self.fit(fam_with_3, ["(+ (3) (3))"])
+        symbol_mask = np.array([True, True, True, True, False])
+        lazy = (
+            dist.lazy()
+            .bound_minimum_likelihood(0.01, symbol_mask)
+            .mix_with_other(other, 0.3)
+            .bound_minimum_likelihood(0.001)
+        )
+        eager = (
+            dist.bound_minimum_likelihood(0.01, symbol_mask)
+            .mix_with_other(other, 0.3)
+            .bound_minimum_likelihood(0.001)
+        )
+        self.assertSameTreeDistribution(fam_with_3, lazy, eager)
+        for program, likelihood in fam_with_3.enumerate(lazy, min_likelihood=-8):
+            self.assertAlmostEqual(
+                fam_with_3.compute_likelihood(eager, program), likelihood, places=5
+            )
+
+    @parameterized.expand([(0.25,), (0.75,)])
+    def test_mix_different_families(self, weight):
+        small = self.fit(fam, ["(1)", "(+ (1) (2))"])
+        large = self.fit(fam_with_3, ["(+ (2) (3))", "(3)"])
+        for this, other in [(small, large), (large, small)]:
+            lazy = (
+                this.lazy().bound_minimum_likelihood(0.01).mix_with_other(other, weight)
+            )
+            eager = this.bound_minimum_likelihood(0.01).mix_with_other(other, weight)
+            self.assertIs(lazy.dist_fam, fam_with_3)
+            self.assertSameTreeDistribution(fam_with_3, lazy, eager)
+
+    def test_non_subset_fails(self):
+        with self.assertRaises(ValueError) as cm:
+            self.fit(fam_with_3, ["(3)"]).lazy().mix_with_other(
+                self.fit(fam_with_vars, ["(1)"]), 0.5
+            )
+        self.assertTrue(str(cm.exception).startswith("DSL not compatible"))
+
+    def test_mask_symbols(self):
+        dist = (
+            fam_with_3.uniform()
+            .lazy()
+            .mask_symbols(np.array([True, True, True, False, True]))
+        )
+        self.assertEqual(
+            fam_with_3.compute_likelihood(dist, ns.parse_s_expression("(2)")), -np.inf
+        )
+        self.assertAlmostEqual(
+            fam_with_3.compute_likelihood(dist, ns.parse_s_expression("(+ (1) (3))")),
+            np.log(1 / 27),
+            places=5,
+        )
+
+    def test_mass_outside_valid_falls_back(self):
+        dist = self.fit(fam, ["(1)", "(+ (1) (2))"])
+        values = dist.distribution.copy()
+        # root -> root is never a valid production
+        values[0, 0, 0] = 0.5
+        dist = BigramProgramDistribution(fam, values)
+        lazy = dist.lazy().mix_with_other(fam.uniform(), 0.5)
+        self.assertIsNone(lazy.packed_values())
+        self.assertSameTreeDistribution(
+            fam, lazy, dist.mix_with_other(fam.uniform(), 0.5)
+        )
+
+
 class OrderingTest(unittest.TestCase):
     def test_traversal(self):
         ordering = fam_with_ordering.tree_distribution_skeleton.ordering
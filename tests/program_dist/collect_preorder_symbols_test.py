@@ -51,3 +51,24 @@ class CollectPreorderSymbolsTest(unittest.TestCase):
                 else sexp
             ),
         )
+
+    def test_collect_preorder_symbols_shared_cache(self):
+        tree_dist = fam_with_vars.tree_distribution_skeleton
+        mask_cache = {}
+        for code in ["(+ (1) (call (lam ($0_0)) (1)))", "(call (lam (+ (1) (1))) (1))"]:
+            expected = list(
+                ns.collect_preorder_symbols(ns.parse_s_expression(code), tree_dist)
+            )
+            self.assertCollectPreorder(
+                [
+                    (
+                        ns.render_s_expression(s_exp),
+                        [tree_dist.symbols[idx][0] for idx in alts],
+                    )
+                    for s_exp, alts, _ in expected
+                ],
+                code,
+                tree_dist,
+                mask_cache=mask_cache,
+            )
+        self.assertNotEqual(mask_cache, {})
@@ -1,3 +1,4 @@
+import dataclasses
 import itertools
 import unittest
 from fractions import Fraction
@@ -5,9 +6,13 @@ from fractions import Fraction
 import numpy as np
 
 import neurosym as ns
+from neurosym.program_dist.bigram import BigramProgramDistribution
+from neurosym.program_dist.tree_distribution.preorder_mask.instrumented_preorder_mask import (
+    InstrumentedPreorderMask,
+)
 
 from .bigram_test import fam, fam_with_ordering, fam_with_ordering_231, fam_with_vars
-from .utils import enumerate_dsl
+from .utils import enumerate_dsl, program_depth, program_size
 
 arith_dist = ns.TreeDistribution(
     1,
@@ -36,6 +41,40 @@ class TreeDistributionTest(unittest.TestCase):
         programs = enumerated(arith_dist)
         assert len(programs) == len(set(programs))
 
+    def test_csr_distribution(self):
+        csr_dist = ns.TreeDistribution(
+            arith_dist.limit,
+            ns.CSRDistribution.from_dict(arith_dist.distribution),
+            arith_dist.symbols,
+            arith_dist.mask_constructor,
+            arith_dist.node_ordering,
+        )
+        self.assertEqual(dict(csr_dist.distribution), arith_dist.distribution)
+        self.assertEqual(dict(csr_dist.distribution_dict), arith_dist.distribution_dict)
+        self.assertEqual(
+            dict(csr_dist.index_within_distribution_list),
+            arith_dist.index_within_distribution_list,
+        )
+        for context, (syms, log_probs) in arith_dist.likelihood_arrays.items():
+            csr_syms, csr_log_probs = csr_dist.likelihood_arrays[context]
+            np.testing.assert_equal(csr_syms, syms)
+            np.testing.assert_equal(csr_log_probs, log_probs)
+        self.assertEqual(enumerated(csr_dist), enumerated(arith_dist))
+
+    def test_csr_distribution_equality(self):
+        csr = ns.CSRDistribution.from_dict(arith_dist.distribution)
+        self.assertEqual(csr, ns.CSRDistribution.from_dict(arith_dist.distribution))
+        self.assertNotEqual(csr, csr.with_log_probs(csr.log_probs - 1))
+        self.assertNotEqual(csr, ns.CSRDistribution.from_dict({((0, 0),): [(2, 0.0)]}))
+        tree_dist = ns.TreeDistribution(
+            arith_dist.limit,
+            csr,
+            arith_dist.symbols,
+            arith_dist.mask_constructor,
+            arith_dist.node_ordering,
+        )
+        self.assertEqual(tree_dist, dataclasses.replace(tree_dist))
+
     def test_enumeration(self):
         out = dict(enumerated(arith_dist))
         p_one = 3 / 4
@@ -205,3 +244,506 @@ class TreeDistributionTest(unittest.TestCase):
             fam_with_ordering_231, fam_with_ordering_231.uniform(), min_likelihood=-6
         )
         self.assertEqual(result, {("(+ (2) (3) (1))", Fraction(1))})
+
+
+class BestFirstEnumerationTest(unittest.TestCase):
+    def assertMatchesChunked(self, family, dist, min_likelihood):
+        best_first = [
+            (ns.render_s_expression(program), likelihood)
+            for program, likelihood in family.enumerate_best_first(
+                dist, min_likelihood=min_likelihood
+            )
+        ]
+        likelihoods = [likelihood for _, likelihood in best_first]
+        self.assertEqual(likelihoods, sorted(likelihoods, reverse=True))
+        chunked = {
+            ns.render_s_expression(program): likelihood
+            for program, likelihood in family.enumerate(
+                dist, min_likelihood=min_likelihood
+            )
+        }
+        self.assertEqual({program for program, _ in best_first}, set(chunked))
+        for program, likelihood in best_first:
+            self.assertAlmostEqual(likelihood, chunked[program])
+
+    def test_arith(self):
+        result = list(
+            itertools.islice(ns.enumerate_tree_dist_best_first(arith_dist), 20)
+        )
+        likelihoods = [likelihood for _, likelihood in result]
+        self.assertEqual(likelihoods, sorted(likelihoods, reverse=True))
+        self.assertEqual(
+            [ns.render_s_expression(program) for program, _ in result[:2]],
+            ["(1)", "(+ (1) (1))"],
+        )
+
+    def test_matches_chunked(self):
+        dist = fam_with_vars.fit_distribution(
+            [ns.parse_s_expression("(call (lam (+ ($0_0) (1))) (2))")]
+        )
+        self.assertMatchesChunked(fam_with_vars, dist, -10)
+        self.assertMatchesChunked(fam_with_vars, fam_with_vars.uniform(), -8)
+
+    def test_matches_chunked_with_ordering(self):
+        for family in fam_with_ordering, fam_with_ordering_231:
+            self.assertMatchesChunked(family, family.uniform(), -6)
+
+    def test_frontier_cap(self):
+        dist = fam_with_vars.uniform()
+        full = list(fam_with_vars.enumerate_best_first(dist, min_likelihood=-10))
+        capped = list(
+            fam_with_vars.enumerate_best_first(
+                dist, min_likelihood=-10, max_frontier_size=20
+            )
+        )
+        self.assertLess(len(capped), len(full))
+        self.assertGreater(len(capped), 0)
+        # everything above the likelihood of the last capped program is produced
+        bound = capped[-1][1]
+        self.assertEqual(
+            {ns.render_s_expression(p) for p, _ in capped},
+            {ns.render_s_expression(p) for p, lp in full if lp >= bound},
+        )
+
+
+class EnumerationCacheTest(unittest.TestCase):
+    dist = fam_with_vars.tree_distribution(fam_with_vars.uniform())
+
+    def enumerate_with(self, **kwargs):
+        return {
+            (ns.render_s_expression(program), likelihood)
+            for program, likelihood in ns.enumerate_tree_dist(
+                self.dist, min_likelihood=-8, chunk_size=1, **kwargs
+            )
+        }
+
+    def test_matches_uncached(self):
+        cache = ns.EnumerationCache()
+        self.assertEqual(
+            self.enumerate_with(cache=cache), self.enumerate_with(use_cache=False)
+        )
+        self.assertGreater(cache.hits, 0)
+        self.assertGreater(cache.misses, 0)
+        self.assertEqual(cache.evictions, 0)
+
+    def test_reused_across_enumerations(self):
+        cache = ns.EnumerationCache()
+        expected = self.enumerate_with(cache=cache)
+        hits, misses = cache.hits, cache.misses
+        self.assertEqual(self.enumerate_with(cache=cache), expected)
+        self.assertLess(cache.misses - misses, misses)
+        self.assertGreater(cache.hits - hits, 0)
+
+    def test_extended_across_chunks(self):
+        cache, stats = ns.EnumerationCache(), ns.EnumerationStats()
+        self.assertEqual(
+            self.enumerate_with(cache=cache, stats=stats),
+            self.enumerate_with(use_cache=False),
+        )
+        # each key is enumerated from scratch once, and later chunks only
+        # enumerate the band below what is stored
+        self.assertEqual(sum(stats.cache_misses), len(cache))
+        self.assertGreater(cache.extensions, 0)
+        uncached_stats = ns.EnumerationStats()
+        self.enumerate_with(use_cache=False, stats=uncached_stats)
+        self.assertLess(
+            sum(stats.nodes_expanded), sum(uncached_stats.nodes_expanded) / 10
+        )
+
+    def test_budget(self):
+        cache = ns.EnumerationCache(max_entries=5, max_programs=20)
+        self.assertEqual(
+            self.enumerate_with(cache=cache), self.enumerate_with(use_cache=False)
+        )
+        self.assertGreater(cache.evictions, 0)
+        self.assertLessEqual(len(cache), 5)
+        self.assertLessEqual(cache.num_programs, 20)
+
+
+class ParallelEnumerationTest(unittest.TestCase):
+    def assertMatchesSequential(self, family, dist, min_likelihood, **kwargs):
+        sequential = {
+            ns.render_s_expression(program): likelihood
+            for program, likelihood in family.enumerate(
+                dist, min_likelihood=min_likelihood
+            )
+        }
+        parallel = [
+            (ns.render_s_expression(program), likelihood)
+            for program, likelihood in ns.enumerate_tree_dist(
+                family.tree_distribution(dist),
+                min_likelihood=min_likelihood,
+                **kwargs,
+            )
+        ]
+        self.assertEqual(len(parallel), len(sequential))
+        for program, likelihood in parallel:
+            self.assertAlmostEqual(likelihood, sequential[program])
+        # chunks are still produced in order
+        chunks = [np.ceil(-likelihood / 1.0) for _, likelihood in parallel]
+        self.assertEqual(chunks, sorted(chunks))
+
+    def test_with_variables(self):
+        dist = fam_with_vars.fit_distribution(
+            [ns.parse_s_expression("(call (lam (+ ($0_0) (1))) (2))")]
+        )
+        for split_depth in 1, 2, 3:
+            self.assertMatchesSequential(
+                fam_with_vars,
+                dist,
+                -10,
+                chunk_size=1.0,
+                n_workers=2,
+                split_depth=split_depth,
+            )
+
+    def test_uncacheable_mask(self):
+        for family in fam_with_ordering, fam_with_ordering_231:
+            self.assertMatchesSequential(
+                family, family.uniform(), -6, chunk_size=1.0, n_workers=2
+            )
+
+    def test_family_enumerate(self):
+        self.assertEqual(
+            {
+                ns.render_s_expression(program)
+                for program, _ in fam.enumerate(
+                    fam.uniform(), min_likelihood=-5, n_workers=2
+                )
+            },
+            {
+                ns.render_s_expression(program)
+                for program, _ in fam.enumerate(fam.uniform(), min_likelihood=-5)
+            },
+        )
+
+    def test_cache_rejected(self):
+        with self.assertRaises(ValueError):
+            list(
+                ns.enumerate_tree_dist(
+                    fam.tree_distribution(fam.uniform()),
+                    min_likelihood=-5,
+                    cache=ns.EnumerationCache(),
+                    n_workers=2,
+                )
+            )
+
+
+class EnumerationCursorTest(unittest.TestCase):
+    dist = fam_with_vars.tree_distribution(fam_with_vars.uniform())
+
+    def enumerate_with(self, **kwargs):
+        return [
+            (ns.render_s_expression(program), likelihood)
+            for program, likelihood in ns.enumerate_tree_dist(
+                self.dist, min_likelihood=-9, **kwargs
+            )
+        ]
+
+    def test_resume(self):
+        full = self.enumerate_with(chunk_size=1.0)
+        cursor = ns.EnumerationCursor(chunk_size=1.0)
+        generator = ns.enumerate_tree_dist(self.dist, min_likelihood=-9, cursor=cursor)
+        partial = []
+        for program, likelihood in generator:
+            partial.append((ns.render_s_expression(program), likelihood))
+            if likelihood < -6:
+                break
+        self.assertEqual(cursor.chunk, 7)
+        # the partially yielded chunk is produced again on resumption
+        completed = [(p, lp) for p, lp in partial if lp > -6]
+        cursor = ns.EnumerationCursor.from_dict(cursor.to_dict())
+        resumed = self.enumerate_with(cursor=cursor)
+        self.assertEqual(completed + resumed, full)
+        self.assertEqual(cursor.chunk, 10)
+
+    def test_partition(self):
+        full = self.enumerate_with(chunk_size=1.0)
+        shards = ns.EnumerationCursor.partition(3, -9, chunk_size=1.0)
+        self.assertEqual(
+            [(shard.chunk, shard.end_chunk) for shard in shards],
+            [(1, 4), (4, 7), (7, 10)],
+        )
+        combined = []
+        for shard in shards:
+            combined += self.enumerate_with(cursor=shard)
+        self.assertEqual(combined, full)
+        with self.assertRaises(AssertionError):
+            ns.EnumerationCursor.partition(3, -float("inf"))
+
+    def test_starting_at(self):
+        self.assertEqual(ns.EnumerationCursor.starting_at(-0.5, 1.0).chunk, 1)
+        self.assertEqual(ns.EnumerationCursor.starting_at(-1.0, 1.0).chunk, 2)
+        cursor = ns.EnumerationCursor.starting_at(-5.5, 1.0)
+        self.assertEqual(
+            self.enumerate_with(cursor=cursor),
+            [(p, lp) for p, lp in self.enumerate_with(chunk_size=1.0) if lp <= -5],
+        )
+
+
+class AdaptiveChunkSizeTest(unittest.TestCase):
+    def test_adaptive_matches_fixed(self):
+        dist = fam_with_vars.uniform()
+        fixed_stats, adaptive_stats = ns.EnumerationStats(), ns.EnumerationStats()
+        fixed = fam_with_vars.enumerate(
+            dist, min_likelihood=-11, chunk_size=0.25, stats=fixed_stats
+        )
+        adaptive = fam_with_vars.enumerate(
+            dist,
+            min_likelihood=-11,
+            chunk_size=0.25,
+            adaptive_chunk_size=True,
+            stats=adaptive_stats,
+        )
+        fixed, adaptive = [
+            {ns.render_s_expression(p): lp for p, lp in result}
+            for result in (fixed, adaptive)
+        ]
+        self.assertEqual(fixed, adaptive)
+        bounds = adaptive_stats.chunk_bounds
+        self.assertEqual(bounds[0], (-0.25, 0))
+        self.assertEqual(bounds[-1][0], -11)
+        for (_, upper), (lower, _) in zip(bounds[1:], bounds):
+            self.assertEqual(upper, lower)
+        self.assertGreater(max(upper - lower for lower, upper in bounds), 0.25)
+        self.assertLess(sum(adaptive_stats.work()), sum(fixed_stats.work()))
+
+    def test_bands(self):
+        stats = ns.EnumerationStats()
+        result = list(
+            ns.enumerate_tree_dist(
+                fam_with_vars.tree_distribution(fam_with_vars.uniform()),
+                min_likelihood=-10,
+                adaptive_chunk_size=True,
+                stats=stats,
+            )
+        )
+        # programs are yielded chunk by chunk
+        chunk_of = [
+            next(
+                i
+                for i, (lower, upper) in enumerate(stats.chunk_bounds)
+                if lower < lp <= upper
+            )
+            for _, lp in result
+        ]
+        self.assertEqual(chunk_of, sorted(chunk_of))
+
+    def test_reused_stats(self):
+        dist = fam_with_vars.tree_distribution(fam_with_vars.uniform())
+        stats = ns.EnumerationStats()
+        for _ in range(2):
+            list(
+                ns.enumerate_tree_dist(
+                    dist,
+                    min_likelihood=-10,
+                    chunk_size=0.25,
+                    adaptive_chunk_size=True,
+                    stats=stats,
+                )
+            )
+        # the second run is sized from its own chunks, not the first run's
+        half = len(stats.chunk_bounds) // 2
+        self.assertEqual(stats.chunk_bounds[:half], stats.chunk_bounds[half:])
+        self.assertEqual(stats.work()[:half], stats.work()[half:])
+
+
+class EnumerationStatsTest(unittest.TestCase):
+    def test_stats(self):
+        calls = []
+        result = list(
+            fam_with_vars.enumerate(
+                fam_with_vars.uniform(),
+                min_likelihood=-8,
+                chunk_size=1.0,
+                stats_callback=lambda stats: calls.append(len(stats.chunk_bounds)),
+            )
+        )
+        stats = ns.EnumerationStats()
+        self.assertEqual(
+            len(result),
+            len(
+                list(
+                    fam_with_vars.enumerate(
+                        fam_with_vars.uniform(),
+                        min_likelihood=-8,
+                        chunk_size=1.0,
+                        stats=stats,
+                    )
+                )
+            ),
+        )
+        self.assertEqual(calls, list(range(1, 9)))
+        self.assertEqual(len(stats.wall_time), 8)
+        self.assertEqual(sum(stats.programs_yielded), len(result))
+        for generated, yielded in zip(stats.programs_generated, stats.programs_yielded):
+            self.assertGreaterEqual(generated, yielded)
+        self.assertEqual(
+            stats.nodes_visited,
+            [e + h for e, h in zip(stats.nodes_expanded, stats.cache_hits)],
+        )
+        self.assertEqual(stats.cache_size, sorted(stats.cache_size))
+        self.assertGreater(sum(stats.cache_hits), 0)
+        self.assertGreater(sum(stats.compute_mask_time), 0)
+
+    def test_uncacheable(self):
+        stats = ns.EnumerationStats()
+        result = list(
+            fam_with_ordering.enumerate(
+                fam_with_ordering.uniform(), min_likelihood=-6, stats=stats
+            )
+        )
+        self.assertEqual(sum(stats.programs_yielded), len(result))
+        self.assertEqual(stats.nodes_visited, stats.nodes_expanded)
+        self.assertEqual(set(stats.cache_size), {0})
+
+    def test_uncached_counts_expansions(self):
+        stats = ns.EnumerationStats()
+        list(
+            ns.enumerate_tree_dist(
+                fam.compute_tree_distribution(fam.uniform()),
+                min_likelihood=-10,
+                use_cache=False,
+                stats=stats,
+            )
+        )
+        self.assertEqual(stats.nodes_visited, stats.nodes_expanded)
+        self.assertTrue(all(expanded > 0 for expanded in stats.nodes_expanded))
+        self.assertEqual(stats.nodes_expanded, sorted(stats.nodes_expanded))
+        self.assertGreater(stats.nodes_expanded[-1], stats.compute_mask_calls[-1])
+
+
+class MaskedLikelihoodsTest(unittest.TestCase):
+    def test_memoized(self):
+        dist = fam_with_vars.compute_tree_distribution(fam_with_vars.uniform())
+        mask = InstrumentedPreorderMask(dist.mask_constructor(dist))
+        mask.on_entry(0, 0)
+        first = dist.masked_likelihoods(((0, 0),), mask)
+        self.assertIs(dist.masked_likelihoods(((0, 0),), mask), first)
+        self.assertEqual(mask.compute_mask_calls, 1)
+        self.assertAlmostEqual(np.logaddexp.reduce(list(first.values())), 0)
+
+    def test_uncacheable(self):
+        dist = fam_with_ordering.compute_tree_distribution(fam_with_ordering.uniform())
+        mask = dist.mask_constructor(dist)
+        mask.on_entry(0, 0)
+        dist.masked_likelihoods(((0, 0),), mask)
+        self.assertEqual(dist.masked_likelihood_cache, {})
+
+
+class BoundedEnumerationTest(unittest.TestCase):
+    def enumerate_with(self, family, **kwargs):
+        return {
+            (ns.render_s_expression(program), likelihood)
+            for program, likelihood in family.enumerate(
+                family.uniform(), min_likelihood=-8, **kwargs
+            )
+        }
+
+    def assertMatchesFiltered(self, family, max_depth, max_size):
+        unbounded = {
+            (ns.render_s_expression(program), likelihood)
+            for program, likelihood in family.enumerate(
+                family.uniform(), min_likelihood=-8
+            )
+            if program_depth(program) <= max_depth and program_size(program) <= max_size
+        }
+        bounded = self.enumerate_with(family, max_depth=max_depth, max_size=max_size)
+        self.assertEqual(bounded, unbounded)
+        self.assertGreater(len(bounded), 0)
+
+    def test_depth(self):
+        self.assertMatchesFiltered(fam_with_vars, max_depth=3, max_size=np.inf)
+
+    def test_size(self):
+        self.assertMatchesFiltered(fam_with_vars, max_depth=np.inf, max_size=4)
+
+    def test_both(self):
+        self.assertMatchesFiltered(fam_with_vars, max_depth=3, max_size=5)
+
+    def test_uncacheable(self):
+        self.assertMatchesFiltered(fam_with_ordering, max_depth=3, max_size=4)
+
+    def test_leaves_only(self):
+        for max_depth, max_size in [(1, np.inf), (np.inf, 1)]:
+            for program, _ in fam_with_vars.enumerate(
+                fam_with_vars.uniform(),
+                min_likelihood=-8,
+                max_depth=max_depth,
+                max_size=max_size,
+            ):
+                self.assertEqual(program.children, [])
+
+    def test_shared_cache(self):
+        dist = fam_with_vars.tree_distribution(fam_with_vars.uniform())
+        cache = ns.EnumerationCache()
+
+        def run(**kwargs):
+            return {
+                (ns.render_s_expression(program), likelihood)
+                for program, likelihood in ns.enumerate_tree_dist(
+                    dist, min_likelihood=-8, **kwargs
+                )
+            }
+
+        for kwargs in [{}, dict(max_size=4), {}, dict(max_size=4)]:
+            self.assertEqual(run(cache=cache, **kwargs), run(use_cache=False, **kwargs))
+
+
+class EnumerationEstimateTest(unittest.TestCase):
+    def actual(self, family, min_likelihood):
+        return list(family.enumerate(family.uniform(), min_likelihood=min_likelihood))
+
+    def test_exact_without_ties_at_the_boundary(self):
+        estimate = fam.estimate_enumeration(
+            fam.uniform(), min_likelihood=-10, bin_width=0.05
+        )
+        for min_likelihood in -6, -10:
+            actual = self.actual(fam, min_likelihood)
+            self.assertAlmostEqual(estimate.num_programs(min_likelihood), len(actual))
+            self.assertAlmostEqual(
+                estimate.num_nodes(min_likelihood),
+                sum(program_size(program) for program, _ in actual),
+            )
+            self.assertAlmostEqual(
+                estimate.covered_mass(min_likelihood),
+                sum(np.exp(likelihood) for _, likelihood in actual),
+            )
+
+    def test_with_variables(self):
+        estimate = fam_with_vars.estimate_enumeration(
+            fam_with_vars.uniform(), min_likelihood=-10, bin_width=0.05
+        )
+        actual = self.actual(fam_with_vars, -10)
+        self.assertLess(abs(estimate.num_programs(-10) / len(actual) - 1), 0.2)
+        self.assertAlmostEqual(
+            estimate.covered_mass(-10),
+            sum(np.exp(likelihood) for _, likelihood in actual),
+            places=1,
+        )
+        self.assertEqual(estimate.num_programs(-6), len(self.actual(fam_with_vars, -6)))
+
+    def test_skewed_recursive(self):
+        # + has a cost below one bin, so it recurses at the same budget
+        values = np.where(fam.uniform().distribution > 0, 0.04, 0)
+        values[:, :, 1] = np.where(fam.uniform().distribution[:, :, 1] > 0, 0.92, 0)
+        dist = BigramProgramDistribution(fam, values)
+        actual = list(fam.enumerate(dist, min_likelihood=-12))
+        self.assertEqual(len(actual), 22)
+        for bin_width in 0.1, 0.05:
+            estimate = fam.estimate_enumeration(
+                dist, min_likelihood=-12, bin_width=bin_width
+            )
+            self.assertAlmostEqual(estimate.num_programs(-12), len(actual))
+
+    def test_budget_and_chunk_size(self):
+        estimate = fam.estimate_enumeration(fam.uniform(), min_likelihood=-12)
+        min_likelihood = estimate.min_likelihood_for_budget(1000)
+        self.assertLessEqual(estimate.num_nodes(min_likelihood), 1000)
+        self.assertGreater(estimate.num_nodes(min_likelihood - 0.1), 1000)
+        chunk_size = estimate.recommended_chunk_size(-12)
+        self.assertGreater(chunk_size, 0)
+        self.assertLessEqual(chunk_size, 12)
+        self.assertLessEqual(
+            estimate.recommended_chunk_size(-12, max_overhead=2), chunk_size
+        )
@@ -0,0 +1,105 @@
+import unittest
+
+import numpy as np
+
+import neurosym as ns
+
+from .bigram_test import dsl, dsl_with_vars
+
+fam = ns.NgramProgramDistributionFamily(dsl, limit=2)
+fam_with_vars = ns.NgramProgramDistributionFamily(dsl_with_vars, limit=3)
+
+programs = [
+    ns.parse_s_expression(x) for x in ["(+ (1) (+ (2) (2)))", "(+ (1) (2))", "(1)"]
+]
+
+
+class NgramCountTest(unittest.TestCase):
+    def test_counts(self):
+        [counts] = fam.count_programs([programs]).counts
+        root, plus, one, two = range(4)
+        self.assertEqual(counts.numerators[(root, 0),], {plus: 2, one: 1})
+        self.assertEqual(counts.numerators[(plus, 1),], {plus: 1, two: 2})
+        self.assertEqual(counts.numerators[(root, 0), (plus, 0)], {one: 2})
+        self.assertEqual(counts.numerators[(plus, 1), (plus, 1)], {two: 1})
+        self.assertEqual(max(len(k) for k in counts.numerators), 2)
+
+
+class NgramDistributionTest(unittest.TestCase):
+    def test_witten_bell(self):
+        dist = fam.fit_distribution(programs)
+        root, plus, one, two = range(4)
+        # at the root, we saw + twice and 1 once, with 2 distinct symbols
+        syms, probs = dist.distribution[(root, 0),]
+        self.assertEqual(syms.tolist(), [plus, one, two])
+        np.testing.assert_allclose(
+            probs, [(2 + 2 / 3) / 5, (1 + 2 / 3) / 5, (2 / 3) / 5]
+        )
+        # the trigram context interpolates with the bigram context
+        lower = dict(zip(*dist.distribution[(plus, 0),]))
+        syms, probs = dist.distribution[(root, 0), (plus, 0)]
+        np.testing.assert_allclose(
+            probs, [lower[s] / 3 + (2 / 3 if s == one else 0) for s in syms.tolist()]
+        )
+
+    def test_backoff(self):
+        dist = fam.fit_distribution(programs)
+        tree_dist = fam.tree_distribution(dist)
+        root, plus = range(2)
+        # never observed, so it backs off to the bigram context
+        unseen = ((plus, 0), (plus, 0))
+        self.assertNotIn(unseen, dist.distribution)
+        self.assertIn(unseen, tree_dist.likelihood_arrays)
+        self.assertEqual(
+            tree_dist.distribution[unseen], tree_dist.distribution[(plus, 0),]
+        )
+        self.assertEqual(
+            tree_dist.distribution[(root, 0), (plus, 0)],
+            sorted(
+                zip(
+                    dist.distribution[(root, 0), (plus, 0)][0].tolist(),
+                    np.log(dist.distribution[(root, 0), (plus, 0)][1]).tolist(),
+                ),
+                key=lambda x: -x[1],
+            ),
+        )
+
+    def test_enumeration_sums_to_one(self):
+        for family, dist in [
+            (fam, fam.fit_distribution(programs)),
+            (fam, fam.uniform()),
+            (
+                fam_with_vars,
+                fam_with_vars.fit_distribution(
+                    [ns.parse_s_expression("(call (lam (+ ($0_0) (1))) (2))")]
+                ),
+            ),
+        ]:
+            result = list(family.enumerate(dist, min_likelihood=-10))
+            self.assertEqual(
+                len({ns.render_s_expression(p) for p, _ in result}), len(result)
+            )
+            total = np.exp([likelihood for _, likelihood in result]).sum()
+            self.assertGreater(total, 0.9)
+            self.assertLessEqual(total, 1 + 1e-6)
+
+    def test_likelihood_matches_enumeration(self):
+        dist = fam_with_vars.fit_distribution(
+            [ns.parse_s_expression("(call (lam (+ ($0_0) (1))) (2))")]
+        )
+        for program, likelihood in fam_with_vars.enumerate(dist, min_likelihood=-6):
+            self.assertAlmostEqual(
+                fam_with_vars.compute_likelihood(dist, program), likelihood
+            )
+
+    def test_sample(self):
+        dist = fam_with_vars.fit_distribution(
+            [ns.parse_s_expression("(call (lam (+ ($0_0) (1))) (2))")]
+        )
+        for seed in range(100):
+            program = fam_with_vars.sample(dist, np.random.RandomState(seed))
+            self.assertGreater(fam_with_vars.compute_likelihood(dist, program), -np.inf)
+
+    def test_no_parameters(self):
+        with self.assertRaises(NotImplementedError):
+            fam.parameters_shape()
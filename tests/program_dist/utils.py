@@ -136,3 +136,11 @@ def enumerate_dsl(family, dist, min_likelihood=-6, max_denominator=10**6):
     result_display = str(result)
     print("{" + result_display[1:-1] + "}")
     return set(result)
+
+
+def program_depth(program: ns.SExpression) -> int:
+    return 1 + max((program_depth(child) for child in program.children), default=0)
+
+
+def program_size(program: ns.SExpression) -> int:
+    return 1 + sum(program_size(child) for child in program.children)